@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+
+'''
+Write a synthetic b6+ or translated-DIAMOND file (and a matching .stb) for benchmarking tRep
+
+The taxIDs come from a taxdump (by default the small one bundled in
+benchmarks/data), and the file is shaped like a real metagenome run:
+
+- genomes with a skewed number of scaffolds, and scaffolds with a skewed
+  number of genes; a few scaffolds aren't in any bin
+- some genes without hits, and up to 25 hits per gene (DIAMOND's default
+  --max-target-seqs), in order of e-value, a few with the same target twice
+- most hits to the species of the genome, others to relatives in the same
+  genus or family, to a genus, to an unrelated species (common ones more
+  often), to a merged taxID, or to one that isn't in the taxonomy at all
+'''
+
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+import tRep.lineage
+
+DEFAULT_TAXDUMP = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'data', 'taxdump.tar.gz')
+
+EXTENSIONS = {'b6+':'.b6+', 'diamond':'.diamondOut'}
+
+# Where the taxID of each hit comes from, and how often
+HIT_SOURCES = [('own species', 0.55), ('same genus', 0.15), ('same family', 0.08), \
+               ('genus', 0.07), ('other species', 0.12), ('merged', 0.02), ('unknown', 0.01)]
+
+# Fraction of genes without a hit, and of scaffolds without a bin
+NO_HIT_GENES = 0.2
+UNBINNED_SCAFFOLDS = 0.1
+
+MAX_HITS_PER_GENE = 25
+
+# Hits generated (and written) at a time
+HITS_PER_CHUNK = 500000
+
+ANNOTATIONS = ['ABC transporter permease', 'DNA-directed RNA polymerase subunit beta', \
+    'Elongation factor Tu', 'Glutamine synthetase', 'Hypothetical protein', \
+    'LysR family transcriptional regulator', 'Methyl-accepting chemotaxis protein', \
+    'NADH-quinone oxidoreductase subunit', 'Outer membrane protein', '50S ribosomal protein L2', \
+    'Sensor histidine kinase', 'TonB-dependent receptor', 'Uncharacterized protein']
+
+def parse_count(count):
+    '''
+    Turn "10k", "1M" or "10M" (or a plain number) into an int
+    '''
+    count = str(count).strip()
+    multiplier = {'k':1000, 'K':1000, 'm':1000000, 'M':1000000, 'g':1000000000, 'G':1000000000}
+    if count[-1] in multiplier:
+        return int(float(count[:-1]) * multiplier[count[-1]])
+    return int(float(count))
+
+def b6_loc(out_base, format):
+    return out_base + EXTENSIONS[format]
+
+def stb_loc(out_base):
+    return out_base + '.stb'
+
+class Taxonomy():
+    '''
+    The species of a LineageIndex, grouped by genus and by family, and the names to write into b6+ files
+    '''
+    def __init__(self, index, rng):
+        self.index = index
+        self.species = np.nonzero(index.rank == tRep.lineage.LEVELS.index('species'))[0]
+        self.genus = self.ancestor(self.species, 'genus')
+        self.family = self.ancestor(self.species, 'family')
+        self.merged = np.nonzero(index.merged)[0]
+        self.max_taxid = len(index)
+
+        # Some species are much more common than others
+        weights = 1.0 / np.arange(1, len(self.species) + 1) ** 1.1
+        self.weights = rng.permutation(weights / weights.sum())
+
+        self.groups = {level:self._groups(getattr(self, level)) for level in ['genus', 'family']}
+
+    def ancestor(self, taxids, level):
+        '''
+        The taxID at this rank in the lineage of each taxID (0 if there isn't one)
+        '''
+        rank = tRep.lineage.LEVELS.index(level)
+        current = np.array(taxids, dtype=np.int64)
+        for i in range(tRep.lineage.MAX_DEPTH):
+            walk = (current != 0) & (self.index.rank[current] != rank)
+            if not walk.any():
+                break
+            current[walk] = self.index.parent[current[walk]]
+        return current
+
+    def _groups(self, ancestors):
+        order = np.argsort(ancestors, kind='stable')
+        keys, starts, counts = np.unique(ancestors[order], return_index=True, return_counts=True)
+        return keys, starts, counts, self.species[order]
+
+    def relatives(self, species_idx, level, rng):
+        '''
+        A random species in the same genus / family as each species (by index into self.species)
+        '''
+        keys, starts, counts, members = self.groups[level]
+        g = np.searchsorted(keys, getattr(self, level)[species_idx])
+        return members[starts[g] + (rng.random(len(g)) * counts[g]).astype(np.int64)]
+
+    def common_species(self, n, rng):
+        return rng.choice(len(self.species), size=n, p=self.weights)
+
+    def tax_strings(self, taxids):
+        '''
+        The "species" field of a b6+ annotation: the names of the top three ranks
+        '''
+        strings = {}
+        for t, entry in zip(taxids, self.index.lineage_entries(taxids)):
+            names = [name for node, rank, name in entry[:3]] if entry is not None else ['unclassified']
+            strings[t] = '; '.join(names) + '.;'
+        return strings
+
+def generate(out_base, hits, format='diamond', taxdump=DEFAULT_TAXDUMP, seed=0):
+    '''
+    Write out_base.b6+ (or out_base.diamondOut) with this many hits, and out_base.stb
+    '''
+    rng = np.random.default_rng(seed)
+    taxonomy = Taxonomy(tRep.lineage.LineageIndex.from_taxdump(taxdump), rng)
+    proteins = max(hits // 4, 1000)
+
+    written = 0
+    genome = 0
+    with open(b6_loc(out_base, format), 'w') as b6, open(stb_loc(out_base), 'w') as stb:
+        while written < hits:
+            db, scaffolds = _generate_chunk(taxonomy, rng, genome, min(HITS_PER_CHUNK, hits - written), \
+                                            proteins, format)
+            _write_lines(b6, db)
+            _write_lines(stb, scaffolds)
+            written += len(db)
+            genome += scaffolds.attrs['genomes']
+    return b6_loc(out_base, format)
+
+# Hits per genome is ~1,500 on average, but varies a lot
+HITS_PER_GENOME = 1000
+
+def _generate_chunk(taxonomy, rng, first_genome, hits, proteins, format, genomes=None):
+    '''
+    Make enough genomes for this many hits; returns a DataFrame of b6 columns
+    (cut to exactly this many hits) and a DataFrame of scaffold -> bin
+    '''
+    # Genomes -> scaffolds -> genes -> hits, each a skewed number of the next
+    if genomes is None:
+        genomes = max(1, hits // HITS_PER_GENOME)
+    scaffolds_per_genome = 1 + rng.lognormal(3.5, 1.0, genomes).astype(np.int64)
+    scaffold_genome = np.repeat(np.arange(genomes), scaffolds_per_genome)
+
+    genes_per_scaffold = 1 + rng.lognormal(2.0, 1.2, len(scaffold_genome)).astype(np.int64)
+    gene_scaffold = np.repeat(np.arange(len(scaffold_genome)), genes_per_scaffold)
+    gene_number = np.arange(len(gene_scaffold)) - np.repeat(np.cumsum(genes_per_scaffold) - \
+                    genes_per_scaffold, genes_per_scaffold) + 1
+
+    hits_per_gene = np.minimum(rng.geometric(0.45, len(gene_scaffold)), MAX_HITS_PER_GENE)
+    hits_per_gene[rng.random(len(gene_scaffold)) < NO_HIT_GENES] = 0
+    hit_gene = np.repeat(np.arange(len(gene_scaffold)), hits_per_gene)
+    hit_rank = np.arange(len(hit_gene)) - np.repeat(np.cumsum(hits_per_gene) - hits_per_gene, hits_per_gene)
+
+    # Too few hits is unlikely, but possible; try again with more genomes
+    if len(hit_gene) < hits:
+        return _generate_chunk(taxonomy, rng, first_genome, hits, proteins, format, genomes=genomes * 2)
+    hit_gene = hit_gene[:hits]
+    hit_rank = hit_rank[:hits]
+    hit_scaffold = gene_scaffold[hit_gene]
+    hit_genome = scaffold_genome[hit_scaffold]
+
+    # Names
+    genome_names = np.array(['genome_{0:05d}'.format(first_genome + g) for g in range(genomes)], dtype=object)
+    scaffold_names = genome_names[scaffold_genome] + '_scaffold_' + \
+                        (np.arange(len(scaffold_genome)) + 1).astype(str).astype(object)
+    querry = scaffold_names[hit_scaffold] + '_' + gene_number[hit_gene].astype(str).astype(object)
+    if format == 'diamond':
+        # Diamond turns the spaces of prodigal headers into "|"
+        querry = querry + '|' + genome_names[hit_genome]
+
+    taxids = _hit_taxids(taxonomy, rng, genomes, hit_genome)
+    protein = rng.integers(0, proteins, len(hit_gene))
+    # The same target twice for a gene (like DIAMOND's multiple HSPs)
+    repeat = (hit_rank > 0) & (rng.random(len(hit_gene)) < 0.005)
+    protein[repeat] = protein[np.nonzero(repeat)[0] - 1]
+    accession = pd.Series(protein).map(lambda p: 'A0A{0:07X}'.format(p * 7919 % 0xFFFFFFF)).to_numpy(dtype=object)
+
+    db = pd.DataFrame({'querry':querry})
+    if format == 'diamond':
+        group = taxonomy.ancestor(taxids, 'genus')
+        group = np.where(group == 0, taxids, group)
+        db['target'] = accession + '_' + taxids.astype(str).astype(object) + '_' + group.astype(str).astype(object)
+    else:
+        db['target'] = accession + '_' + pd.Series(taxids % 26 ** 2).map(lambda x: '9' + chr(65 + x // 26) + \
+                        chr(65 + x % 26) + 'XX').to_numpy(dtype=object)
+    _add_alignments(db, rng, hit_rank)
+
+    if format == 'b6+':
+        tax_strings = taxonomy.tax_strings(sorted(set(taxids.tolist())))
+        annotation = np.array(ANNOTATIONS, dtype=object)[rng.integers(0, len(ANNOTATIONS), len(db))]
+        db['extra'] = annotation + ' {ECO:0000313|EMBL:KJZ97909.1};  TaxID=' + taxids.astype(str).astype(object) + \
+            ' species="' + pd.Series(taxids).map(tax_strings).to_numpy(dtype=object) + '" source="' + \
+            annotation + '";'
+
+    # Bins, leaving some scaffolds out
+    binned = rng.random(len(scaffold_genome)) >= UNBINNED_SCAFFOLDS
+    scaffolds = pd.DataFrame({'scaffold':scaffold_names[binned], \
+                              'bin':genome_names[scaffold_genome[binned]] + '.fa'})
+    scaffolds.attrs['genomes'] = genomes
+    return db, scaffolds
+
+def _hit_taxids(taxonomy, rng, genomes, hit_genome):
+    '''
+    Pick the taxID of every hit based on the species of its genome (see HIT_SOURCES)
+    '''
+    genome_species = taxonomy.common_species(genomes, rng)
+    own = genome_species[hit_genome]
+    sources = rng.choice(len(HIT_SOURCES), size=len(hit_genome), p=[p for s, p in HIT_SOURCES])
+    names = [s for s, p in HIT_SOURCES]
+
+    taxids = taxonomy.species[own].copy()
+    for i, name in enumerate(names):
+        pick = sources == i
+        n = int(pick.sum())
+        if (n == 0) or (name == 'own species'):
+            continue
+        if name == 'same genus':
+            taxids[pick] = taxonomy.relatives(own[pick], 'genus', rng)
+        elif name == 'same family':
+            taxids[pick] = taxonomy.relatives(own[pick], 'family', rng)
+        elif name == 'genus':
+            genus = taxonomy.genus[own[pick]]
+            taxids[pick] = np.where(genus == 0, taxids[pick], genus)
+        elif name == 'other species':
+            taxids[pick] = taxonomy.species[taxonomy.common_species(n, rng)]
+        elif name == 'merged':
+            if len(taxonomy.merged) > 0:
+                taxids[pick] = rng.choice(taxonomy.merged, n)
+        elif name == 'unknown':
+            taxids[pick] = taxonomy.max_taxid + rng.integers(1, 1000000, n)
+    return taxids
+
+def _add_alignments(db, rng, hit_rank):
+    '''
+    Add the numeric b6 columns, with e-values getting worse down the hits of a gene
+    '''
+    n = len(db)
+    length = rng.integers(30, 800, n)
+    percent = np.round(rng.uniform(30, 100, n), 1)
+    mismatches = (length * (100 - percent) / 100).astype(np.int64)
+    start = rng.integers(1, 50, n)
+    best = rng.uniform(5, 180, n)
+    exponent = np.maximum(best - hit_rank * rng.uniform(0, 10, n), 1)
+
+    db['percentID'] = percent
+    db['alignment_length'] = length
+    db['mm'] = mismatches
+    db['gaps'] = rng.integers(0, 5, n)
+    db['querry_start'] = start
+    db['querry_end'] = start + length - 1
+    db['target_start'] = start
+    db['target_end'] = start + length - 1
+    db['e-value'] = pd.Series(10.0 ** -exponent).map('{0:.1e}'.format).to_numpy(dtype=object)
+    db['bit_score'] = np.round(exponent * 2.2 + 30, 1)
+
+def _write_lines(handle, db):
+    # Written by hand since csv writers want to quote the quotes of b6+ annotations
+    lines = db.iloc[:, 0].astype(str)
+    for col in db.columns[1:]:
+        lines = lines + '\t' + db[col].astype(str)
+    handle.write('\n'.join(lines) + '\n')
+
+def main(**args):
+    hits = parse_count(args.get('hits'))
+    start = time.time()
+    loc = generate(args.get('output'), hits, format=args.get('format'), \
+                   taxdump=args.get('taxdump'), seed=int(args.get('seed')))
+    print("Wrote {0} hits to {1} ({2:.1f} Mb) in {3:.1f} seconds".format(hits, loc, \
+        os.path.getsize(loc) / 1e6, time.time() - start))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write a synthetic b6+ or DIAMOND file (and .stb) for benchmarking")
+    parser.add_argument('-o', '--output', required=True, help='output basename')
+    parser.add_argument('-n', '--hits', default='10k', help='number of hits, like 10k, 1M or 10M')
+    parser.add_argument('-f', '--format', default='diamond', choices=list(EXTENSIONS.keys()), \
+        help='b6+ (taxIDs in the annotation) or diamond (taxIDs in the target)')
+    parser.add_argument('--taxdump', default=DEFAULT_TAXDUMP, help='NCBI taxdump to take taxIDs from')
+    parser.add_argument('--seed', default=0, help='random seed')
+
+    args = parser.parse_args()
+    main(**vars(args))
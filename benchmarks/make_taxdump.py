@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+
+'''
+Make the small synthetic NCBI taxdump bundled in benchmarks/data/taxdump.tar.gz
+
+It's shaped like the real one (superkingdoms down to species, with sparse
+taxIDs, unranked clades in between, missing ranks, strains below species,
+synonyms and merged taxIDs), but only a few thousand nodes, so benchmarks
+never need the network or ete3's taxa.sqlite. The same seed always makes the
+same file.
+'''
+
+import io
+import os
+import gzip
+import random
+import tarfile
+import argparse
+
+SYLLABLES = ['ba', 'ci', 'do', 'fu', 'ga', 'li', 'mo', 'nu', 'pe', 'ra', 'si', 'to', 'vi', 'xa', \
+             'bac', 'cor', 'lac', 'mon', 'pse', 'rhi', 'str', 'ter', 'vib', 'zym']
+
+# (name, taxID, number of phyla)
+SUPERKINGDOMS = [('Bacteria', 2, 40), ('Archaea', 2157, 10), ('Eukaryota', 2759, 12), ('Viruses', 10239, 8)]
+
+def make_taxonomy(seed):
+    '''
+    Return lists of nodes (taxID, parent, rank), names (taxID, name, name class) and merged (old, new)
+    '''
+    rng = random.Random(seed)
+    used = set([1, 131567] + [s[1] for s in SUPERKINGDOMS])
+
+    def new_id():
+        while True:
+            t = rng.randint(3000, 3000000)
+            if t not in used:
+                used.add(t)
+                return t
+
+    def latin(suffix=''):
+        return ''.join(rng.choice(SYLLABLES) for i in range(rng.randint(2, 4))).capitalize() + suffix
+
+    nodes = [(1, 1, 'no rank'), (131567, 1, 'no rank')]
+    names = [(1, 'root', 'scientific name'), (131567, 'cellular organisms', 'scientific name')]
+
+    def add(parent, rank, name):
+        # Real lineages have unranked clades between some of the ranks
+        if (rank != 'species') and (rng.random() < 0.1):
+            clade = new_id()
+            nodes.append((clade, parent, 'clade'))
+            names.append((clade, latin(' group'), 'scientific name'))
+            parent = clade
+        t = new_id()
+        nodes.append((t, parent, rank))
+        names.append((t, name, 'scientific name'))
+        if rng.random() < 0.05:
+            names.append((t, latin(), 'synonym'))
+        return t
+
+    def children(low, high):
+        # Skewed like the real tree: most taxa have few children, a few have lots
+        return min(high, low + int(rng.paretovariate(1.5)) - 1)
+
+    species = []
+    for sk_name, sk, phyla in SUPERKINGDOMS:
+        nodes.append((sk, 131567 if sk != 10239 else 1, 'superkingdom'))
+        names.append((sk, sk_name, 'scientific name'))
+        for p in range(phyla):
+            phylum = add(sk, 'phylum', latin('ota'))
+            for c in range(children(1, 4)):
+                cls = add(phylum, 'class', latin('ia'))
+                for o in range(children(1, 5)):
+                    order = add(cls, 'order', latin('ales'))
+                    for f in range(children(1, 5)):
+                        # Some genera have no family
+                        family = add(order, 'family', latin('aceae')) if rng.random() > 0.03 else order
+                        for g in range(children(1, 6)):
+                            genus_name = latin()
+                            genus = add(family, 'genus', genus_name)
+                            for s in range(children(1, 12)):
+                                sp = add(genus, 'species', genus_name + ' ' + latin().lower())
+                                species.append(sp)
+                                if rng.random() < 0.1:
+                                    add(sp, 'strain', genus_name + ' strain ' + str(rng.randint(1, 999)))
+
+    # Obsolete taxIDs that were merged into current ones
+    merged = [(new_id(), rng.choice(species)) for i in range(len(species) // 10)]
+
+    return nodes, names, merged
+
+def dmp_lines(rows):
+    '''
+    Format rows the way NCBI does: fields joined by "\\t|\\t", each line ending with "\\t|"
+    '''
+    return ''.join('\t|\t'.join(str(x) for x in row) + '\t|\n' for row in rows)
+
+def write_taxdump(loc, nodes, names, merged):
+    # nodes.dmp has 13 fields; only the first three are used
+    node_rows = [(t, p, r, '', 0, 1, 11, 1, 0, 1, 0, 0, '') for t, p, r in nodes]
+    name_rows = [(t, n, '', c) for t, n, c in names]
+
+    # A fixed time in the gzip header and for every file, so the output only changes if its contents do
+    with gzip.GzipFile(loc, 'wb', mtime=0) as gz, tarfile.open(fileobj=gz, mode='w') as tar:
+        for name, text in [('nodes.dmp', dmp_lines(node_rows)), ('names.dmp', dmp_lines(name_rows)), \
+                           ('merged.dmp', dmp_lines(merged))]:
+            data = text.encode('utf-8')
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = 0
+            tar.addfile(info, io.BytesIO(data))
+
+def main(**args):
+    nodes, names, merged = make_taxonomy(int(args.get('seed')))
+    write_taxdump(args.get('output'), nodes, names, merged)
+    print("Wrote {0} nodes ({1} species) and {2} merged taxIDs to {3}".format(len(nodes), \
+        sum(1 for n in nodes if n[2] == 'species'), len(merged), args.get('output')))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Make a small synthetic NCBI taxdump for benchmarks")
+    parser.add_argument('-o', '--output', default=os.path.join(os.path.dirname(os.path.realpath(__file__)), \
+        'data', 'taxdump.tar.gz'), help='where to write the taxdump (default: the bundled one)')
+    parser.add_argument('--seed', default=0, help='random seed')
+
+    args = parser.parse_args()
+    main(**vars(args))
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+
+'''
+Time and measure the peak memory of each stage of tax_collector.py on synthetic data
+
+For every size (like 10k, 1M or 10M hits) and format (b6+ / diamond), a b6
+file and .stb are made with generate_b6.py (kept in --work_dir, so they're only
+made once) and run through the stages of making the gene, genome and scaffold
+taxonomy tables one at a time:
+
+    type_b6, load_b6, gen_levels_db, merge_taxonomy, add_scaffolds,
+    compact_tdb, add_bin_to_tdb, gen_taxonomy_table (bin / scaffold)
+
+Lineages come from the taxdump bundled in benchmarks/data (the lineage cache is
+turned off), so no network or NCBI taxonomy database is needed.
+
+Peak memory is how far the resident set grew during a stage (Linux only; on
+other systems tracemalloc is used, which slows the stages down). Results are
+written as JSON; pass an earlier one to --baseline to flag stages that got slower
+'''
+
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+import generate_b6
+
+def run_stages(b6_loc, stb_loc):
+    '''
+    Run every stage on one b6 file; returns a dictionary of stage -> measurements
+    '''
+    import tRep
+    import tRep.controller
+
+    results = {}
+    def measure(stage, function, *args, **kwargs):
+        value, results[stage] = measure_call(function, *args, **kwargs)
+        print("    {0:<32}{1:>9.3f} s {2:>10.1f} Mb".format(stage, results[stage]['seconds'], \
+            results[stage]['peak_mb']))
+        return value
+
+    type = measure('type_b6', tRep.type_b6, b6_loc)
+    Bdb = measure('load_b6', tRep.load_b6, b6_loc)
+    Bdb = Bdb[~Bdb['taxID'].isna()]
+    tax = measure('gen_levels_db', tRep.gen_levels_db, list(Bdb['taxID'].unique()))
+    Tdb = measure('merge_taxonomy', tRep.controller.merge_taxonomy, Bdb, tax)
+    del Bdb
+    Tdb = measure('add_scaffolds', tRep.controller.add_scaffolds, Tdb, type)
+    Tdb = measure('compact_tdb', tRep.compact_tdb, Tdb)
+    Tdb = measure('add_bin_to_tdb', tRep.add_bin_to_tdb, Tdb, stb_loc)
+    measure('gen_taxonomy_table (bin)', tRep.gen_taxonomy_table, Tdb, on='bin')
+    measure('gen_taxonomy_table (scaffold)', tRep.gen_taxonomy_table, Tdb, on='scaffold')
+
+    return results
+
+def measure_call(function, *args, **kwargs):
+    '''
+    Call function and return its value, and a dictionary of the seconds it took and
+    the megabytes of memory it used at its peak
+    '''
+    rss = can_reset_peak_rss()
+    if rss:
+        reset_peak_rss()
+        before = read_status('VmRSS')
+    else:
+        tracemalloc.start()
+
+    start = time.perf_counter()
+    value = function(*args, **kwargs)
+    seconds = time.perf_counter() - start
+
+    if rss:
+        peak = max(read_status('VmHWM') - before, 0)
+    else:
+        peak = tracemalloc.get_traced_memory()[1] / 1024
+        tracemalloc.stop()
+    return value, {'seconds':seconds, 'peak_mb':peak / 1024}
+
+def can_reset_peak_rss():
+    return os.access('/proc/self/clear_refs', os.W_OK)
+
+def reset_peak_rss():
+    # Writing 5 resets the peak resident set size (VmHWM) of this process
+    with open('/proc/self/clear_refs', 'w') as o:
+        o.write('5')
+
+def read_status(key):
+    '''
+    Read a value (in kB) from /proc/self/status
+    '''
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(key + ':'):
+                return int(line.split()[1])
+
+def use_taxdump(taxdump):
+    '''
+    Resolve lineages from a taxdump instead of the NCBI taxonomy database
+    '''
+    os.environ['TREP_LINEAGE_CACHE'] = 'off'
+    import tRep
+    import tRep.lineage
+    tRep.lineage_index = tRep.lineage.LineageIndex.from_taxdump(taxdump)
+
+def compare(results, baseline, threshold):
+    '''
+    Print how each stage changed since the baseline; returns the stages that got slower than threshold times
+    '''
+    slower = []
+    print("\n{0:<44}{1:>12}{2:>12}{3:>8}{4:>12}{5:>12}".format('stage', 'baseline s', 'now s', \
+        'ratio', 'baseline Mb', 'now Mb'))
+    for run, stages in results['runs'].items():
+        if run not in baseline['runs']:
+            continue
+        for stage, now in stages.items():
+            then = baseline['runs'][run].get(stage)
+            if then is None:
+                continue
+            ratio = now['seconds'] / max(then['seconds'], 1e-6)
+            flag = ''
+            # Stages that take no time at all are too noisy to judge
+            if (ratio > threshold) and (now['seconds'] > 0.01):
+                flag = '  SLOWER'
+                slower.append('{0} {1}'.format(run, stage))
+            print("{0:<44}{1:>12.3f}{2:>12.3f}{3:>8.2f}{4:>12.1f}{5:>12.1f}{6}".format(\
+                run + ' ' + stage, then['seconds'], now['seconds'], ratio, then['peak_mb'], \
+                now['peak_mb'], flag))
+    return slower
+
+def main(**args):
+    sizes = [s.strip() for s in args.get('sizes').split(',')]
+    formats = [f.strip() for f in args.get('formats').split(',')]
+    taxdump = args.get('taxdump')
+    seed = int(args.get('seed'))
+
+    work_dir = args.get('work_dir')
+    if work_dir is None:
+        work_dir = os.path.join(tempfile.gettempdir(), 'tRep_benchmarks')
+    os.makedirs(work_dir, exist_ok=True)
+
+    use_taxdump(taxdump)
+    import tRep
+
+    results = {'tRep_version':tRep.__version__, 'tRep_loc':os.path.dirname(os.path.realpath(tRep.__file__)), \
+               'python':platform.python_version(), 'machine':platform.machine(), \
+               'date':time.strftime('%Y-%m-%d %H:%M:%S'), 'seed':seed, 'runs':{}}
+    for size in sizes:
+        hits = generate_b6.parse_count(size)
+        for format in formats:
+            out_base = os.path.join(work_dir, 'synthetic_{0}_{1}_{2}'.format(size, format.replace('+', 'plus'), seed))
+            b6_loc = generate_b6.b6_loc(out_base, format)
+            if not os.path.isfile(b6_loc):
+                print("Making {0} ({1} hits)".format(b6_loc, hits))
+                generate_b6.generate(out_base, hits, format=format, taxdump=taxdump, seed=seed)
+
+            run = '{0} {1}'.format(size, format)
+            print("{0} ({1:.1f} Mb)".format(run, os.path.getsize(b6_loc) / 1e6))
+            results['runs'][run] = run_stages(b6_loc, generate_b6.stb_loc(out_base))
+
+    if args.get('json') is not None:
+        with open(args.get('json'), 'w') as o:
+            json.dump(results, o, indent=2)
+
+    if args.get('baseline') is not None:
+        with open(args.get('baseline')) as f:
+            baseline = json.load(f)
+        slower = compare(results, baseline, float(args.get('threshold')))
+        if len(slower) > 0:
+            print("\n{0} stages are more than {1}x slower than the baseline".format(len(slower), \
+                args.get('threshold')))
+            sys.exit(1)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the stages of tax_collector.py on synthetic data")
+    parser.add_argument('-s', '--sizes', default='10k,1M', help='comma-separated numbers of hits, like 10k,1M,10M')
+    parser.add_argument('-f', '--formats', default='diamond,b6+', help='comma-separated b6 formats (diamond, b6+)')
+    parser.add_argument('--taxdump', default=generate_b6.DEFAULT_TAXDUMP, \
+        help='NCBI taxdump to resolve lineages with (default: the bundled synthetic one)')
+    parser.add_argument('--work_dir', default=None, help='where to keep the synthetic files (default: a temporary directory)')
+    parser.add_argument('--seed', default=0, help='random seed of the synthetic files')
+    parser.add_argument('--json', default=None, help='write the results to this .json file')
+    parser.add_argument('--baseline', default=None, help='.json results of an earlier run to compare to')
+    parser.add_argument('--threshold', default=1.25, help=\
+        'with --baseline, exit with an error if a stage is more than this many times slower')
+
+    args = parser.parse_args()
+    main(**vars(args))
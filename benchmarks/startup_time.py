@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+
+'''
+Measure how long it takes to start tRep
+
+Every measurement runs in a fresh interpreter, so it includes the cost of all
+imports done by "import tRep" and by the scripts in bin/. Point --tree at
+another checkout (for example an older release) to compare the two.
+'''
+
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+
+def get_commands(tree):
+    python = sys.executable
+    return [
+        ('python (no imports)', [python, '-c', 'pass']),
+        ('import pandas', [python, '-c', 'import pandas']),
+        ('import tRep', [python, '-c', 'import tRep']),
+        ('tax_collector.py --help', [python, os.path.join(tree, 'bin', 'tax_collector.py'), '--help']),
+        ('functional_tax.py --help', [python, os.path.join(tree, 'bin', 'functional_tax.py'), '--help']),
+        ('make_Tdb.py --help', [python, os.path.join(tree, 'bin', 'make_Tdb.py'), '--help']),
+        ('quickTaxonomy_centrifuge.py --help', [python, os.path.join(tree, 'bin', 'quickTaxonomy_centrifuge.py'), '--help']),
+    ]
+
+def time_command(cmd, tree, repeats):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = tree + os.pathsep + env.get('PYTHONPATH', '')
+
+    times = []
+    for i in range(repeats):
+        start = time.perf_counter()
+        subprocess.run(cmd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        times.append(time.perf_counter() - start)
+    return times
+
+def main(**args):
+    tree = os.path.abspath(args.get('tree'))
+    repeats = int(args.get('repeats'))
+
+    results = {}
+    for name, cmd in get_commands(tree):
+        times = time_command(cmd, tree, repeats)
+        results[name] = {'median':statistics.median(times), 'min':min(times), 'max':max(times)}
+        print("{0:<40}{1:>8.3f} s (min {2:.3f}, max {3:.3f})".format(name, \
+            results[name]['median'], results[name]['min'], results[name]['max']))
+
+    if args.get('json') is not None:
+        with open(args.get('json'), 'w') as o:
+            json.dump({'tree':tree, 'repeats':repeats, 'results':results}, o, indent=2)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure the startup time of tRep and its scripts")
+    parser.add_argument('--tree', default=os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'), \
+        help='tRep checkout to measure (default: this one)')
+    parser.add_argument('-n', '--repeats', default=5, help='number of times to run each command')
+    parser.add_argument('--json', default=None, help='also write the results to this .json file')
+
+    args = parser.parse_args()
+    main(**vars(args))
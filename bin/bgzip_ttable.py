@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+'''
+Recompress a translation table as BGZF
+
+BGZF files are still regular .gz files, but are made of small independent blocks
+so that functional_tax.py can split the scan of them between processes
+'''
+
+import os
+import sys
+import gzip
+import time
+import argparse
+import tRep
+import tRep.ttable
+
+__version__ = tRep.__version__
+
+def main(**args):
+    in_loc = args.get('input')
+    out_loc = args.get('output')
+    level = int(args.get('level'))
+
+    if os.path.abspath(in_loc) == os.path.abspath(out_loc):
+        print("The output can't overwrite the input; pick a different output location")
+        sys.exit(1)
+
+    start = time.time()
+    if tRep.ttable.is_bgzf(in_loc):
+        print("{0} is already BGZF compressed; recompressing anyway".format(in_loc))
+    with gzip.open(in_loc, 'rb') as handle:
+        tRep.ttable.write_bgzf(handle, out_loc, level=level)
+
+    print("{0:.1f} seconds to recompress {1} ({2:.1f} Mb) into {3} ({4:.1f} Mb)".format(\
+        time.time() - start, in_loc, os.path.getsize(in_loc) / 1e6, \
+        out_loc, os.path.getsize(out_loc) / 1e6))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Recompress a gzipped translation table as BGZF, " \
+        + "so that functional_tax.py can read it with multiple processes")
+
+    InpArgs = parser.add_argument_group('INPUT ARGUMENTS')
+    InpArgs.add_argument('-i', '--input', help='location of gzipped translation table', \
+        required=True)
+
+    OutArgs = parser.add_argument_group('OUTPUT ARGUMENTS')
+    OutArgs.add_argument('-o', '--output', help=\
+        'location of BGZF translation table to write', required=True)
+
+    OptArgs = parser.add_argument_group('OPTIONAL ARGUMENTS')
+    OptArgs.add_argument('-l', '--level', help='compression level (1-9)', default=6)
+
+    # Specify output of "--version"
+    parser.add_argument(
+        "--version",
+        action="version",
+        version="%(prog)s (version {version})".format(version=__version__))
+
+    args = sys.argv[1:]
+    if (len(args) == 0):
+        print('Run with -h for help')
+        sys.exit(0)
+
+    args = parser.parse_args()
+    main(**vars(args))
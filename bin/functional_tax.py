@@ -7,52 +7,24 @@ Simple script to get functional taxonomy from a b6 file and a translation table
 import os
 import sys
 import time
-import gzip
 import argparse
 import pandas as pd
 
 import tRep
 import tRep.controller
+import tRep.server
 
 __version__ = tRep.__version__
 
 def main(**args):
-    b6_loc = args.get('b6_loc')
-    out_base = args.get('out_loc')
-    database = args.get('database')
-
-    # Load the hits
-    Bdb = tRep.load_b6(b6_loc)
-
-    # Load translations
-    start = time.time()
-    r2t = funcional_annotation(database, set(Bdb['target'].tolist()))
-    end = time.time()
-    print("{0:.1f} seconds to load translation database".format(end-start))
-
-    # Make the translation table
-    Bdb['functional_annotation'] = Bdb['target'].map(r2t)
-
-    # Save
-    Bdb.to_csv(os.path.join(out_base) + '_geneFunctionalAnnotation.tsv', \
-        index=False, sep='\t')
+    if tRep.server.forward('functional_tax', args):
+        return
+    tRep.controller.run_functional_tax(args)
 
 def load_transtable(loc):
     db = pd.read_csv(loc, sep = '\t', names=['ID', 'annotation'], dtype=str)
     return db.set_index('ID')['annotation'].to_dict()
 
-def funcional_annotation(tt_loc, hits):
-    r2t = dict()
-    assert type(hits) == type(set(hits))
-
-    with gzip.open(tt_loc,'rt') as f:
-        for line in f:
-            if line.split('\t')[0] in hits:
-                linewords = line.strip().split('\t')
-                r2t[linewords[0]] = linewords[1]
-    return r2t
-
-
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Simple script to get functional taxonomy from a b6 file and a translation table")
 
@@ -64,6 +36,15 @@ if __name__ == "__main__":
     InpArgs.add_argument('-d', '--database',  help=\
         'location of translation database', required=True)
 
+    OptArgs = parser.add_argument_group('OPTIONAL ARGUMENTS')
+    OptArgs.add_argument('--build_index', action='store_true', default=False, help=\
+        'index the translation database (if it isn\'t already) so that this and future runs '\
+        + 'only look up the hits instead of reading the whole database. The index is written '\
+        + 'next to the database as [database].idx')
+    OptArgs.add_argument('-p', '--processes', default=6, help=\
+        'processes to scan the translation database with (only used if it\'s BGZF compressed '\
+        + 'and not indexed; see bgzip_ttable.py)')
+
     # Specify output of "--version"
     parser.add_argument(
         "--version",
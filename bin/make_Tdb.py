@@ -10,10 +10,13 @@ import argparse
 import sys
 import tRep
 import tRep.controller
+import tRep.server
 
 __version__ = tRep.__version__
 
 def main(**args):
+    if tRep.server.forward('make_Tdb', args):
+        return
     tRep.controller.convert_b6_to_Tdb(args, save=True)
 
 if __name__ == "__main__":
@@ -26,6 +29,15 @@ if __name__ == "__main__":
     OutArgs = parser.add_argument_group('OUTPUT ARGUMENTS')
     OutArgs.add_argument('-o', '--out_loc',  help=\
         'location of output file', required=True)
+    OutArgs.add_argument('--output_format',  help=\
+        'format of the output file (default: csv, unless the output location ends in .parquet '\
+        + 'or .feather); parquet and feather need pyarrow installed', default=None, \
+        choices=['csv', 'parquet', 'feather'])
+
+    OptArgs = parser.add_argument_group('OPTIONAL ARGUMENTS')
+    OptArgs.add_argument('--max_memory',  help=\
+        "Read the b6 file in chunks, using about this many megabytes (on top of the final table) to parse each one",
+        action='store', type=float, default=None)
 
     # Specify output of "--version"
     parser.add_argument(
@@ -7,6 +7,7 @@ import argparse
 import sys
 
 import tRep
+import tRep.server
 
 __version__ = tRep.__version__
 
@@ -25,8 +26,9 @@ if __name__ == "__main__":
     # InpArgs.add_argument('-tdb',
     #     help='Tdb.csv (from dRep run))
     # Parsing from .fasta file
-    InpArgs.add_argument('-f', "--fasta",
-        help='location of fasta file(s) to detemine the taxonomy of')
+    InpArgs.add_argument('-f', "--fasta", nargs='+',
+        help='location of fasta file(s) to detemine the taxonomy of, or directories of them (.fa, .fna or '\
+        + '.fasta). Genes are called for the next genomes while the current one is classified')
     InpArgs.add_argument("--cent_index",help='path to centrifuge index (for example, ' + \
                     "/home/mattolm/download/centrifuge/indices/b+h+v", default= \
                     "/home/mattolm/download/centrifuge/indices/b+h+v")
@@ -40,6 +42,14 @@ if __name__ == "__main__":
         'Minimum percent of genes for the percent method')
     OutArgs.add_argument('--full_dump', default=None, help=\
         'Output FULL taxonomy table to the file specified here (for testing purposes)')
+    OutArgs.add_argument('--out_table', default=None, help=\
+        'With more than one fasta file, also save the taxonomy of every genome to this .tsv file')
+    OutArgs.add_argument('--tmp_dir', default=None, help=\
+        'where to call and classify genes (default: the temporary directory); each genome\'s files '\
+        + 'are removed as soon as it\'s done')
+    OutArgs.add_argument('--work_dir', default=None, help=\
+        'keep the prodigal and centrifuge output of every genome in this directory instead of removing it; '\
+        + 'genomes that already have it there aren\'t run again')
 
     FilArgs = parser.add_argument_group('FILTERING ARGUMENTS')
     FilArgs.add_argument('--min_score', default='250', help=\
@@ -52,7 +62,8 @@ if __name__ == "__main__":
         "--version",
         action="version",
         version="%(prog)s (version {version})".format(version=__version__))
-    parser.add_argument('-p', '--processes', help='threads for centrifuge run', default='6')
+    parser.add_argument('-p', '--processes', help='threads to use; with more than one fasta file, they\'re '\
+        + 'split between calling genes and centrifuge runs', default='6')
 
     args = sys.argv[1:]
     if (len(args) == 0):
@@ -60,4 +71,5 @@ if __name__ == "__main__":
         sys.exit(0)
 
     args = parser.parse_args()
-    tRep.main(**vars(args))
+    if not tRep.server.forward('quickTaxonomy_centrifuge', vars(args)):
+        tRep.main(**vars(args))
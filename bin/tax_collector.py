@@ -6,47 +6,32 @@ import os
 
 import tRep
 import tRep.controller
+import tRep.table_io
+import tRep.server
 
 __version__ = tRep.__version__
 
 def main(**args):
-    out_base = args.get('out_loc')
-    skip_scaffs = args.get('SkipScaffolds', False)
-    skip_genes = args.get('SkipGenes', False)
-    stb = args.get('scaffold2bin', None)
     update = args.get('update', False)
+    manifest = args.get('manifest', None)
 
     if update:
         from ete3 import NCBITaxa
         ncbi = NCBITaxa()
+        tRep.taxdb.close()
         ncbi.update_taxonomy_database()
+        tRep.lineage_cache.clear(ncbi.dbfile)
 
-    # Make Tdb (gene_level taxonomy)
-    Tdb = tRep.controller.convert_b6_to_Tdb(args, save=False)
-    if not skip_genes:
-        Tdb.to_csv(os.path.join(out_base) + '_fullGeneTaxonomy.tsv', \
-            index=False, sep='\t')
-
-    # Make genome level taxonomy
-    if stb is None:
-        pass
+    if manifest is not None:
+        Rdb = tRep.controller.run_tax_collector_batch(args)
+        if Rdb['error'].notna().any():
+            sys.exit(1)
     else:
-        if stb == 'ALL':
-            Tdb['bin'] = 'genome'
-        else:
-            Tdb = tRep.add_bin_to_tdb(Tdb, stb)
-        gdb = tRep.gen_taxonomy_table(Tdb, on='bin')
-        gdb.to_csv(os.path.join(out_base) + '_fullGenomeTaxonomy.tsv', \
-            index=False, sep='\t')
-
-    # Make scaffold level taxonomy
-    if not skip_scaffs:
-        try:
-            sdb = tRep.gen_taxonomy_table(Tdb, on='scaffold')
-            sdb.to_csv(os.path.join(out_base) + '_fullScaffoldTaxonomy.tsv', \
-                index=False, sep='\t')
-        except:
-            print('unable to parse scaffold information- skipping')
+        if (args.get('b6_loc') is None) or (args.get('out_loc') is None):
+            print("-b and -o are required (unless you're running a --manifest)")
+            sys.exit(1)
+        if not tRep.server.forward('tax_collector', args):
+            tRep.controller.run_tax_collector(args)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(\
@@ -59,7 +44,7 @@ if __name__ == "__main__":
         formatter_class=argparse.RawTextHelpFormatter)
 
     InpArgs = parser.add_argument_group('INPUT ARGUMENTS')
-    InpArgs.add_argument('-b', '--b6_loc', help='location of b6+ file', required=True)
+    InpArgs.add_argument('-b', '--b6_loc', help='location of b6+ file')
     InpArgs.add_argument('-stb', '--scaffold2bin',  help=\
         'scaffold to bin file for generating per-genome taxonomy. Pass in the word "ALL" to consider all genes the same genome')
     InpArgs.add_argument('-a', '--amino_acids',  help=\
@@ -67,7 +52,10 @@ if __name__ == "__main__":
 
     OutArgs = parser.add_argument_group('OUTPUT ARGUMENTS')
     OutArgs.add_argument('-o', '--out_loc',  help=\
-        'output basename', required=True)
+        'output basename')
+    OutArgs.add_argument('--output_format',  help=\
+        'format of the output tables; parquet and feather are compressed, much faster to load, '\
+        + 'and need pyarrow installed', default='tsv', choices=tRep.table_io.OUTPUT_FORMATS)
 
     OptArgs = parser.add_argument_group('OPTIONAL ARGUMENTS')
     OptArgs.add_argument('--SkipGenes',  help=\
@@ -80,6 +68,34 @@ if __name__ == "__main__":
     OptArgs.add_argument('--update',  help=\
         "Update the NCBI taxomony before running (takes ~ 5 minutes)",
         action='store_true')
+    OptArgs.add_argument('--max_memory',  help=\
+        "Read the b6 file in chunks, using about this many megabytes (on top of the final table) to parse each one",
+        action='store', type=float, default=None)
+    OptArgs.add_argument('--streaming',  help=\
+        "Only make the scaffold table, a scaffold at a time in one pass over the b6 file, so memory is bounded by the "\
+        + "largest scaffold rather than the whole sample. Needs the hits of each scaffold to be next to each other "\
+        + "(like DIAMOND writes them); can't be used with -stb",
+        action='store_true', default=False)
+    OptArgs.add_argument('--checkpoints',  help=\
+        "Save the parsed hits and gene taxonomy to [out_loc]_checkpoints, and on later runs only redo the stages "\
+        + "whose inputs (file contents, options, tRep and taxonomy database versions) have changed",
+        action='store_true', default=False)
+
+    BatArgs = parser.add_argument_group('BATCH ARGUMENTS')
+    BatArgs.add_argument('--manifest',  help=\
+        'tab-separated file with a header and a row per sample to run (instead of -b / -o). '\
+        + 'Columns are b6_loc and out_loc, and optionally scaffold2bin and amino_acids; '\
+        + 'the other arguments above apply to every sample')
+    BatArgs.add_argument('-p', '--processes',  help=\
+        'number of samples of the manifest to run at once', default=6)
+
+    ProArgs = parser.add_argument_group('PROFILING ARGUMENTS')
+    ProArgs.add_argument('--profile',  help=\
+        'record the wall time, CPU time, peak memory and number of rows of every stage, '\
+        + 'and save them to [out_loc]_profile.json', action='store_true', default=False)
+    ProArgs.add_argument('--profile_stage',  help=\
+        'with --profile, also run this stage under cProfile (saved to [out_loc]_profile_[stage].prof)', \
+        default=None, choices=tRep.controller.PROFILE_STAGES)
 
     args = sys.argv[1:]
     if (len(args) == 0):
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+
+'''
+Run a resident tRep server that tax_collector.py, make_Tdb.py, quickTaxonomy_centrifuge.py
+and functional_tax.py send their runs to (see tRep/server.py)
+'''
+
+import os
+import sys
+import json
+import argparse
+
+import tRep
+import tRep.server
+
+__version__ = tRep.__version__
+
+def main(**args):
+    loc = args.get('socket')
+    if loc is None:
+        loc = tRep.server.get_socket_loc()
+
+    if args.get('stop', False) or args.get('stats', False) or args.get('ping', False):
+        command = 'shutdown' if args.get('stop', False) else ('stats' if args.get('stats', False) else 'ping')
+        reply = tRep.server.call(command, loc)
+        if reply is None:
+            print("No tRep server is running on {0}".format(loc))
+            sys.exit(1)
+        if command == 'stats':
+            print(json.dumps(reply['stats'], indent=2))
+        elif command == 'ping':
+            print("tRep server {0} (pid {1}) is running on {2}".format(reply['version'], reply['pid'], loc))
+        else:
+            print("Stopping the tRep server on {0}".format(loc))
+        return
+
+    tRep.server.serve(loc, threads=int(args.get('threads')), ttables=args.get('ttable') or [])
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a resident tRep server that keeps the taxonomy "\
+        + "database and its caches loaded between runs of the other scripts")
+
+    InpArgs = parser.add_argument_group('SERVER ARGUMENTS')
+    InpArgs.add_argument('-s', '--socket', help=\
+        'location of the server\'s Unix socket (default: $TREP_SERVER_SOCKET, or tRep_server_[uid].sock '\
+        + 'in the temporary directory). The other scripts find it through $TREP_SERVER_SOCKET', default=None)
+    InpArgs.add_argument('-t', '--threads', default=tRep.server.DEFAULT_THREADS, help=\
+        'runs to do at the same time; the rest wait for a free thread')
+    InpArgs.add_argument('--ttable', nargs='*', help=\
+        'translation tables that functional_tax.py will be run with (checks that they\'re indexed)')
+
+    ComArgs = parser.add_argument_group('CONTROLLING A RUNNING SERVER')
+    ComArgs.add_argument('--stop', action='store_true', default=False, help=\
+        'stop the server')
+    ComArgs.add_argument('--stats', action='store_true', default=False, help=\
+        'print the number, errors and latency (mean, max, median and 95th percentile seconds) of the runs of each script')
+    ComArgs.add_argument('--ping', action='store_true', default=False, help=\
+        'check if a server is running')
+
+    # Specify output of "--version"
+    parser.add_argument(
+        "--version",
+        action="version",
+        version="%(prog)s (version {version})".format(version=__version__))
+
+    args = parser.parse_args()
+    main(**vars(args))
@@ -16,7 +16,8 @@ setup(name='taxRep',
       package_data={'tRep': ['VERSION']},
       packages=['tRep'],
       scripts=['bin/quickTaxonomy_centrifuge.py', 'bin/make_Tdb.py',\
-        'bin/tax_collector.py', 'bin/functional_tax.py'],
+        'bin/tax_collector.py', 'bin/functional_tax.py', 'bin/bgzip_ttable.py',\
+        'bin/trep_server.py'],
       install_requires=[
           'pandas',
           'ete3',
@@ -4,30 +4,47 @@
 tRep
 """
 import os
+import re
+import csv
 __author__ = "Matt Olm"
 __version__ = open(os.path.join(os.path.dirname(os.path.realpath(__file__)), \
                 'VERSION')).read().strip()
 __license__ = "MIT"
 
-import glob
-import time
-import shutil
-import argparse
-import tempfile
 import numpy as np
 import pandas as pd
 
 import warnings
 warnings.filterwarnings("ignore")
 
-from Bio import SeqIO
-from ete3 import NCBITaxa
-from collections import defaultdict
-ncbi = NCBITaxa()
+import tRep.lineage
+import tRep.lineage_cache
+import tRep.taxdb
+import tRep.table_io
+import tRep.engine
+import tRep.pipeline
 
-import drep.d_bonus
-import drep.d_filter
-import drep.d_cluster
+# ete3, Biopython and dRep are slow to import and opening the NCBI taxonomy
+# database is slower still, so they are only loaded by the code that needs them
+_ncbi = None
+lineage_index = None
+_engine = None
+
+def get_ncbi():
+    '''
+    Return the NCBITaxa taxonomy handle, opening it the first time it's needed
+    '''
+    global _ncbi
+    if _ncbi is None:
+        from ete3 import NCBITaxa
+        _ncbi = NCBITaxa()
+    return _ncbi
+
+def __getattr__(name):
+    # Keep "tRep.ncbi" working without opening the database at import time
+    if name == 'ncbi':
+        return get_ncbi()
+    raise AttributeError("module 'tRep' has no attribute '{0}'".format(name))
 
 '''
 THIS SECTION IS BASED ON USEARCH
@@ -57,65 +74,237 @@ def type_b6(location):
         print("The database you align against must have taxIDs present. Yours does not. Please see the README for details")
         raise Exception()
 
-def load_b6(location, tax_type='species'):
+# Peak bytes of memory used to parse one byte of a b6 file (measured on the test files)
+B6_MEMORY_PER_BYTE = 4
+
+B6_HEADER = ['querry', 'target', 'percentID', 'alignment_length', 'mm', 'gaps',\
+    'querry_start', 'querry_end', 'target_start', 'target_end', 'e-value', 'bit_score',\
+    'extra']
+
+def load_b6(location, tax_type='species', chunksize=None):
     '''
     return the b6 file as a pandas DataFrame
+
+    chunksize = parse this many lines at a time (None = the whole file at once).
+        Reading in chunks bounds the memory needed on top of the final table;
+        see get_b6_chunksize to pick one from a memory budget
+
+    Only the best e-value hit of every querry / target pair is kept (see iter_b6)
+    '''
+    chunks = list(iter_b6(location, tax_type=tax_type, chunksize=chunksize))
+    Bdb = chunks[0] if len(chunks) == 1 else pd.concat(chunks)
+    del chunks
+    return Bdb
+
+def iter_b6(location, tax_type='species', chunksize=None):
+    '''
+    Yield the parsed b6 file a chunk at a time
+
+    Chunks always end at the end of a query. DIAMOND writes all hits of a query
+    together, so duplicate querry / target pairs are dropped within each chunk
+    (keeping the best e-value) and never make it into memory all at once
     '''
     type = type_b6(location)
+    if type not in ['b6+', 'diamond']:
+        print("I dont know how to parse type {0}".format(type))
+        raise Exception()
+
+    if chunksize is None:
+        yield _drop_duplicate_hits(parse_b6_table(pd.read_csv(location, names=B6_HEADER, sep='\t'), type, tax_type))
+        return
 
+    carry = None
+    with pd.read_csv(location, names=B6_HEADER, sep='\t', chunksize=int(chunksize)) as reader:
+        for chunk in reader:
+            if carry is not None:
+                chunk = pd.concat([carry, chunk])
+
+            # hold back the last query; its hits may continue in the next chunk
+            tail = (chunk['querry'] == chunk['querry'].iloc[-1]).to_numpy()
+            carry = chunk[tail]
+            chunk = chunk[~tail]
+
+            if len(chunk) > 0:
+                yield _drop_duplicate_hits(parse_b6_table(chunk, type, tax_type))
+
+    if carry is not None and len(carry) > 0:
+        yield _drop_duplicate_hits(parse_b6_table(carry, type, tax_type))
+
+def parse_b6_table(Bdb, type, tax_type='species'):
+    '''
+    Add the taxID (and other parsed columns) to a freshly read b6 table
+    '''
     if type == 'b6+':
         '''
         parse the b6+ format, like from Brian
         '''
-        header = ['querry', 'target', 'percentID', 'alignment_length', 'mm', 'gaps',\
-            'querry_start', 'querry_end', 'target_start', 'target_end', 'e-value', 'bit_score',\
-            'extra']
-        Bdb = pd.read_csv(location, names=header, sep='\t')
-        Bdb['annotation'], Bdb['taxID'], Bdb['taxString'] = zip(*Bdb['extra'].map(parse_b6))
-        Bdb['scaffold'] = ['_'.join(x.split('_')[:-1]) for x in Bdb['querry']]
+        parsed = _map_unique(Bdb['extra'], parse_b6_column)
+        for col in ['annotation', 'taxID', 'taxString']:
+            Bdb[col] = parsed[col]
+        Bdb['scaffold'] = _map_unique(Bdb['querry'], lambda q: q.str.rpartition('_')[0])
 
     elif type == 'diamond':
         '''
         parse like this is from the diamond out
         '''
-        header = ['querry', 'target', 'percentID', 'alignment_length', 'mm', 'gaps',\
-            'querry_start', 'querry_end', 'target_start', 'target_end', 'e-value', 'bit_score',\
-            'extra']
-        Bdb = pd.read_csv(location, names=header, sep='\t')
-        Bdb['taxID'] = Bdb['target'].apply(parse_diamond, tax_type=tax_type)
-        Bdb['scaffold'] = ['_'.join(x.split('|')[0].split('_')[:-1]) for x in Bdb['querry']]
+        Bdb['taxID'] = _map_unique(Bdb['target'], parse_diamond_column, tax_type=tax_type)
+        Bdb['scaffold'] = _map_unique(Bdb['querry'], diamond_scaffolds)
 
     else:
         print("I dont know how to parse type {0}".format(type))
         raise Exception()
 
-    if len(Bdb) > 0:
-        Bdb = Bdb.sort_values('e-value').drop_duplicates(subset=['querry', 'target'], keep='first')
     return Bdb
 
+def _drop_duplicate_hits(Bdb):
+    '''
+    Keep the best e-value hit of every querry / target pair, in file order
+    '''
+    if Bdb.duplicated(subset=['querry', 'target']).any():
+        Bdb = Bdb.sort_values('e-value', kind='stable')\
+                .drop_duplicates(subset=['querry', 'target'], keep='first').sort_index()
+    return Bdb
+
+def get_b6_chunksize(location, max_memory):
+    '''
+    Estimate how many lines of a b6 file can be parsed at once using max_memory megabytes
+
+    This is on top of the memory needed to hold the final table
+    '''
+    lengths = []
+    with open(location, 'r') as o:
+        for line in o:
+            lengths.append(len(line))
+            if len(lengths) >= 1000:
+                break
+    bytes_per_line = max(np.mean(lengths), 1) * B6_MEMORY_PER_BYTE if len(lengths) > 0 else 1
+    return max(int((float(max_memory) * 1024 * 1024) / bytes_per_line), 1000)
+
+# A header line (after the first), and its ID (skipping any whitespace after the >)
+FASTA_ID = re.compile(rb'\n>[^\S\n]*(\S*)')
+FASTA_FIRST_ID = re.compile(rb'>[^\S\n]*(\S*)')
+
+# Bytes of a fasta to search at a time
+FASTA_BLOCK = 16 * 1024 * 1024
+
 def parse_prodigal_genes(gene_fasta):
     '''
     Parse the prodigal .fna file
 
-    Return a datatable with gene info and a dictionary of gene -> sequence
+    Return a datatable with the gene and scaffold of every gene
+
+    Only the header lines are read (see get_fasta_ids); the gene is the ID of the
+    record like Biopython gives it (the header up to the first whitespace)
     '''
-    table = defaultdict(list)
     print(gene_fasta)
-    for record in SeqIO.parse(gene_fasta, 'fasta'):
-        gene = str(record.id)
+    genes = pd.Series(get_fasta_ids(gene_fasta))
+    Gdb = pd.DataFrame({'gene':genes, 'scaffold':gene_scaffolds(genes)})
+
+    return Gdb
 
-        table['gene'].append(gene)
-        table['scaffold'].append("_".join(gene.split("_")[:-1]))
-        # table['direction'].append(record.description.split("#")[3].strip())
-        # table['partial'].append('partial=00' not in record.description)
-        #
-        # # NOTE: PRODIGAL USES A 1-BASED INDEX AND WE USE 0, SO CONVERT TO 0 HERE
-        # table['start'].append(int(record.description.split("#")[1].strip())-1)
-        # table['end'].append(int(record.description.split("#")[2].strip())-1)
+def get_fasta_ids(fasta):
+    '''
+    Return the ID of every record of a (possibly gzipped) fasta file, without reading the sequences
 
-    Gdb = pd.DataFrame(table)
+    Plain files are memory-mapped, gzipped ones decompressed, and both are searched
+    for header lines a block at a time
+    '''
+    with open(fasta, 'rb') as f:
+        if f.read(2) == b'\x1f\x8b':
+            import gzip
+            with gzip.open(fasta, 'rb') as g:
+                ids = _read_fasta_ids(g)
+        elif os.path.getsize(fasta) == 0:
+            ids = []
+        else:
+            import mmap
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                ids = _mapped_fasta_ids(data)
 
-    return Gdb
+    return ids
+
+def _mapped_fasta_ids(data):
+    '''
+    The IDs of a memory-mapped fasta file
+
+    Pages that have been searched are let go of as it goes, so the file never
+    all sits in memory
+    '''
+    import mmap
+    first = FASTA_FIRST_ID.match(data)
+    ids = [] if first is None else _decode_ids([first.group(1)])
+
+    start, released = 0, 0
+    while start < len(data):
+        end = data.rfind(b'\n', start, start + FASTA_BLOCK) if start + FASTA_BLOCK < len(data) else len(data)
+        if end <= start:
+            # a line longer than the block
+            end = data.find(b'\n', start + FASTA_BLOCK)
+            end = len(data) if end == -1 else end
+        ids += _decode_ids(FASTA_ID.findall(data, start, end))
+
+        done = (end // mmap.PAGESIZE) * mmap.PAGESIZE
+        if hasattr(data, 'madvise') and done > released:
+            data.madvise(mmap.MADV_DONTNEED, released, done - released)
+            released = done
+        start = end
+    return ids
+
+def _read_fasta_ids(f):
+    '''
+    The IDs of an open fasta file, read a block of whole lines at a time
+    '''
+    ids = []
+    carry = b'\n'
+    while True:
+        block = f.read(FASTA_BLOCK)
+        if not block:
+            break
+        block = carry + block
+        end = block.rfind(b'\n')
+        ids += _decode_ids(FASTA_ID.findall(block, 0, end))
+        carry = block[end:]
+    ids += _decode_ids(FASTA_ID.findall(carry))
+    return ids
+
+def _decode_ids(ids):
+    # decoding them all at once is much faster than one at a time
+    if len(ids) == 0:
+        return []
+    return b'\n'.join(ids).decode().split('\n')
+
+def gene_scaffolds(genes):
+    '''
+    The scaffold of every gene of a column: everything before the last _ (the same as "_".join(gene.split("_")[:-1]))
+    '''
+    if len(genes) == 0:
+        return genes
+    return genes.str.replace(r'(^|_)[^_]*$', '', regex=True)
+
+def diamond_scaffolds(querries):
+    '''
+    The scaffold of every querry of a column of DIAMOND hits; querries that can't be parsed are NaN
+
+    Column-wise version of controller.extract_diamond_scaffold. DIAMOND turns spaces in
+    fasta headers into "|", so the gene is first looked for before the first "|", and
+    then in the whole querry
+    '''
+    scaffolds = pd.Series(np.nan, index=querries.index, dtype=querries.dtype)
+    known = querries.notna().to_numpy()
+    if known.any():
+        scaffolds[known] = _numbered_gene_scaffolds(querries[known].str.partition('|')[0])
+    missing = known & scaffolds.isna().to_numpy()
+    if missing.any():
+        scaffolds[missing] = _numbered_gene_scaffolds(querries[missing])
+    return scaffolds
+
+def _numbered_gene_scaffolds(genes):
+    '''
+    The scaffold of genes named like [scaffold]_[number]; NaN for genes that aren't
+    '''
+    parts = genes.str.rpartition('_')
+    numbered = (parts[1] == '_') & parts[2].str.isnumeric().fillna(False).astype(bool)
+    return parts[0].where(numbered)
 
 def parse_diamond(line, tax_type='species'):
     if tax_type == 'species':
@@ -128,6 +317,75 @@ def parse_diamond(line, tax_type='species'):
         taxID = np.nan
     return taxID
 
+def _map_unique(column, parser, **kwargs):
+    '''
+    Run a column-wise parser on just the unique values of a column, and spread
+    the results back out to every row
+
+    Hits are very repetitive (the same query and target show up over and over),
+    so this does a fraction of the string work
+    '''
+    codes, uniques = pd.factorize(column)
+
+    # the extra NaN on the end is what missing values (code -1) map to
+    uniques = pd.Series(uniques).reindex(range(len(uniques) + 1))
+    if not pd.api.types.is_string_dtype(uniques):
+        uniques = uniques.astype(object)
+    parsed = parser(uniques, **kwargs)
+
+    parsed = parsed.iloc[codes]
+    parsed.index = column.index
+    return parsed
+
+def parse_diamond_column(targets, tax_type='species'):
+    '''
+    parse_diamond for a whole column of targets at once
+    '''
+    if tax_type == 'species':
+        loc = 1
+    elif tax_type == 'group':
+        loc = 2
+    taxIDs = targets.str.split('_').str[loc]
+    return _to_float(taxIDs)
+
+def parse_b6_column(extras):
+    '''
+    parse_b6 for a whole column of b6+ annotation strings at once
+
+    Returns a DataFrame with the columns annotation, taxID and taxString
+    '''
+    db = pd.DataFrame(index=extras.index)
+    db['annotation'] = extras.str.partition(';')[0].str.strip()
+
+    # the first ;-separated word starting with TaxID, up to the first whitespace
+    taxIDs = extras.str.extract(r'(?:^|;)\s*(TaxID[^\s;]*)', expand=False)
+    taxIDs = taxIDs.str.replace('TaxID=', '', regex=False)
+    db['taxID'] = _to_float(taxIDs)
+
+    # whatever comes after the first quote, up to the next one
+    db['taxString'] = extras.str.extract(r'^[^"]*"([^"]*)', expand=False)\
+                        .fillna(';'.join(['NA'] * 7))
+
+    return db
+
+def _to_float(values):
+    '''
+    Convert a column of strings to floats, with NaN wherever float() would fail
+    '''
+    floats = pd.to_numeric(values, errors='coerce').astype(float)
+
+    # to_numeric is a bit stricter than float() (it won't take "1_000", for example)
+    retry = (floats.isna() & values.notna()).to_numpy()
+    if retry.any():
+        floats[retry] = [_float_or_nan(x) for x in values[retry]]
+    return floats
+
+def _float_or_nan(x):
+    try:
+        return float(x)
+    except:
+        return np.nan
+
 def parse_b6(line):
     '''
     return a parsed list from a b6+ annotation string:
@@ -154,94 +412,192 @@ def parse_b6(line):
 
     return annotation, taxID, taxString
 
-def gen_levels_db(hits):
+def get_lineage_index():
     '''
-    from a list of taxIDs, return a DataFrame deliniating their taxonomies
+    Return the LineageIndex of the NCBI taxonomy, building it the first time
     '''
-    Levels = ['superkingdom','phylum','class','order','family','genus','species']
+    global lineage_index
+    if lineage_index is None:
+        lineage_index = tRep.lineage.LineageIndex.from_taxdb(get_taxdb())
+    return lineage_index
 
-    # start the spinner
-    # spinner = Halo(text='Parsing taxIDs', spinner='dots')
-    # spinner.start()
-    print("parsing taxIDs...")
+def get_engine():
+    '''
+    Return the TaxonomyEngine that the functions of this module share (see tRep/engine.py)
+    '''
+    global _engine
+    if _engine is None:
+        _engine = tRep.engine.TaxonomyEngine()
+    return _engine
 
-    # set up the database
-    table = {'taxID':[]}
-    for level in Levels:
-        table[level] = []
+def get_taxdb():
+    '''
+    Return this process's read-only connection to the NCBI taxonomy database (see tRep/taxdb.py)
+    '''
+    loc = get_taxdb_loc()
+    if not os.path.isfile(loc):
+        # ete3 downloads and builds the database the first time it's used
+        loc = get_ncbi().dbfile
+    return tRep.taxdb.get_taxdb(loc)
+
+def get_taxdb_loc():
+    '''
+    Return the location of ete3's NCBI taxonomy database (without opening it)
+    '''
+    if _ncbi is not None:
+        return _ncbi.dbfile
+    return os.path.join(os.environ.get('HOME', '/'), '.etetoolkit', 'taxa.sqlite')
 
-    # fill in nested dictionary
-    for t in hits:
-        if t == 0:
-            continue
+# With fewer missing lineages than this, ask ete3 for each rather than building the LineageIndex
+INDEX_MIN_MISSES = 500
 
-        try:
-            lin = ncbi.get_lineage(t)
-        except:
-            continue
+def get_lineages(taxids):
+    '''
+    Return the ranked part of the lineage of every taxID (see LineageIndex.lineage_entries)
+
+    Lineages come from the on-disk lineage cache when they can; the rest are
+    resolved and added to it
+    '''
+    keys = [_lineage_key(t) for t in taxids]
+    unique = sorted(set([k for k in keys if k is not None]))
 
-        lin2name  = ncbi.get_taxid_translator(lin)
-        name2rank = ncbi.get_rank(lin)
-        rank2name = {v: k for k, v in name2rank.items()}
+    cache = tRep.lineage_cache.get_cache(get_taxdb_loc())
+    found = cache.get(unique) if cache is not None else {}
 
-        for level in Levels:
-            if level in rank2name:
-                table[level].append(lin2name[rank2name[level]])
-            else:
-                table[level].append('unk')
-        table['taxID'].append(t)
+    missing = [k for k in unique if k not in found]
+    if len(missing) > 0:
+        if (lineage_index is not None) or (len(missing) >= INDEX_MIN_MISSES):
+            new = dict(zip(missing, get_lineage_index().lineage_entries(missing)))
+        else:
+            taxdb = get_taxdb()
+            new = {k:_taxdb_lineage_entry(taxdb, k) for k in missing}
+        if cache is not None:
+            cache.put(new)
+        found.update(new)
 
-    # spinner.stop()
+    return [found[k] if k is not None else None for k in keys]
+
+def _lineage_key(t):
+    try:
+        t = float(t)
+    except (TypeError, ValueError):
+        return None
+    if (not np.isfinite(t)) or (t < 1) or (not t.is_integer()):
+        return None
+    return int(t)
+
+def _taxdb_lineage_entry(taxdb, t):
+    '''
+    LineageIndex.lineage_entries for one taxID, asking the taxonomy database
+    '''
+    try:
+        lin = taxdb.lineage(t)
+    except ValueError:
+        # taxID not found
+        return None
+
+    lin2name  = taxdb.names(lin)
+    name2rank = taxdb.ranks(lin)
+    Levels = get_levels()
+    return [[int(i), Levels.index(name2rank[i]), lin2name[i]] for i in lin \
+                if name2rank.get(i) in Levels]
+
+def _format_taxid(t):
+    key = _lineage_key(t)
+    return t if key is None else key
+
+def _entry_rank2name(entry):
+    '''
+    rank -> name for a lineage entry; like ete3's rank2name, the higher taxID
+    wins if there are two nodes at one rank
+    '''
+    Levels = get_levels()
+    rank2node = {}
+    for node, rank, name in entry:
+        if node > rank2node.get(rank, (0, None))[0]:
+            rank2node[rank] = (node, name)
+    return {Levels[rank]:name for rank, (node, name) in rank2node.items()}
 
-    return pd.DataFrame(table)
+def gen_levels_db(hits):
+    '''
+    from a list of taxIDs, return a DataFrame deliniating their taxonomies
+    '''
+    return get_engine().levels_db(hits)
 
 def get_levels():
     return ['superkingdom','phylum','class','order','family','genus','species']
 
+def compact_tdb(Tdb):
+    '''
+    Store the rank columns of Tdb as categoricals that share one dictionary of
+    taxon names, and the scaffold column as a categorical
+
+    Every gene repeats the names in its lineage, so this takes a fraction of the
+    memory of a column of strings. Names are only decoded when a table is written
+    '''
+    Levels = get_levels()
+    names = pd.unique(pd.concat([Tdb[level] for level in Levels]).dropna())
+    dtype = pd.CategoricalDtype(sorted(names))
+    for level in Levels:
+        Tdb[level] = Tdb[level].astype(dtype)
+
+    if 'scaffold' in Tdb.columns:
+        Tdb['scaffold'] = Tdb['scaffold'].astype('category')
+    return Tdb
+
 def gen_taxonomy_table(Idb, on='scaffold', minPerc=50):
     '''
     From a dataframe with all of the levels present, calculate percentages
+
+    Idb can also be the location of a saved Tdb (in any format tRep.table_io can load)
     '''
-    Levels = ['superkingdom','phylum','class','order','family','genus','species']
+    return get_engine().classify_tdb(Idb, on=on, minPerc=minPerc)
 
-    # # start the spinner
-    # spinner = Halo(text='Generating taxonomy table', spinner='dots')
-    # spinner.start()
-    print("Generating taxonomy table...")
+def _group_winners(groups, num_groups, values):
+    '''
+    For every group, find the most common non-null value and the percent of the
+    group's non-null values that it makes up
 
-    # set up Sdb
-    table = {}
-    for level in Levels:
-        table[level + '_winner'] = []
-        table[level + '_percent'] = []
-    table[on] = []
-
-    # make Sdb
-    for thing, db in Idb.groupby(on):
-        table[on].append(thing)
-        for level in Levels:
-            vcounts = dict(db[level].value_counts())
-            try:
-                winner = max(vcounts, key=vcounts.get)
-            except:
-                table[level + '_winner'].append('unk')
-                table[level + '_percent'].append(100)
-                continue
-
-            total = sum(vcounts.values())
-            count = vcounts[winner]
-            table[level + '_winner'].append(winner)
-            table[level + '_percent'].append(((count/total) *100))
-    Sdb = pd.DataFrame(table)
-
-    # add taxonomy
-    Sdb['minPerc'] = int(minPerc)
-    Sdb['full_taxonomy'] = Sdb.apply(calculate_full_taxonmy, axis=1)
-    Sdb['taxonomy'] = Sdb['full_taxonomy'].map(get_simple_tax)
-    del Sdb['minPerc']
-
-    # spinner.stop()
-    return Sdb
+    groups = integer group code of every row (-1 to leave the row out)
+
+    Ties go to the value that shows up first in the group, like value_counts().
+    Groups with no values at all get a winner of 'unk' at 100 percent.
+    '''
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        # already integer-coded (see compact_tdb)
+        codes, uniques = values.cat.codes.to_numpy(), values.cat.categories
+    else:
+        codes, uniques = pd.factorize(values)
+    keep = (groups >= 0) & (codes >= 0)
+    g = groups[keep].astype(np.int64)
+
+    # count every (group, value) pair and remember where it first shows up
+    pairs, first, counts = np.unique(g * len(uniques) + codes[keep], \
+                                return_index=True, return_counts=True)
+    pair_group = pairs // max(len(uniques), 1)
+    pair_value = pairs % max(len(uniques), 1)
+
+    # the pairs of a group sit next to each other; the winner of each group is
+    # the pair with the most counts, and then the earliest first appearance
+    if len(pairs) > 0:
+        score = counts * (len(g) + 1) - first
+        starts = np.flatnonzero(np.r_[True, pair_group[1:] != pair_group[:-1]])
+        top = np.maximum.reduceat(score, starts)
+        best = np.flatnonzero(score == np.repeat(top, np.diff(np.r_[starts, len(pairs)])))
+    else:
+        best = np.zeros(0, dtype=np.int64)
+    total = np.bincount(g, minlength=num_groups)
+
+    winners = np.full(num_groups, 'unk', dtype=object)
+    winners[pair_group[best]] = np.asarray(uniques, dtype=object)[pair_value[best]]
+
+    if len(best) == 0:
+        percents = np.full(num_groups, 100, dtype=np.int64)
+    else:
+        percents = np.full(num_groups, 100, dtype=float)
+        percents[pair_group[best]] = (counts[best] / total[pair_group[best]]) * 100
+
+    return winners, percents
 
 def get_simple_tax(full_taxonomy):
     '''
@@ -253,6 +609,36 @@ def get_simple_tax(full_taxonomy):
             return t
     return 'unk'
 
+def calculate_full_taxonomies(Sdb, minPerc=50):
+    '''
+    calculate the consensus taxonomy of every row of Sdb at once
+
+    Column-wise version of calculate_full_taxonmy and get_simple_tax; returns
+    arrays of the full taxonomy string and the simple taxonomy
+    '''
+    Levels = ['superkingdom','phylum','class','order','family','genus','species']
+
+    # once a level is below minPerc, it and every level below it is unknown
+    skip = np.zeros(len(Sdb), dtype=bool)
+    names = []
+    for l in Levels:
+        skip |= Sdb[l + '_percent'].to_numpy(dtype=float).astype(np.int64) < int(minPerc)
+        names.append(np.where(skip, 'unk', Sdb[l + '_winner'].to_numpy(dtype=object)))
+
+    full_taxonomy = names[0]
+    for name in names[1:]:
+        full_taxonomy = full_taxonomy + '|' + name
+
+    # the simple taxonomy is the lowest known level
+    taxonomy = np.full(len(Sdb), 'unk', dtype=object)
+    found = np.zeros(len(Sdb), dtype=bool)
+    for name in reversed(names):
+        take = ~found & (name != 'unk')
+        taxonomy[take] = name[take]
+        found |= take
+
+    return full_taxonomy, taxonomy
+
 def calculate_full_taxonmy(row):
     '''
     calculate consensus taxonomy based on a row of Sdb
@@ -272,34 +658,72 @@ def calculate_full_taxonmy(row):
 def add_bin_to_tdb(tdb, s2b):
     '''
     Add the 'bin' column to tdb based off of an stb file
+
+    tdb can also be the location of a saved Tdb (in any format tRep.table_io can load)
+    s2b can be the location of an stb file, a dictionary of scaffold -> bin, or a table from load_stb_table
+
+    The bin column is a categorical (with sorted categories, if the bins can be sorted with 'unk'). Scaffolds are matched
+    to bins once per distinct scaffold, and every gene gets its bin by integer code
     '''
-    if type(s2b) == dict:
-        pass
+    if isinstance(tdb, str):
+        tdb = tRep.table_io.load_tdb(tdb)
+
+    if isinstance(s2b, pd.DataFrame):
+        stb = s2b
+    elif type(s2b) == dict:
+        stb = pd.DataFrame({'scaffold':list(s2b.keys()), 'bin':list(s2b.values())})
+        stb['bin'] = stb['bin'].astype('category')
     else:
-        s2b = load_stb(s2b)
+        stb = load_stb_table(s2b)
 
     # Throw a warning
-    problems = [s for s, b in s2b.items() if '|' in s]
-    if len(problems) > 0:
+    problems = stb['scaffold'].str.contains('|', regex=False).to_numpy() if len(stb) > 0 else np.zeros(0, dtype=bool)
+    if problems.any():
+        first = np.flatnonzero(problems)[0]
         message = "Hey bucko! You really shouldnt have | characters in your fasta IDs!"
-        message += " There are {0} scaffolds in the stb that have them".format(len(problems))
-        message += " (example - {0} in bin {1}).".format(problems[0], s2b[problems[0]])
+        message += " There are {0} scaffolds in the stb that have them".format(problems.sum())
+        message += " (example - {0} in bin {1}).".format(stb['scaffold'].iloc[first], stb['bin'].iloc[first])
         message += " I will try and handle this (and yell more if I cant), but if you see problems"
         message += " this is likely the issue"
         print(message)
 
-    # Add the bin to Tdb
-    tdb['bin'] = tdb['scaffold'].map(s2b)
-    tdb['bin'] = tdb['bin'].fillna('unk')
+    # Add the bin to Tdb; bins that aren't in the stb are 'unk'
+    bins = stb['bin'].astype('category')
+    categories = bins.cat.categories
+    if 'unk' not in categories:
+        categories = categories.astype(object).append(pd.Index(['unk'], dtype=object))
+    try:
+        categories = categories.sort_values()
+    except TypeError:
+        # bins that can't be sorted with 'unk' (like numbers) keep their order, with 'unk' last
+        pass
+    unk = categories.get_loc('unk')
+    recode = categories.get_indexer(bins.cat.categories)
+
+    # look up the bin of every distinct scaffold, then hand them out by code
+    if isinstance(tdb['scaffold'].dtype, pd.CategoricalDtype):
+        codes, scaffolds = tdb['scaffold'].cat.codes.to_numpy(), tdb['scaffold'].cat.categories
+    else:
+        codes, scaffolds = pd.factorize(tdb['scaffold'])
+    found = pd.merge(pd.DataFrame({'scaffold':scaffolds}), \
+                     pd.DataFrame({'scaffold':stb['scaffold'], 'bin':bins.cat.codes}), how='left', on='scaffold')['bin']
+    found = found.fillna(-1).to_numpy(dtype=np.int64)
+    # the unk on the end is for genes without a scaffold (code -1)
+    scaffold_bins = np.append(np.where(found >= 0, recode[found], unk), unk)
+    bin = scaffold_bins.astype(np.min_scalar_type(-len(categories)))[codes]
+    tdb['bin'] = pd.Categorical.from_codes(bin, categories=categories)
 
     # Make sure at least some scaffolds map
-    assert len(tdb[tdb['bin'] == 'unk']) != len(tdb), \
+    assert (bin == unk).sum() != len(tdb), \
         "No scaffolds in the stb map to a bin"
-    assert len(tdb[tdb['bin'] != tdb['bin']]) == 0
+    assert (bin < 0).sum() == 0
 
     return tdb
 
 def load_stb(file):
+    '''
+    Load an stb file as a dictionary of scaffold -> bin (see load_stb_table for a table)
+    '''
     stb = {}
     with open(file,'r') as ins:
         for line in ins:
@@ -310,11 +734,38 @@ def load_stb(file):
             stb[scaffold] = b
     return stb
 
+def load_stb_table(file):
+    '''
+    Load an stb file (scaffold<tab>bin on every line) as a table with the columns scaffold and bin
+
+    The bin column is a categorical with sorted categories. Like load_stb, a header
+    line starting with scaffold_name is skipped, and if a scaffold is listed more
+    than once the last bin is kept
+    '''
+    stb = pd.read_csv(file, sep='\t', header=None, usecols=[0, 1], names=['scaffold', 'bin'], dtype=str, \
+                      na_filter=False, quoting=csv.QUOTE_NONE)
+    # load_stb strips the whitespace off of the ends of each line
+    stb['scaffold'] = stb['scaffold'].str.lstrip()
+    stb['bin'] = stb['bin'].str.rstrip()
+    stb = stb[(stb['scaffold'] != '') & ~stb['scaffold'].str.startswith('scaffold_name')]
+    if (stb['bin'] == '').any():
+        print("These lines of {0} don't have a bin: {1}".format(file, stb['scaffold'][stb['bin'] == ''].tolist()[:5]))
+        raise Exception()
+
+    stb = stb.drop_duplicates(subset=['scaffold'], keep='last').reset_index(drop=True)
+    # inferred categories come out sorted
+    stb['bin'] = stb['bin'].astype('category')
+    return stb
+
 ###############################################################################
 '''
 THIS SECTION IS BASED ON CENTRIFUGE
 '''
 
+# The columns of centrifuge hits files that tRep reads, and the lines read at once
+CENTRIFUGE_COLUMNS = ['readID', 'taxID', 'score', '2ndBestScore']
+CENTRIFUGE_CHUNKSIZE = 1000000
+
 def main(**kwargs):
     """ Main entry point of the app """
     cent_hit = kwargs.get('cent_hit')
@@ -323,60 +774,150 @@ def main(**kwargs):
 
     if (cent_hit != None) and (cent_report != None):
         print('determining taxonomy from raw centrifuge')
-        from_raw_centrifuge(cent_hit, cent_report, **kwargs)
+        tax = from_raw_centrifuge(cent_hit, cent_report, **kwargs)
+        if tax is not None:
+            print(tax)
 
     elif fasta != None:
-        print('determining taxonomy from .fasta file')
-        from_fasta(fasta, **kwargs)
+        if isinstance(fasta, str):
+            fasta = [fasta]
+        if (len(fasta) == 1) and (not os.path.isdir(fasta[0])):
+            print('determining taxonomy from .fasta file')
+            tax = from_fasta(fasta[0], **kwargs)
+            if tax is not None:
+                print(tax)
+        else:
+            if kwargs.get('full_dump') != None:
+                print("--full_dump only works with one .fasta file")
+                raise Exception()
+            fastas = tRep.pipeline.get_fastas(fasta)
+            print('determining taxonomy from {0} .fasta files'.format(len(fastas)))
+            tRep.pipeline.run_fastas(fastas, **kwargs)
 
 def from_fasta(fasta, **kwargs):
-    dirpath = tempfile.mkdtemp() + '/'
-
-    bdb = pd.DataFrame({'location':[fasta], 'genome':[os.path.basename(fasta)]})
-    print('running prodigal')
-    drep.d_filter.run_prodigal(bdb, dirpath)
-    print('running centrifuge')
-    drep.d_bonus.run_centrifuge(bdb, dirpath, dirpath, cent_index=kwargs['cent_index'])
+    '''
+    Return the taxonomy of one genome, from prodigal and centrifuge run in a temporary directory
 
-    hits, report = glob.glob(dirpath + os.path.basename(fasta) + '*.tsv')
-    from_raw_centrifuge(hits, report, **kwargs)
+    See tRep/pipeline.py for lots of genomes
+    '''
+    for fasta, tax, error in tRep.pipeline.classify_fastas([fasta], **kwargs):
+        if error is not None:
+            print(error)
+            raise Exception()
+        return tax
 
 def from_raw_centrifuge(hits, report, **kwargs):
     '''
     Return the taxonomy based on raw centrifuge output
-    '''
-    Tdb = drep.d_bonus.parse_raw_centrifuge(hits, report)
-    Tdb = filter_hits(Tdb, **kwargs)
-    from_tdb(Tdb, **kwargs)
 
-def filter_hits(Tdb, **kwargs):
+    The hits are read a chunk at a time (see iter_centrifuge_hits). The percent method
+    and full_dump only need the number of hits to each taxID, so that's all that's kept
+    '''
     min_score = int(kwargs.get('min_score', 250))
     min_diff = int(kwargs.get('min_diff', 0))
+    chunksize = kwargs.get('chunksize', CENTRIFUGE_CHUNKSIZE)
+
+    if (kwargs.get('full_dump') != None) or (kwargs.get('method') == 'percent'):
+        above = None if kwargs.get('full_dump') != None else 250
+        counts = count_centrifuge_taxids(hits, min_score=min_score, min_diff=min_diff, above=above, \
+                                         chunksize=chunksize)
+        return from_taxid_counts(counts, **kwargs)
+
+    Tdb = load_centrifuge_hits(hits, report, min_score=min_score, min_diff=min_diff, chunksize=chunksize)
+    return from_tdb(Tdb, **kwargs)
+
+def iter_centrifuge_hits(hits, min_score=250, min_diff=0, chunksize=CENTRIFUGE_CHUNKSIZE, \
+                        columns=CENTRIFUGE_COLUMNS):
+    '''
+    Yield the hits of a centrifuge hits file that pass min_score and min_diff, a chunk at a time
+
+    Only columns are read; score and 2ndBestScore are always read to filter on
+    '''
+    usecols = list(dict.fromkeys(list(columns) + ['score', '2ndBestScore']))
+    with pd.read_csv(hits, sep='\t', usecols=usecols, dtype={'readID':str}, chunksize=int(chunksize)) as reader:
+        for chunk in reader:
+            keep = _keep_hits(chunk['score'].to_numpy(), chunk['2ndBestScore'].to_numpy(), min_score, min_diff)
+            yield chunk.loc[keep, list(columns)]
 
-    Tdb['diff'] = [x - y for x, y in zip(Tdb['score'], Tdb['2ndBestScore'])]
+def count_centrifuge_taxids(hits, min_score=250, min_diff=0, above=None, chunksize=CENTRIFUGE_CHUNKSIZE):
+    '''
+    Return the number of hits to each taxID (a Series, in order of first appearance) of a centrifuge hits file
 
-    Tdb = Tdb[Tdb['score'] >= min_score]
-    Tdb = Tdb[Tdb['diff'] >= min_diff]
+    above = only count hits with a score above this
+    '''
+    counts = {}
+    columns = ['taxID'] if above is None else ['taxID', 'score']
+    for chunk in iter_centrifuge_hits(hits, min_score=min_score, min_diff=min_diff, chunksize=chunksize, \
+                                      columns=columns):
+        taxids = chunk['taxID'].to_numpy()
+        if above is not None:
+            taxids = taxids[chunk['score'].to_numpy() > above]
+        codes, uniques = pd.factorize(taxids)
+        for t, c in zip(uniques.tolist(), np.bincount(codes, minlength=len(uniques)).tolist()):
+            counts[t] = counts.get(t, 0) + c
+    return pd.Series(counts, index=list(counts.keys()), dtype=np.int64)
+
+def load_centrifuge_hits(hits, report, min_score=250, min_diff=0, chunksize=CENTRIFUGE_CHUNKSIZE):
+    '''
+    Return the hits of a centrifuge hits file that pass min_score and min_diff, with the
+    level and name of their taxID from the centrifuge report (the columns the max method needs)
+    '''
+    tax = pd.read_csv(report, sep='\t', usecols=['name', 'taxID', 'taxRank'])
+    tax = tax.drop_duplicates(subset=['taxID'], keep='last').set_index('taxID')
 
+    chunks = list(iter_centrifuge_hits(hits, min_score=min_score, min_diff=min_diff, chunksize=chunksize, \
+                                       columns=['readID', 'taxID', 'score']))
+    Tdb = chunks[0] if len(chunks) == 1 else pd.concat(chunks)
+    del chunks
+
+    Tdb = Tdb.rename(columns={'readID':'gene'})
+    Tdb['level'] = Tdb['taxID'].map(tax['taxRank'])
+    Tdb['name'] = Tdb['taxID'].map(tax['name'])
     return Tdb
 
+def filter_hits(Tdb, **kwargs):
+    min_score = int(kwargs.get('min_score', 250))
+    min_diff = int(kwargs.get('min_diff', 0))
+
+    Tdb['diff'] = Tdb['score'] - Tdb['2ndBestScore']
+    return Tdb[_keep_hits(Tdb['score'].to_numpy(), Tdb['2ndBestScore'].to_numpy(), min_score, min_diff)]
+
+def _keep_hits(score, second, min_score, min_diff):
+    return (score >= min_score) & ((score - second) >= min_diff)
+
 def from_tdb(Tdb, **kwargs):
+    '''
+    Return the taxonomy string of the hits of Tdb (None with full_dump, which is saved instead)
+    '''
     if kwargs.get('full_dump') != None:
         tdb = gen_full_tdb(Tdb)
         tdb.to_csv(kwargs.get('full_dump'), index=False)
 
     elif kwargs.get('method') == 'percent':
-        tax = gen_taxonomy_string(Tdb['hit'][Tdb['score'] > 250], minPerc= int(\
-            kwargs['percent']).to_list())
-        print(tax)
+        tax = gen_taxonomy_string(Tdb['taxID'][Tdb['score'] > 250].tolist(), minPerc= int(\
+            kwargs['percent']))
+        return tax
 
     elif kwargs.get('method') == 'max':
+        import drep.d_bonus
         x = drep.d_bonus.gen_phylo_db(Tdb)
         taxID = x['tax_ID'][x['tax_confidence'] == x['tax_confidence'].max()].tolist()[0]
         tax = lineage_from_taxId(taxID)
-        print(tax)
+        return tax
+
+def from_taxid_counts(counts, **kwargs):
+    '''
+    Like from_tdb, from the number of hits to each taxID (see count_centrifuge_taxids)
+    '''
+    if kwargs.get('full_dump') != None:
+        tdb = gen_full_tdb(pd.DataFrame({'taxID':counts.index}), weights=counts.to_numpy())
+        tdb.to_csv(kwargs.get('full_dump'), index=False)
 
-def gen_taxonomy_string(hits, minPerc= 50, testing=False):
+    elif kwargs.get('method') == 'percent':
+        return gen_taxonomy_string(counts.index.tolist(), minPerc=int(kwargs['percent']), \
+                                   weights=counts.to_numpy())
+
+def gen_taxonomy_string(hits, minPerc= 50, testing=False, weights=None):
     '''
     Determines the lowest taxonomic level with at least minPerc certainty
 
@@ -394,148 +935,27 @@ def gen_taxonomy_string(hits, minPerc= 50, testing=False):
         For example, species [Eubacterium] rectale (taxID 39491) has no genus
         Also, species [artifical construct] (taxID 32630) has no anything but species
 
+    weights = the number of hits each of hits stands for (default: one each)
     '''
-    Levels = ['superkingdom','phylum','class','order','family','genus','species']
-
-    # generate nested dictionary for levels
-    countDic = {}
-    for level in Levels:
-        countDic[level] = {}
-
-    # fill in nested dictionary
-    for t in hits:
-        if t == 0:
-            continue
-
-        try:
-            lin = ncbi.get_lineage(t)
-        except:
-            continue
-
-        lin2name  = ncbi.get_taxid_translator(lin)
-        name2rank = ncbi.get_rank(lin)
-
-        for i in lin:
-            rank = name2rank[i]
-            name = lin2name[i]
-            if rank in countDic:
-                countDic[rank][i] = countDic[rank].get(i,0) + 1
-
-    # make the taxonomy string
-    WinningName = None
-
-    # figure out the total number of hits
-    total = sum(countDic['phylum'].values())
-
-    # find the lowest rank winner
-    winner = False
-
-    Levels.reverse()
-    for level in Levels:
-        if winner != False:
-            break
-        dic = countDic[level]
-        for name in sorted(dic, key=dic.get, reverse= True):
-            count = dic[name]
-            if ((count/total) *100) > minPerc:
-                winner = name
-            break
-
-    # return the whole taxonomy string
-    name = []
-
-    lin = ncbi.get_lineage(winner)
-
-    lin2name  = ncbi.get_taxid_translator(lin)
-    name2rank = ncbi.get_rank(lin)
-    rank2name = {v: k for k, v in name2rank.items()}
-
-    Levels.reverse()
-    for level in Levels:
-        if level in rank2name:
-            name.append(lin2name[rank2name[level]])
-        else:
-            name.append('unk')
-
-    if testing:
-        return '|'.join([str(winner)] + name), countDic
-    else:
-        return '|'.join([str(winner)] + name)
+    return get_engine().taxonomy_string(hits, minPerc=minPerc, testing=testing, weights=weights)
 
-def gen_full_tdb(hits):
+def _invalid_taxids(hits):
     '''
-    Report all hits to all taxonomic levels
+    Return the positions of hits that can't be taxIDs at all (like 0 and NaN)
     '''
+    values = _taxid_values(hits)
+    return np.flatnonzero(~(np.isfinite(values) & (values >= 1))).tolist()
 
-    from ete3 import NCBITaxa
-    ncbi = NCBITaxa()
-
-    Levels = ['superkingdom','phylum','class','order','family','genus','species']
-
-    # generate nested dictionary for levels
-    countDic = {}
-    for level in Levels:
-        countDic[level] = {}
-
-    # fill in nested dictionary
-    for t in hits['taxID'].tolist():
-        if t == 0:
-            continue
-
-        # This try / except thing is trying to catch sporatic errors of:
-        # sqlite3.OperationalError: disk I/O error
-        try:
-            lin = ncbi.get_lineage(t)
-            lin2name  = ncbi.get_taxid_translator(lin)
-            name2rank = ncbi.get_rank(lin)
-        except:
-            time.sleep(1)
-            lin = ncbi.get_lineage(t)
-            lin2name  = ncbi.get_taxid_translator(lin)
-            name2rank = ncbi.get_rank(lin)
-
-        printed=False
-        for j, i in enumerate(lin[::-1]):
-            rank = name2rank[i]
-            name = lin2name[i]
-
-            if rank in countDic:
-                if printed == False:
-                    #print(rank)
-                    printed=True
-
-                countDic[rank][name] = countDic[rank].get(name,0) + 1
-
-    # make the table
-    total = sum(countDic['phylum'].values())
-    table = {'tax_confidence':[], 'tax_level':[], 'taxonomy':[]}
-
-    for level in Levels:
-        dic = countDic[level]
-        for name in sorted(dic, key=dic.get, reverse= True):
-            count = dic[name]
+def _taxid_values(hits):
+    return pd.to_numeric(pd.Series(list(hits), dtype=object), errors='coerce').to_numpy(dtype=float)
 
-            table['tax_confidence'].append(((count/total) *100))
-            table['tax_level'].append(level)
-            table['taxonomy'].append(name)
+def gen_full_tdb(hits, weights=None):
+    '''
+    Report all hits to all taxonomic levels
 
-    tdb = pd.DataFrame(table)
-    return tdb
+    weights = the number of hits each of hits stands for (default: one each)
+    '''
+    return get_engine().full_tdb(hits, weights=weights)
 
 def lineage_from_taxId(t):
-    Levels = ['superkingdom','phylum','class','order','family','genus','species']
-    name = []
-
-    lin = ncbi.get_lineage(t)
-
-    lin2name  = ncbi.get_taxid_translator(lin)
-    name2rank = ncbi.get_rank(lin)
-    rank2name = {v: k for k, v in name2rank.items()}
-
-    for level in Levels:
-        if level in rank2name:
-            name.append(lin2name[rank2name[level]])
-        else:
-            name.append('unk')
-
-    return '|'.join([str(int(t))] + name)
+    return get_engine().lineage_string(t)
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+
+'''
+Checkpoints of the stages of tax_collector.py, so a rerun only redoes what changed
+
+Every stage is keyed by a hash of everything it depends on: the contents of its
+input files, the options that change its result, the key of the stage before it,
+the tRep version and (for stages that look up lineages) the version of the
+taxonomy database. A stage whose key matches its checkpoint is skipped:
+
+- hits: the parsed b6 file
+- Tdb: the hits with their lineages (and the genes without hits)
+- the gene, genome and scaffold tables: skipped if the output file is still the
+  one that was written with this key
+
+So rerunning with a new .stb only re-bins the saved Tdb and remakes the genome table
+
+Checkpoints are kept in a directory with a checkpoints.json listing what each
+one was made from. Files are written under a temporary name and renamed into
+place, and checkpoints.json is only updated after, so a run that dies half-way
+through writing never leaves a checkpoint that looks finished
+'''
+
+import os
+import json
+import time
+import hashlib
+
+import pandas as pd
+
+# Bytes read at a time while hashing a file
+HASH_CHUNK = 4 * 1024 * 1024
+
+def get_checkpoint_dir(out_base):
+    return out_base + '_checkpoints'
+
+def file_fingerprint(loc):
+    stat = os.stat(loc)
+    return [stat.st_size, stat.st_mtime_ns]
+
+def hash_file(loc):
+    h = hashlib.blake2b(digest_size=16)
+    with open(loc, 'rb') as f:
+        while True:
+            data = f.read(HASH_CHUNK)
+            if not data:
+                break
+            h.update(data)
+    return h.hexdigest()
+
+def make_key(*parts):
+    '''
+    Hash anything that can be written as JSON into a key
+    '''
+    return hashlib.blake2b(json.dumps(parts, sort_keys=True).encode('utf-8'), digest_size=16).hexdigest()
+
+class Checkpoints():
+    '''
+    A directory of stage checkpoints
+    '''
+    def __init__(self, loc):
+        self.loc = loc
+        self.state_loc = os.path.join(loc, 'checkpoints.json')
+        os.makedirs(loc, exist_ok=True)
+
+        self.state = {'stages':{}, 'files':{}}
+        if os.path.isfile(self.state_loc):
+            try:
+                with open(self.state_loc) as f:
+                    self.state = json.load(f)
+            except ValueError:
+                print("Ignoring the unreadable checkpoint list {0}".format(self.state_loc))
+
+    def file_hash(self, loc):
+        '''
+        Return a hash of the contents of a file (None for None)
+
+        Hashes are remembered with the size and modification time of the file,
+        so an unchanged file is only read the first time
+        '''
+        if loc is None:
+            return None
+        real = os.path.realpath(loc)
+        known = self.state['files'].get(real)
+        if (known is not None) and (known['fingerprint'] == file_fingerprint(real)):
+            return known['hash']
+
+        h = hash_file(real)
+        self.state['files'][real] = {'fingerprint':file_fingerprint(real), 'hash':h}
+        self._save_state()
+        return h
+
+    def cached(self, stage, key, function):
+        '''
+        Return the DataFrame checkpointed for this stage and key, or run function() to make
+        (and checkpoint) it
+        '''
+        db = self.load(stage, key)
+        if db is not None:
+            print("Reusing the {0} checkpoint in {1}".format(stage, self.loc))
+            return db
+
+        db = function()
+        self.save(stage, key, db)
+        return db
+
+    def load(self, stage, key):
+        entry = self.state['stages'].get(stage)
+        if (entry is None) or (entry['key'] != key) or ('data' not in entry):
+            return None
+        loc = os.path.join(self.loc, entry['data'])
+        if not os.path.isfile(loc):
+            return None
+        try:
+            return pd.read_pickle(loc)
+        except Exception as e:
+            print("Unable to read the {0} checkpoint ({1}); remaking it".format(stage, e))
+            return None
+
+    def save(self, stage, key, db):
+        name = stage + '.pkl'
+        tmp_loc = os.path.join(self.loc, name + '.tmp')
+        db.to_pickle(tmp_loc)
+        os.replace(tmp_loc, os.path.join(self.loc, name))
+        self.state['stages'][stage] = {'key':key, 'data':name, 'time':time.time()}
+        self._save_state()
+
+    def is_done(self, stage, key):
+        '''
+        Return True if this stage already wrote its output with this key, and the output hasn't changed since
+        '''
+        entry = self.state['stages'].get(stage)
+        if (entry is None) or (entry['key'] != key):
+            return False
+        for loc, fingerprint in entry.get('outputs', {}).items():
+            if (not os.path.isfile(loc)) or (file_fingerprint(loc) != fingerprint):
+                return False
+        return True
+
+    def mark_done(self, stage, key, outputs):
+        '''
+        Record that this stage wrote these files with this key
+        '''
+        self.state['stages'][stage] = {'key':key, 'time':time.time(), \
+            'outputs':{loc:file_fingerprint(loc) for loc in outputs}}
+        self._save_state()
+
+    def _save_state(self):
+        tmp_loc = self.state_loc + '.tmp'
+        with open(tmp_loc, 'w') as o:
+            json.dump(self.state, o, indent=2)
+        os.replace(tmp_loc, self.state_loc)
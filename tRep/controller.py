@@ -1,8 +1,30 @@
 #!/usr/bin/env python
 
+import os
+import time
+import shutil
+import tempfile
+import traceback
+import multiprocessing
+
+import numpy as np
 import pandas as pd
 
 import tRep
+import tRep.lineage
+import tRep.checkpoint
+import tRep.profiling
+import tRep.taxdb
+import tRep.table_io
+import tRep.ttable
+
+# Columns of a tax_collector.py --manifest; the first two are required
+MANIFEST_COLUMNS = ['b6_loc', 'out_loc', 'scaffold2bin', 'amino_acids']
+
+# Stages of tax_collector.py recorded with --profile, in the order they run
+PROFILE_STAGES = ['tax_collector', 'convert_b6_to_Tdb', 'load_b6', 'gen_levels_db', 'merge_taxonomy', \
+    'add_genes_without_hits', 'add_scaffolds', 'compact_tdb', 'save_gene_table', 'add_bin_to_tdb', \
+    'genome_taxonomy', 'save_genome_table', 'scaffold_taxonomy', 'save_scaffold_table']
 
 def extract_diamond_scaffold(id):
     '''
@@ -27,52 +49,393 @@ def extract_diamond_scaffold(id):
     print("I dont know how to parse the gene {0} into a scaffold; it will be ignored for scaffold and genome profiling".format(
         id))
 
-def convert_b6_to_Tdb(args, save=False):
+def convert_b6_to_Tdb(args, save=False, checkpoints=None, engine=None):
+    '''
+    Make Tdb (the lineage of every gene) from the b6 file of args
+
+    With checkpoints (a tRep.checkpoint.Checkpoints), the parsed hits are
+    reused from there if the b6 file hasn't changed
+
+    engine = the tRep.engine.TaxonomyEngine to classify the hits with (default: tRep.get_engine())
+    '''
+    if engine is None:
+        engine = tRep.get_engine()
     b6_loc = args.get('b6_loc')
     out_loc = args.get('out_loc')
     aa_loc = args.get('amino_acids', None)
     tax_type = args.get('tax_type', 'species')
+    max_memory = args.get('max_memory', None)
 
     # Load Bdb
-    Bdb = tRep.load_b6(b6_loc, tax_type=tax_type)
-    Bdb = Bdb[~Bdb['taxID'].isna()]
+    with tRep.profiling.stage('load_b6') as s:
+        def load_hits():
+            chunksize = tRep.get_b6_chunksize(b6_loc, max_memory) if max_memory is not None else None
+            Bdb = tRep.load_b6(b6_loc, tax_type=tax_type, chunksize=chunksize)
+            return Bdb[~Bdb['taxID'].isna()]
+
+        if checkpoints is None:
+            Bdb = load_hits()
+        else:
+            Bdb = checkpoints.cached('hits', get_checkpoint_keys(args, checkpoints)['hits'], load_hits)
+        s['rows'] = len(Bdb)
+
+    Tdb = engine.classify_hits(Bdb, type=tRep.type_b6(b6_loc), aa_loc=aa_loc, tax_type=tax_type)
 
-    # Add the taxonomy
-    tax = tRep.gen_levels_db(list(Bdb['taxID'].unique()))
+    # Save
+    if save:
+        with tRep.profiling.stage('save_gene_table') as s:
+            # Without an output_format, go by the extension (Tdb has always been a .csv)
+            format = args.get('output_format', None)
+            if format is None:
+                format = tRep.table_io.get_format(out_loc)
+                if format == 'tsv':
+                    format = 'csv'
+            tRep.table_io.save_table(Tdb, out_loc, format)
+            s['rows'] = len(Tdb)
 
-    # Merge in
+    return Tdb
+
+def merge_taxonomy(Bdb, tax):
+    '''
+    Add the columns of gen_levels_db to every hit of Bdb
+    '''
     Tdb = pd.merge(Bdb, tax, on='taxID', how='outer')
     assert len(Tdb) == len(Bdb)
+    return Tdb
 
-    # Add back missing ones
-    if aa_loc is not None:
-        Adb = tRep.parse_prodigal_genes(aa_loc)
+def add_scaffolds(Tdb, type):
+    '''
+    Add the scaffold of every gene of Tdb, parsed from the querry the way the b6 type needs
 
-        # Figure out the overlap
-        all_genes = set(Adb['gene'].tolist())
-        hit_genes = set(Bdb['querry'].tolist())
-        print("{0} of {1} genes have a {2} hit".format(len(hit_genes), len(all_genes), tax_type))
-        assert len(hit_genes - all_genes) == 0
+    Scaffolds that load_b6 already parsed are kept. The rest (like genes without hits)
+    are parsed once per unique querry, and those that can't be are reported together
+    '''
+    if type == 'diamond':
+        parser = tRep.diamond_scaffolds
+    elif type == 'b6+':
+        parser = tRep.gene_scaffolds
+    else:
+        return Tdb
 
-        # Add back some blanks
-        db = pd.DataFrame({"querry":list(all_genes - hit_genes)})
-        for level in tRep.get_levels():
-            db[level] = 'unk'
-        Tdb = pd.concat([Tdb, db]).reset_index(drop=True)
+    if 'scaffold' in Tdb.columns:
+        todo = Tdb['scaffold'].isna().to_numpy()
+        scaffolds = Tdb['scaffold'].to_numpy(dtype=object, copy=True)
+    else:
+        todo = np.ones(len(Tdb), dtype=bool)
+        scaffolds = np.full(len(Tdb), None, dtype=object)
 
-    if len(Tdb) > 0:
-        type = tRep.type_b6(b6_loc)
-        if type == 'diamond':
-            Tdb['scaffold'] = [extract_diamond_scaffold(x) for x in Tdb['querry']]
-        elif type == 'b6+':
-            Tdb['scaffold'] = ['_'.join(x.split('_')[:-1]) for x in Tdb['querry']]
+    if todo.any():
+        parsed = tRep._map_unique(Tdb['querry'][todo], parser)
+        failed = Tdb['querry'][todo][parsed.isna().to_numpy()].unique()
+        if len(failed) > 0:
+            print("I dont know how to parse {0} genes into scaffolds (like {1}); they will be ignored for scaffold and genome profiling".format(
+                len(failed), failed[0]))
+        scaffolds[todo] = parsed.to_numpy(dtype=object)
 
+    Tdb['scaffold'] = pd.Series(scaffolds.tolist(), index=Tdb.index)
+    return Tdb
 
-    # Save
-    if save:
-        Tdb.to_csv(out_loc, index=False)
+def run_tax_collector(args):
+    '''
+    Make the gene, genome and scaffold taxonomy tables of tax_collector.py for one b6 file
+
+    With args['profile'], the stages are profiled (see tRep/profiling.py) and
+    saved to [out_loc]_profile.json, even if the run fails
+
+    Returns Tdb (or with args['streaming'], the scaffold table)
+    '''
+    if not args.get('profile', False):
+        return _run_tax_collector(args)
+
+    out_base = args.get('out_loc')
+    cprofile_stage = args.get('profile_stage', None)
+    profiler = tRep.profiling.start(cprofile_stage=cprofile_stage, \
+        cprofile_loc=out_base + '_profile_' + cprofile_stage + '.prof' if cprofile_stage is not None else None)
+    try:
+        with tRep.profiling.stage('tax_collector'):
+            return _run_tax_collector(args)
+    finally:
+        tRep.profiling.stop()
+        profiler.print_summary()
+        print("Stage profile saved to {0}".format(profiler.save(out_base + '_profile.json')))
+
+def _run_tax_collector(args):
+    out_base = args.get('out_loc')
+    skip_scaffs = args.get('SkipScaffolds', False)
+    skip_genes = args.get('SkipGenes', False)
+    stb = args.get('scaffold2bin', None)
+    format = args.get('output_format', 'tsv')
+
+    if args.get('streaming', False):
+        return _stream_scaffold_taxonomy(args)
+
+    checkpoints, keys = None, None
+    if args.get('checkpoints', False):
+        checkpoints = tRep.checkpoint.Checkpoints(tRep.checkpoint.get_checkpoint_dir(out_base))
+        keys = get_checkpoint_keys(args, checkpoints)
+
+    # Make Tdb (gene_level taxonomy)
+    with tRep.profiling.stage('convert_b6_to_Tdb') as s:
+        if checkpoints is None:
+            Tdb = convert_b6_to_Tdb(args, save=False)
+        else:
+            Tdb = checkpoints.cached('Tdb', keys['Tdb'], \
+                    lambda: convert_b6_to_Tdb(args, save=False, checkpoints=checkpoints))
+        s['rows'] = len(Tdb)
+    if tRep.taxdb.stats['retries'] > 0:
+        print(tRep.taxdb.stats_message())
+    if not skip_genes:
+        loc = tRep.table_io.output_loc(out_base, 'fullGeneTaxonomy', format)
+        if not _is_done(checkpoints, 'gene_table', keys, loc):
+            with tRep.profiling.stage('save_gene_table') as s:
+                tRep.table_io.save_table(Tdb, loc, format)
+                s['rows'] = len(Tdb)
+            _mark_done(checkpoints, 'gene_table', keys, loc)
+
+    # Make genome level taxonomy
+    if stb is None:
+        pass
+    else:
+        loc = tRep.table_io.output_loc(out_base, 'fullGenomeTaxonomy', format)
+        if not _is_done(checkpoints, 'genome_table', keys, loc):
+            with tRep.profiling.stage('add_bin_to_tdb') as s:
+                if stb == 'ALL':
+                    Tdb['bin'] = 'genome'
+                else:
+                    Tdb = tRep.add_bin_to_tdb(Tdb, stb)
+                s['rows'] = len(Tdb)
+            with tRep.profiling.stage('genome_taxonomy') as s:
+                gdb = tRep.gen_taxonomy_table(Tdb, on='bin')
+                s['rows'] = len(gdb)
+            with tRep.profiling.stage('save_genome_table') as s:
+                tRep.table_io.save_table(gdb, loc, format)
+                s['rows'] = len(gdb)
+            _mark_done(checkpoints, 'genome_table', keys, loc)
+
+    # Make scaffold level taxonomy
+    if not skip_scaffs:
+        loc = tRep.table_io.output_loc(out_base, 'fullScaffoldTaxonomy', format)
+        if not _is_done(checkpoints, 'scaffold_table', keys, loc):
+            try:
+                with tRep.profiling.stage('scaffold_taxonomy') as s:
+                    sdb = tRep.gen_taxonomy_table(Tdb, on='scaffold')
+                    s['rows'] = len(sdb)
+            except:
+                print('unable to parse scaffold information- skipping')
+            else:
+                with tRep.profiling.stage('save_scaffold_table') as s:
+                    tRep.table_io.save_table(sdb, loc, format)
+                    s['rows'] = len(sdb)
+                _mark_done(checkpoints, 'scaffold_table', keys, loc)
 
     return Tdb
 
+def _stream_scaffold_taxonomy(args):
+    '''
+    The --streaming version of _run_tax_collector: make only the scaffold table, in
+    one pass over the b6 file and without Tdb (see tRep/streaming.py)
+
+    Returns the scaffold table
+    '''
+    import tRep.streaming
+    b6_loc = args.get('b6_loc')
+    out_base = args.get('out_loc')
+    format = args.get('output_format', 'tsv')
+    max_memory = args.get('max_memory', None)
+
+    if args.get('scaffold2bin', None) is not None:
+        print("--streaming only makes the scaffold table; the genome table needs the full Tdb (drop -stb or --streaming)")
+        raise Exception()
+    if not args.get('SkipGenes', False):
+        print("--streaming doesn't make the gene table; only the scaffold table")
+
+    with tRep.profiling.stage('scaffold_taxonomy') as s:
+        chunksize = tRep.get_b6_chunksize(b6_loc, max_memory) if max_memory is not None else None
+        sdb = tRep.streaming.stream_scaffold_taxonomy(b6_loc, tax_type=args.get('tax_type', 'species'), \
+                aa_loc=args.get('amino_acids', None), chunksize=chunksize)
+        s['rows'] = len(sdb)
+    with tRep.profiling.stage('save_scaffold_table') as s:
+        tRep.table_io.save_table(sdb, tRep.table_io.output_loc(out_base, 'fullScaffoldTaxonomy', format), format)
+        s['rows'] = len(sdb)
+
+    return sdb
+
+def get_checkpoint_keys(args, checkpoints):
+    '''
+    Return the checkpoint key of every stage of tax_collector.py (see tRep/checkpoint.py)
+
+    Each key covers the inputs and options that change the result of its stage,
+    and the key of the stage it starts from
+    '''
+    make_key = tRep.checkpoint.make_key
+    stb = args.get('scaffold2bin', None)
+    format = args.get('output_format', 'tsv')
+
+    keys = {}
+    keys['hits'] = make_key('hits', tRep.__version__, checkpoints.file_hash(args.get('b6_loc')), \
+                            args.get('tax_type', 'species'))
+    keys['Tdb'] = make_key('Tdb', keys['hits'], checkpoints.file_hash(args.get('amino_acids', None)), \
+                           tRep.lineage_cache.taxdb_fingerprint(tRep.get_taxdb_loc()))
+    keys['gene_table'] = make_key('gene_table', keys['Tdb'], format)
+    keys['genome_table'] = make_key('genome_table', keys['Tdb'], format, \
+                           stb if stb in [None, 'ALL'] else checkpoints.file_hash(stb))
+    keys['scaffold_table'] = make_key('scaffold_table', keys['Tdb'], format)
+    return keys
+
+def _is_done(checkpoints, stage, keys, loc):
+    if (checkpoints is None) or (not checkpoints.is_done(stage, keys[stage])):
+        return False
+    print("Reusing {0}; its inputs haven't changed".format(loc))
+    return True
+
+def _mark_done(checkpoints, stage, keys, loc):
+    if checkpoints is not None:
+        checkpoints.mark_done(stage, keys[stage], [loc])
+
+def load_manifest(loc):
+    '''
+    Load a tab-separated manifest of samples for tax_collector.py
+
+    Returns a list of dictionaries with the keys in MANIFEST_COLUMNS (missing values are None)
+    '''
+    mdb = pd.read_csv(loc, sep='\t', dtype=str)
+    for col in MANIFEST_COLUMNS[:2]:
+        if col not in mdb.columns:
+            print("The manifest {0} needs a column named {1}; it has {2}".format(\
+                loc, col, ', '.join(mdb.columns)))
+            raise Exception()
+
+    extra = set(mdb.columns) - set(MANIFEST_COLUMNS)
+    if len(extra) > 0:
+        print("Ignoring unknown manifest columns: {0}".format(', '.join(sorted(extra))))
+
+    samples = []
+    for i, row in mdb.iterrows():
+        samples.append({col:(row[col] if (col in mdb.columns) and (not pd.isna(row[col])) else None) \
+                        for col in MANIFEST_COLUMNS})
+    return samples
+
+def run_tax_collector_batch(args):
+    '''
+    Run tax_collector.py on every sample of a manifest with a pool of worker processes
+
+    The lineage index is built once and saved to a temporary directory; every
+    worker memory-maps that same copy rather than opening the NCBI taxonomy itself
+
+    Returns a DataFrame with a row of stats per sample
+    '''
+    samples = load_manifest(args.get('manifest'))
+    processes = max(1, min(int(args.get('processes', 1)), len(samples)))
+
+    start = time.time()
+    index_dir = tempfile.mkdtemp(prefix='tRep_lineage_')
+    try:
+        tRep.get_lineage_index().save(index_dir)
+
+        jobs = []
+        for sample in samples:
+            # missing values leave the arguments of the whole batch as they are
+            job = dict(args)
+            job.update({k:v for k, v in sample.items() if v is not None})
+            jobs.append(job)
+
+        print("Running {0} samples with {1} processes".format(len(jobs), processes))
+        if processes == 1:
+            results = [_run_batch_sample(job) for job in jobs]
+        else:
+            with multiprocessing.Pool(processes, initializer=_init_batch_worker, \
+                        initargs=(index_dir,)) as pool:
+                results = list(pool.imap(_run_batch_sample, jobs))
+    finally:
+        shutil.rmtree(index_dir, ignore_errors=True)
+
+    Rdb = pd.DataFrame(results)
+    print_batch_summary(Rdb, time.time() - start)
+    return Rdb
+
+def _init_batch_worker(index_dir):
+    tRep.lineage_index = tRep.lineage.LineageIndex.load(index_dir)
+
+def _run_batch_sample(args):
+    '''
+    Run one sample of a batch; failures are reported rather than raised so the rest can finish
+    '''
+    start = time.time()
+    result = {'b6_loc':args.get('b6_loc'), 'out_loc':args.get('out_loc'), 'genes':0, \
+              'b6_mb':0.0, 'seconds':0.0, 'error':None}
+    before = tRep.taxdb.get_stats()
+    try:
+        result['b6_mb'] = os.path.getsize(args.get('b6_loc')) / 1e6
+        Tdb = run_tax_collector(args)
+        # --streaming returns the scaffold table, which knows how many genes went into it
+        result['genes'] = Tdb.attrs.get('genes', len(Tdb))
+    except Exception as e:
+        result['error'] = '{0}: {1}'.format(type(e).__name__, e)
+        print("Failed on {0}:".format(args.get('b6_loc')))
+        traceback.print_exc()
+    result['seconds'] = time.time() - start
+    result['taxdb_retries'] = tRep.taxdb.stats['retries'] - before['retries']
+    result['taxdb_wait'] = tRep.taxdb.stats['wait_seconds'] - before['wait_seconds']
+    return result
+
+def print_batch_summary(Rdb, seconds):
+    '''
+    Print how long each sample took, and the throughput of the whole batch
+    '''
+    print("\n...::: tax_collector.py batch summary :::...")
+    for i, row in Rdb.iterrows():
+        status = 'ok' if pd.isna(row['error']) else 'FAILED ({0})'.format(row['error'])
+        print("{0:>8.1f}s  {1:>10} genes  {2}  {3}".format(row['seconds'], row['genes'], \
+            row['out_loc'], status))
+
+    ok = Rdb[Rdb['error'].isna()]
+    print("{0} of {1} samples finished in {2:.1f} seconds ({3:.1f} samples / minute, "\
+        "{4:.0f} genes / second, {5:.1f} Mb of b6 / second)".format(len(ok), len(Rdb), seconds, \
+        len(ok) / seconds * 60, ok['genes'].sum() / seconds, ok['b6_mb'].sum() / seconds))
+    if len(ok) < len(Rdb):
+        print("{0} samples failed; see the errors above".format(len(Rdb) - len(ok)))
+    if Rdb['taxdb_retries'].sum() > 0:
+        print("Taxonomy database queries were retried {0} times after errors ({1:.1f} seconds spent waiting)".format(\
+            Rdb['taxdb_retries'].sum(), Rdb['taxdb_wait'].sum()))
+
+def run_functional_tax(args):
+    '''
+    Add the functional annotation of every hit of a b6 file from a translation table (functional_tax.py)
+
+    Uses the index of the translation table if it has one (see --build_index).
+    Otherwise, BGZF translation tables (see bgzip_ttable.py) are scanned with multiple processes
+    '''
+    b6_loc = args.get('b6_loc')
+    out_base = args.get('out_loc')
+    database = args.get('database')
+
+    # Index the translation database
+    if args.get('build_index', False):
+        start = time.time()
+        if tRep.ttable.index_is_current(database, tRep.ttable.get_index_loc(database)):
+            print("Translation database is already indexed")
+        else:
+            lines = tRep.ttable.build_index(database)
+            print("{0:.1f} seconds to index {1} lines of the translation database".format(\
+                time.time()-start, lines))
+
+    # Load the hits
+    Bdb = tRep.load_b6(b6_loc)
+
+    # Load translations
+    start = time.time()
+    r2t = tRep.ttable.load_annotations(database, set(Bdb['target'].tolist()), \
+                processes=int(args.get('processes', 1)))
+    end = time.time()
+    print("{0:.1f} seconds to load translation database".format(end-start))
+
+    # Make the translation table
+    Bdb['functional_annotation'] = Bdb['target'].map(r2t)
+
+    # Save
+    Bdb.to_csv(os.path.join(out_base) + '_geneFunctionalAnnotation.tsv', \
+        index=False, sep='\t')
+    return Bdb
+
 def gen_blank_levels():
     pass
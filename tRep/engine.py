@@ -0,0 +1,402 @@
+#!/usr/bin/env python
+
+'''
+A TaxonomyEngine classifies hits and tables while remembering everything it
+has looked up, so code that classifies lots of samples in one process (a
+notebook, a Snakemake rule, trep_server.py) only resolves each taxID once
+
+    engine = tRep.engine.TaxonomyEngine()
+    for b6_loc in b6_locs:
+        Tdb = engine.classify_hits(tRep.load_b6(b6_loc), type=tRep.type_b6(b6_loc))
+        Sdb = engine.classify_tdb(Tdb, on='scaffold')
+
+An engine holds:
+
+- the taxonomy database it resolves lineages from (by default ete3's, through
+  the lineage cache and lineage index of tRep.get_lineages)
+- a memo of the lineage and the name at every rank of the taxIDs it has seen
+  (the max_entries most recently used), emptied if the taxonomy database changes
+- one dictionary of taxon names that the rank columns of all of its Tdbs are
+  coded with, so they can be concatenated without recoding
+
+gen_levels_db, gen_taxonomy_table, gen_taxonomy_string, gen_full_tdb,
+lineage_from_taxId and controller.convert_b6_to_Tdb use the engine of
+tRep.get_engine()
+'''
+
+import threading
+import collections
+
+import numpy as np
+import pandas as pd
+
+import tRep
+import tRep.lineage
+import tRep.lineage_cache
+import tRep.profiling
+import tRep.taxdb
+
+# Lineages an engine remembers; the least recently used are forgotten past this
+DEFAULT_MAX_ENTRIES = 250000
+
+class TaxonomyEngine():
+    '''
+    taxdb_loc = the NCBI taxonomy database to resolve lineages from (default: ete3's, with the lineage cache)
+    lineage_index = a LineageIndex to resolve lineages with instead (see tRep/lineage.py)
+    max_entries = the number of lineages to remember
+    '''
+    def __init__(self, taxdb_loc=None, lineage_index=None, max_entries=DEFAULT_MAX_ENTRIES):
+        self.taxdb_loc = taxdb_loc
+        self.lineage_index = lineage_index
+        self.max_entries = max_entries
+        self.levels = tRep.get_levels()
+
+        self.entries = collections.OrderedDict()
+        self.rank_memo = {}
+        self.fingerprint = None
+        self.names = set()
+        self.dtype = pd.CategoricalDtype([])
+        self.lock = threading.Lock()
+        self.stats = {'lookups':0, 'memo_hits':0, 'resolved':0, 'forgotten':0}
+
+    @property
+    def taxdb(self):
+        '''
+        The connection to the taxonomy database (see tRep/taxdb.py)
+        '''
+        if self.taxdb_loc is None:
+            return tRep.get_taxdb()
+        return tRep.taxdb.get_taxdb(self.taxdb_loc)
+
+    def clear(self):
+        '''
+        Forget every lineage looked up so far (the dictionary of names is kept)
+        '''
+        with self.lock:
+            self.entries = collections.OrderedDict()
+            self.rank_memo = {}
+
+    def lineages(self, taxids):
+        '''
+        Return the ranked part of the lineage of every taxID (see LineageIndex.lineage_entries)
+        '''
+        return self._lookup(taxids)[1]
+
+    def rank_names(self, taxids):
+        '''
+        Return the name at every rank (get_levels()) of every taxID; 'unk' for ranks
+        its lineage doesn't have, or None if it can't be found
+        '''
+        keys, entries = self._lookup(taxids)
+        names = []
+        for k, entry in zip(keys, entries):
+            if entry is None:
+                names.append(None)
+                continue
+            n = self.rank_memo.get(k)
+            if n is None:
+                rank2name = tRep._entry_rank2name(entry)
+                n = [rank2name.get(level, 'unk') for level in self.levels]
+                with self.lock:
+                    # (only for lineages that are still remembered)
+                    if k in self.entries:
+                        self.rank_memo[k] = n
+            names.append(n)
+        return names
+
+    def lineage_entry(self, t):
+        '''
+        The lineage of one taxID; raises a ValueError if it can't be found, like ete3's get_lineage
+        '''
+        entry = self.lineages([t])[0]
+        if entry is None:
+            raise ValueError("{0} taxid not found".format(tRep._format_taxid(t)))
+        return entry
+
+    def _lookup(self, taxids):
+        keys = [tRep._lineage_key(t) for t in taxids]
+        self._check_taxdb()
+
+        found = {}
+        with self.lock:
+            for k in set(keys):
+                if (k is not None) and (k in self.entries):
+                    self.entries.move_to_end(k)
+                    found[k] = self.entries[k]
+        missing = sorted(set([k for k in keys if (k is not None) and (k not in found)]))
+
+        # resolved without the lock, so other threads can use the memo meanwhile
+        if len(missing) > 0:
+            found.update(zip(missing, self._resolve(missing)))
+
+        with self.lock:
+            for k in missing:
+                self.entries[k] = found[k]
+            while len(self.entries) > self.max_entries:
+                k, entry = self.entries.popitem(last=False)
+                self.rank_memo.pop(k, None)
+                self.stats['forgotten'] += 1
+            self.stats['lookups'] += len(keys)
+            self.stats['resolved'] += len(missing)
+            self.stats['memo_hits'] += len(keys) - len(missing)
+        return keys, [found[k] if k is not None else None for k in keys]
+
+    def _resolve(self, keys):
+        if self.lineage_index is not None:
+            return self.lineage_index.lineage_entries(keys)
+        if self.taxdb_loc is None:
+            return tRep.get_lineages(keys)
+
+        # like get_lineages, but without the lineage cache of ete3's database
+        if len(keys) >= tRep.INDEX_MIN_MISSES:
+            self.lineage_index = tRep.lineage.LineageIndex.from_taxdb(self.taxdb)
+            return self.lineage_index.lineage_entries(keys)
+        taxdb = self.taxdb
+        return [tRep._taxdb_lineage_entry(taxdb, k) for k in keys]
+
+    def _check_taxdb(self):
+        '''
+        Forget everything if the taxonomy database has changed (like after tax_collector.py --update)
+        '''
+        loc = self.taxdb_loc if self.taxdb_loc is not None else tRep.get_taxdb_loc()
+        fingerprint = tRep.lineage_cache.taxdb_fingerprint(loc)
+        if fingerprint != self.fingerprint:
+            if self.fingerprint is not None:
+                self.clear()
+            self.fingerprint = fingerprint
+
+    def levels_db(self, hits):
+        '''
+        from a list of taxIDs, return a DataFrame deliniating their taxonomies
+        '''
+        print("parsing taxIDs...")
+
+        hits = list(hits)
+        table = {'taxID':[]}
+        for level in self.levels:
+            table[level] = []
+
+        for t, names in zip(hits, self.rank_names(hits)):
+            if names is None:
+                continue
+            table['taxID'].append(t)
+            for level, name in zip(self.levels, names):
+                table[level].append(name)
+
+        return pd.DataFrame(table)
+
+    def classify_hits(self, Bdb, type=None, aa_loc=None, tax_type='species'):
+        '''
+        Make Tdb (the lineage of every gene) from the hits of a b6 file that have a taxID
+
+        type = the type of the b6 file, to parse scaffolds with (see type_b6)
+        aa_loc = the prodigal genes the b6 file was made from; genes without hits are added as "unk"
+        '''
+        import tRep.controller
+
+        # Add the taxonomy
+        with tRep.profiling.stage('gen_levels_db') as s:
+            tax = self.levels_db(list(Bdb['taxID'].unique()))
+            s['rows'] = len(tax)
+
+        # Merge in
+        with tRep.profiling.stage('merge_taxonomy') as s:
+            Tdb = tRep.controller.merge_taxonomy(Bdb, tax)
+            s['rows'] = len(Tdb)
+
+        # Add back missing ones
+        if aa_loc is not None:
+            with tRep.profiling.stage('add_genes_without_hits') as s:
+                Adb = tRep.parse_prodigal_genes(aa_loc)
+
+                # Figure out the overlap
+                all_genes = set(Adb['gene'].tolist())
+                hit_genes = set(Bdb['querry'].tolist())
+                print("{0} of {1} genes have a {2} hit".format(len(hit_genes), len(all_genes), tax_type))
+                assert len(hit_genes - all_genes) == 0
+
+                # Add back some blanks
+                db = pd.DataFrame({"querry":list(all_genes - hit_genes)})
+                for level in self.levels:
+                    db[level] = 'unk'
+                Tdb = pd.concat([Tdb, db]).reset_index(drop=True)
+                s['rows'] = len(db)
+
+        if (len(Tdb) > 0) and (type is not None):
+            with tRep.profiling.stage('add_scaffolds') as s:
+                Tdb = tRep.controller.add_scaffolds(Tdb, type)
+                s['rows'] = len(Tdb)
+
+        # Store the names as categorical codes
+        if len(Tdb) > 0:
+            with tRep.profiling.stage('compact_tdb') as s:
+                Tdb = self.compact_tdb(Tdb)
+                s['rows'] = len(Tdb)
+
+        return Tdb
+
+    def compact_tdb(self, Tdb):
+        '''
+        compact_tdb, coding the rank columns with the engine's dictionary of names
+
+        The dictionary is sorted, and grows to take in the names of every Tdb it codes
+        '''
+        names = pd.unique(pd.concat([Tdb[level] for level in self.levels]).dropna())
+        with self.lock:
+            new = set(names) - self.names
+            if len(new) > 0:
+                self.names |= new
+                self.dtype = pd.CategoricalDtype(sorted(self.names))
+            dtype = self.dtype
+
+        for level in self.levels:
+            Tdb[level] = Tdb[level].astype(dtype)
+        if 'scaffold' in Tdb.columns:
+            Tdb['scaffold'] = Tdb['scaffold'].astype('category')
+        return Tdb
+
+    def classify_tdb(self, Tdb, on='scaffold', minPerc=50):
+        '''
+        From a dataframe with all of the levels present, calculate percentages (gen_taxonomy_table)
+
+        Tdb can also be the location of a saved Tdb (in any format tRep.table_io can load)
+        '''
+        if isinstance(Tdb, str):
+            Tdb = tRep.table_io.load_tdb(Tdb)
+        print("Generating taxonomy table...")
+
+        # integer-code the groups once; they come out sorted, the same as Tdb.groupby(on)
+        groups, things = pd.factorize(Tdb[on], sort=True)
+
+        table = {}
+        for level in self.levels:
+            winners, percents = tRep._group_winners(groups, len(things), Tdb[level])
+            table[level + '_winner'] = winners
+            table[level + '_percent'] = percents
+        table[on] = things
+        Sdb = pd.DataFrame(table)
+
+        # add taxonomy
+        Sdb['full_taxonomy'], Sdb['taxonomy'] = tRep.calculate_full_taxonomies(Sdb, minPerc)
+        return Sdb
+
+    def count_lineages(self, hits, weights=None):
+        '''
+        Count every distinct taxID of hits and resolve its lineage once
+
+        weights = the number of hits each of hits stands for (like the counts of count_taxids)
+
+        Returns lists of the lineage entries, the number of hits and the position of
+        the first hit of each distinct taxID, in order of first appearance. Hits that
+        can't be taxIDs at all (like 0 and NaN) are left out, and ones that aren't whole
+        numbers have no lineage
+        '''
+        values = tRep._taxid_values(hits)
+        valid = np.flatnonzero(np.isfinite(values) & (values >= 1))
+
+        codes, uniques = pd.factorize(values[valid])
+        if weights is None:
+            counts = np.bincount(codes, minlength=len(uniques))
+        else:
+            weights = np.asarray(weights, dtype=np.int64)[valid]
+            counts = np.bincount(codes, weights=weights, minlength=len(uniques)).astype(np.int64)
+        firsts = valid[np.unique(codes, return_index=True)[1]] if len(codes) > 0 else valid
+
+        return self.lineages(uniques), counts.tolist(), firsts.tolist()
+
+    def taxonomy_string(self, hits, minPerc=50, testing=False, weights=None):
+        '''
+        Determines the lowest taxonomic level with at least minPerc certainty (see gen_taxonomy_string)
+        '''
+        Levels = list(self.levels)
+
+        # generate nested dictionary for levels
+        countDic = {}
+        for level in Levels:
+            countDic[level] = {}
+
+        # fill in nested dictionary, once per distinct taxID
+        entries, counts, firsts = self.count_lineages(hits, weights=weights)
+        for entry, count in zip(entries, counts):
+            if entry is None:
+                continue
+
+            for i, rank, name in entry:
+                level = Levels[rank]
+                countDic[level][i] = countDic[level].get(i,0) + count
+
+        # figure out the total number of hits
+        total = sum(countDic['phylum'].values())
+
+        # find the lowest rank winner
+        winner = False
+
+        Levels.reverse()
+        for level in Levels:
+            if winner != False:
+                break
+            dic = countDic[level]
+            for name in sorted(dic, key=dic.get, reverse= True):
+                count = dic[name]
+                if ((count/total) *100) > minPerc:
+                    winner = name
+                break
+
+        # return the whole taxonomy string
+        name = self._rank_name_list(self.lineage_entry(winner))
+
+        if testing:
+            return '|'.join([str(winner)] + name), countDic
+        else:
+            return '|'.join([str(winner)] + name)
+
+    def full_tdb(self, hits, weights=None):
+        '''
+        Report all hits to all taxonomic levels (see gen_full_tdb)
+        '''
+        Levels = self.levels
+
+        # generate nested dictionary for levels
+        countDic = {}
+        for level in Levels:
+            countDic[level] = {}
+
+        # fill in nested dictionary, once per distinct taxID
+        taxIDs = hits['taxID'].tolist()
+        entries, counts, firsts = self.count_lineages(taxIDs, weights=weights)
+
+        # taxIDs that can't be found (other than 0) are an error
+        missing = [f for f, e in zip(firsts, entries) if e is None]
+        missing += [i for i in tRep._invalid_taxids(taxIDs) if taxIDs[i] != 0]
+        if len(missing) > 0:
+            raise ValueError("{0} taxid not found".format(tRep._format_taxid(taxIDs[min(missing)])))
+
+        for entry, count in zip(entries, counts):
+            for i, rank, name in entry[::-1]:
+                level = Levels[rank]
+                countDic[level][name] = countDic[level].get(name,0) + count
+
+        # make the table
+        total = sum(countDic['phylum'].values())
+        table = {'tax_confidence':[], 'tax_level':[], 'taxonomy':[]}
+
+        for level in Levels:
+            dic = countDic[level]
+            for name in sorted(dic, key=dic.get, reverse= True):
+                count = dic[name]
+
+                table['tax_confidence'].append(((count/total) *100))
+                table['tax_level'].append(level)
+                table['taxonomy'].append(name)
+
+        return pd.DataFrame(table)
+
+    def lineage_string(self, t):
+        '''
+        Return "taxID|superkingdom|...|species" for one taxID (see lineage_from_taxId)
+        '''
+        return '|'.join([str(int(t))] + self._rank_name_list(self.lineage_entry(t)))
+
+    def _rank_name_list(self, entry):
+        rank2name = tRep._entry_rank2name(entry)
+        return [rank2name.get(level, 'unk') for level in self.levels]
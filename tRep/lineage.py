@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+
+'''
+An in-memory index of the NCBI taxonomy for resolving lots of taxIDs at once
+
+ete3 answers every get_lineage / get_taxid_translator / get_rank call with a
+separate SQLite query. The LineageIndex instead reads the whole species table
+once and keeps parent pointers, rank codes and name IDs in NumPy arrays indexed
+by taxID, so a whole batch of taxIDs can be walked up to the root together.
+'''
+
+import os
+import csv
+import tarfile
+
+import numpy as np
+import pandas as pd
+
+LEVELS = ['superkingdom','phylum','class','order','family','genus','species']
+
+# NCBI lineages are ~40 deep; anything deeper than this is a cycle
+MAX_DEPTH = 256
+
+class LineageIndex():
+    '''
+    Parent pointers, rank codes and name IDs of the NCBI taxonomy held in arrays
+
+    Every array is indexed by taxID:
+        parent[t]  - taxID of the parent of t (0 if t is the root or not a node)
+        rank[t]    - index of the rank of t in LEVELS (-1 for any other rank)
+        name_id[t] - index of the scientific name of t in names (-1 if not a node)
+        merged[t]  - taxID that the obsolete taxID t was merged into (0 if none)
+    '''
+    def __init__(self, parent, rank, name_id, names, merged):
+        self.parent = parent
+        self.rank = rank
+        self.name_id = name_id
+        self.names = names
+        self.merged = merged
+
+    @classmethod
+    def from_ncbi(cls, ncbi):
+        '''
+        Build the index from the SQLite database behind an ete3 NCBITaxa object
+        '''
+        species = pd.read_sql_query('SELECT taxid, parent, spname, rank FROM species', ncbi.db)
+        merged = pd.read_sql_query('SELECT taxid_old, taxid_new FROM merged', ncbi.db)
+        return cls.from_tables(species, merged)
+
+    @classmethod
+    def from_taxdb(cls, taxdb):
+        '''
+        Build the index from a tRep.taxdb.TaxDB
+        '''
+        species = taxdb.read_table('SELECT taxid, parent, spname, rank FROM species')
+        merged = taxdb.read_table('SELECT taxid_old, taxid_new FROM merged')
+        return cls.from_tables(species, merged)
+
+    @classmethod
+    def from_taxdump(cls, loc):
+        '''
+        Build the index from an NCBI taxdump, either the taxdump.tar.gz itself or a
+        directory it was extracted into (only nodes.dmp, names.dmp and merged.dmp are read)
+        '''
+        nodes = read_dmp(loc, 'nodes.dmp', [0, 1, 2], ['taxid', 'parent', 'rank'])
+        names = read_dmp(loc, 'names.dmp', [0, 1, 3], ['taxid', 'spname', 'name_class'])
+        merged = read_dmp(loc, 'merged.dmp', [0, 1], ['taxid_old', 'taxid_new'])
+
+        names = names[names['name_class'] == 'scientific name']
+        species = pd.merge(nodes, names[['taxid', 'spname']], on='taxid', how='left')
+        return cls.from_tables(species, merged)
+
+    @classmethod
+    def from_tables(cls, species, merged):
+        '''
+        Build the index from DataFrames shaped like ete3's species and merged tables
+        '''
+        taxid = pd.to_numeric(species['taxid']).to_numpy(dtype=np.int64)
+        # ete3 stores the parent of the root as an empty string
+        parent = pd.to_numeric(species['parent'], errors='coerce').fillna(0).to_numpy(dtype=np.int64, copy=True)
+        parent[parent == taxid] = 0
+
+        old = pd.to_numeric(merged['taxid_old']).to_numpy(dtype=np.int64)
+        new = pd.to_numeric(merged['taxid_new']).to_numpy(dtype=np.int64)
+
+        size = int(max(taxid.max(initial=0), old.max(initial=0))) + 1
+
+        P = np.zeros(size, dtype=np.int64)
+        P[taxid] = parent
+
+        R = np.full(size, -1, dtype=np.int8)
+        rank = species['rank'].map({l:i for i, l in enumerate(LEVELS)}).fillna(-1)
+        R[taxid] = rank.to_numpy(dtype=np.int8)
+
+        N = np.full(size, -1, dtype=np.int64)
+        N[taxid] = np.arange(len(taxid))
+
+        M = np.zeros(size, dtype=np.int64)
+        M[old] = new
+
+        names = species['spname'].to_numpy(dtype=object)
+        return cls(P, R, N, names, M)
+
+    def save(self, loc):
+        '''
+        Save the index as a directory of .npy files that load() can memory-map
+
+        Processes that load() the same directory share one copy of it in memory
+        '''
+        os.makedirs(loc, exist_ok=True)
+        if isinstance(self.names, PackedNames):
+            packed = self.names
+        else:
+            packed = PackedNames.from_list(self.names)
+
+        for name, array in [('parent', self.parent), ('rank', self.rank), \
+                ('name_id', self.name_id), ('merged', self.merged), \
+                ('name_offsets', packed.offsets), ('name_blob', packed.blob)]:
+            np.save(os.path.join(loc, name + '.npy'), array)
+
+    @classmethod
+    def load(cls, loc, mmap=True):
+        '''
+        Load an index written by save()
+        '''
+        mode = 'r' if mmap else None
+        arrays = {}
+        for name in ['parent', 'rank', 'name_id', 'merged', 'name_offsets', 'name_blob']:
+            arrays[name] = np.load(os.path.join(loc, name + '.npy'), mmap_mode=mode)
+
+        names = PackedNames(arrays['name_blob'], arrays['name_offsets'])
+        return cls(arrays['parent'], arrays['rank'], arrays['name_id'], names, arrays['merged'])
+
+    def __len__(self):
+        return len(self.names)
+
+    def translate(self, taxids):
+        '''
+        Map taxIDs onto nodes of the index the same way ete3's get_lineage does
+
+        Returns an int64 array of node taxIDs, with 0 wherever get_lineage would
+        raise (NaN, 0, unknown taxIDs and merges pointing at missing nodes), and for
+        taxIDs that aren't whole numbers
+        '''
+        t = np.asarray(taxids, dtype=float)
+        size = len(self.parent)
+
+        ok = np.isfinite(t)
+        ok[ok] = t[ok] == np.floor(t[ok])
+        node = np.zeros(len(t), dtype=np.int64)
+        node[ok] = t[ok].clip(0, size).astype(np.int64)
+        node[node >= size] = 0
+
+        # Obsolete taxIDs are looked up through the merged table
+        missing = self.name_id[node] < 0
+        node[missing] = self.merged[node[missing]]
+        node[self.name_id[node] < 0] = 0
+        return node
+
+    def resolve(self, taxids):
+        '''
+        Walk every taxID up to the root at the same time
+
+        Returns an (n, 7) int64 array with the taxID of the node at each of LEVELS
+        (0 where the lineage has no node at that rank), along with the array of
+        translated nodes from translate() (0 where the taxID could not be resolved)
+        '''
+        node = self.translate(taxids)
+        levels = np.zeros((len(node), len(LEVELS)), dtype=np.int64)
+
+        for depth, idx, c in self._walk(node):
+            r = self.rank[c]
+            hit = r >= 0
+            i, r, c_hit = idx[hit], r[hit], c[hit]
+            # If a lineage has two nodes at one rank, ete3's rank2name keeps the higher taxID
+            levels[i, r] = np.maximum(levels[i, r], c_hit)
+
+        return levels, node
+
+    def lineage_entries(self, taxids):
+        '''
+        Return the ranked part of the lineage of every taxID
+
+        Each is a list of [taxID, rank, name] for every node of the lineage at one
+        of LEVELS (rank is the index in LEVELS), from the root down, like the nodes
+        of ete3's get_lineage that have one of those ranks. Unresolvable taxIDs get None
+        '''
+        node = self.translate(taxids)
+
+        rows, depths, nodes = [], [], []
+        for depth, idx, c in self._walk(node):
+            hit = self.rank[c] >= 0
+            rows.append(idx[hit])
+            depths.append(np.full(hit.sum(), depth))
+            nodes.append(c[hit])
+
+        entries = [[] if n > 0 else None for n in node]
+        if len(rows) == 0:
+            return entries
+
+        rows, depths, nodes = np.concatenate(rows), np.concatenate(depths), np.concatenate(nodes)
+        order = np.lexsort((-depths, rows))
+        rows, nodes = rows[order], nodes[order]
+
+        for r, n, k, name in zip(rows.tolist(), nodes.tolist(), self.rank[nodes].tolist(), \
+                                self.node_names(nodes).tolist()):
+            entries[r].append([n, k, name])
+        return entries
+
+    def _walk(self, node):
+        '''
+        Walk every node up to the root at the same time
+
+        Yields the depth, the positions of the lineages that haven't reached the
+        root yet, and the node each of them is at
+        '''
+        cur = node.copy()
+        for depth in range(MAX_DEPTH):
+            idx = np.flatnonzero(cur)
+            if len(idx) == 0:
+                return
+            c = cur[idx]
+            yield depth, idx, c
+            cur[idx] = self.parent[c]
+        raise ValueError('The taxonomy has a cycle; cannot resolve lineages')
+
+    def node_names(self, nodes, missing='unk'):
+        '''
+        Return the scientific names of an array of nodes; 0 becomes missing
+        '''
+        nodes = np.asarray(nodes, dtype=np.int64)
+        names = np.full(nodes.shape, missing, dtype=object)
+        has = nodes > 0
+        names[has] = self.names[self.name_id[nodes[has]]]
+        return names
+
+    def levels_table(self, hits):
+        '''
+        From a list of taxIDs, return a DataFrame deliniating their taxonomies
+
+        The result matches the per-taxID ete3 loop that gen_levels_db used to run:
+        taxIDs that are 0 or that ete3 can't find are left out, and missing ranks
+        are reported as 'unk'
+        '''
+        hits = np.asarray(list(hits), dtype=object)
+        levels, node = self.resolve(hits.astype(float) if len(hits) > 0 else [])
+        keep = node > 0
+
+        table = {'taxID': hits[keep].tolist()}
+        names = self.node_names(levels[keep])
+        for i, level in enumerate(LEVELS):
+            table[level] = names[:, i].tolist()
+        return pd.DataFrame(table)
+
+def read_dmp(loc, name, fields, columns):
+    '''
+    Read some fields of one .dmp file of an NCBI taxdump (a directory or .tar.gz)
+
+    Fields are separated by "\t|\t", so with tabs as the separator they're every other column
+    '''
+    kwargs = dict(sep='\t', header=None, usecols=[f * 2 for f in fields], dtype=str, \
+                  quoting=csv.QUOTE_NONE, keep_default_na=False)
+    if os.path.isdir(loc):
+        db = pd.read_csv(os.path.join(loc, name), **kwargs)
+    else:
+        with tarfile.open(loc) as tar:
+            db = pd.read_csv(tar.extractfile(name), **kwargs)
+    db.columns = columns
+    return db
+
+class PackedNames():
+    '''
+    A list of strings stored as one UTF-8 byte array plus offsets, so that it can be memory-mapped
+
+    Indexing with an array of positions returns an object array of str, like
+    indexing a NumPy array of names would
+    '''
+    def __init__(self, blob, offsets):
+        self.blob = blob
+        self.offsets = offsets
+
+    @classmethod
+    def from_list(cls, names):
+        encoded = [str(n).encode('utf-8') for n in names]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(e) for e in encoded])
+        blob = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+        return cls(blob, offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        idx = np.asarray(idx, dtype=np.int64)
+        uniques, inverse = np.unique(idx, return_inverse=True)
+        decoded = np.empty(len(uniques), dtype=object)
+        for i, u in enumerate(uniques):
+            decoded[i] = self.blob[self.offsets[u]:self.offsets[u + 1]].tobytes().decode('utf-8')
+        return decoded[inverse].reshape(idx.shape)
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+
+'''
+A persistent, on-disk cache of resolved lineages that's shared between runs
+
+Every entry is the ranked part of the lineage of one taxID, as returned by
+LineageIndex.lineage_entries(): a list of [taxID, rank, name] from the root
+down, or None if the taxID couldn't be resolved. The cache belongs to one
+version of the NCBI taxonomy database; when taxa.sqlite changes (for example
+after tax_collector.py --update) the cache empties itself.
+
+The cache is an SQLite database in WAL mode, so any number of processes can
+read it while one writes. Once it holds more than max_entries lineages, the
+least recently used ones are dropped. When a lineage was last used is only
+updated every TOUCH_INTERVAL seconds, so most reads don't need to write.
+
+Set the environment variable TREP_LINEAGE_CACHE to move the cache, or to "off"
+to not use one.
+'''
+
+import os
+import json
+import time
+import sqlite3
+import threading
+
+# Number of taxIDs looked up per query (SQLite allows 999 variables per statement)
+LOOKUP_BATCH = 900
+
+# About 200 bytes each
+DEFAULT_MAX_ENTRIES = 1000000
+
+# Seconds to wait for another process to finish writing
+BUSY_TIMEOUT = 60
+
+# Seconds between updates of when a lineage was last used
+TOUCH_INTERVAL = 600
+
+# Each thread has its own connection (SQLite connections can't be shared between them)
+_local = threading.local()
+
+def get_cache_loc(taxdb_loc):
+    '''
+    Return where the cache for this taxonomy database goes (None if caching is off)
+    '''
+    loc = os.environ.get('TREP_LINEAGE_CACHE', None)
+    if loc is None:
+        return os.path.join(os.path.dirname(taxdb_loc), 'tRep_lineage_cache.sqlite')
+    elif loc.lower() in ['off', 'none', '']:
+        return None
+    return loc
+
+def get_cache(taxdb_loc):
+    '''
+    Return the LineageCache of this process and thread (None if caching is off or impossible)
+    '''
+    loc = get_cache_loc(taxdb_loc)
+    if loc is None:
+        return None
+
+    # A forked process needs its own connection too
+    cache = getattr(_local, 'cache', None)
+    if (cache is not None) and (cache.loc == loc) and (cache.pid == os.getpid()):
+        return cache
+
+    try:
+        _local.cache = LineageCache(loc, taxdb_fingerprint(taxdb_loc))
+    except (sqlite3.Error, OSError) as e:
+        print("Unable to use the lineage cache at {0} ({1}); continuing without it".format(loc, e))
+        _local.cache = None
+    return _local.cache
+
+def clear(taxdb_loc):
+    '''
+    Empty the cache of this taxonomy database, if there is one
+    '''
+    cache = get_cache(taxdb_loc)
+    if cache is not None:
+        cache.clear(taxdb_fingerprint(taxdb_loc))
+
+def taxdb_fingerprint(taxdb_loc):
+    '''
+    Identify a version of the taxonomy database by its size and modification time
+    '''
+    if not os.path.isfile(taxdb_loc):
+        return 'missing'
+    stat = os.stat(taxdb_loc)
+    return '{0}:{1}'.format(stat.st_size, stat.st_mtime_ns)
+
+class LineageCache():
+    '''
+    taxID -> lineage entry, stored in SQLite
+    '''
+    def __init__(self, loc, fingerprint, max_entries=DEFAULT_MAX_ENTRIES):
+        self.loc = loc
+        self.pid = os.getpid()
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+        # Autocommit mode, with transactions started explicitly
+        self.conn = sqlite3.connect(loc, timeout=BUSY_TIMEOUT, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode = WAL')
+        self.conn.execute('PRAGMA synchronous = NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS lineages '\
+            + '(taxid INTEGER PRIMARY KEY, entry TEXT, last_used REAL)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS lineages_last_used ON lineages (last_used)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS info (key TEXT PRIMARY KEY, value TEXT)')
+
+        self._check_fingerprint(fingerprint)
+
+    def _check_fingerprint(self, fingerprint):
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = self.conn.execute("SELECT value FROM info WHERE key = 'fingerprint'").fetchone()
+            if (row is None) or (row[0] != fingerprint):
+                self._reset(fingerprint)
+            self.conn.execute('COMMIT')
+        except:
+            self.conn.execute('ROLLBACK')
+            raise
+
+    def _reset(self, fingerprint):
+        self.conn.execute('DELETE FROM lineages')
+        self.conn.execute("INSERT OR REPLACE INTO info VALUES ('fingerprint', ?)", (fingerprint,))
+
+    def clear(self, fingerprint):
+        self.conn.execute('BEGIN IMMEDIATE')
+        self._reset(fingerprint)
+        self.conn.execute('COMMIT')
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM lineages').fetchone()[0]
+
+    def get(self, taxids):
+        '''
+        Return a dictionary of taxID -> entry for the taxIDs (ints) that are in the cache
+        '''
+        found = {}
+        stale = []
+        now = time.time()
+        taxids = list(taxids)
+        for i in range(0, len(taxids), LOOKUP_BATCH):
+            batch = taxids[i:i + LOOKUP_BATCH]
+            query = 'SELECT taxid, entry, last_used FROM lineages WHERE taxid IN ({0})'\
+                        .format(','.join(['?'] * len(batch)))
+            for taxid, entry, last_used in self.conn.execute(query, batch):
+                found[taxid] = json.loads(entry)
+                if last_used < now - TOUCH_INTERVAL:
+                    stale.append(taxid)
+
+        self.hits += len(found)
+        self.misses += len(taxids) - len(found)
+
+        if len(stale) > 0:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                self.conn.executemany('UPDATE lineages SET last_used = ? WHERE taxid = ?', \
+                    [(now, t) for t in stale])
+                self.conn.execute('COMMIT')
+            except:
+                self.conn.execute('ROLLBACK')
+                raise
+        return found
+
+    def put(self, entries):
+        '''
+        Add a dictionary of taxID -> entry to the cache, dropping the least recently used
+        entries if that makes it too big
+        '''
+        if len(entries) == 0:
+            return
+        now = time.time()
+
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            self.conn.executemany('INSERT OR REPLACE INTO lineages VALUES (?, ?, ?)', \
+                [(t, json.dumps(e), now) for t, e in entries.items()])
+
+            extra = len(self) - self.max_entries
+            if extra > 0:
+                self.conn.execute('DELETE FROM lineages WHERE taxid IN '\
+                    + '(SELECT taxid FROM lineages ORDER BY last_used LIMIT ?)', (extra,))
+            self.conn.execute('COMMIT')
+        except:
+            self.conn.execute('ROLLBACK')
+            raise
@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+
+'''
+Determine the taxonomy of lots of genomes with prodigal and centrifuge (quickTaxonomy_centrifuge.py -f)
+
+Every genome goes through the same stages:
+
+    call genes (prodigal) -> classify them (centrifuge) -> parse and summarize the hits
+
+Genes are called for the next genomes while the current one is classified and
+summarized, so the cores one stage leaves idle are used by the other. The -p
+threads are shared between the stages (see ThreadBudget): each centrifuge run
+gets half of them and the rest call genes, a genome per thread. Only a few
+genomes are ever ahead of the one being classified, each in its own temporary
+directory that's removed as soon as that genome is done (or fails)
+
+With a work_dir (quickTaxonomy_centrifuge.py --work_dir) the prodigal and
+centrifuge output of every genome is kept there instead, in a directory of its
+own named after the genome's location, size and modification time (see
+get_work_name), and genomes that already have it aren't run again
+'''
+
+import os
+import time
+import hashlib
+import shutil
+import tempfile
+import threading
+import traceback
+import contextlib
+import subprocess
+import collections
+import concurrent.futures
+
+import pandas as pd
+
+import tRep
+
+# Files in a directory given to -f that count as genomes
+FASTA_EXTENSIONS = ('.fa', '.fna', '.fasta')
+
+_END = object()
+
+def get_fastas(locs):
+    '''
+    Return the fasta files of locs (a location or a list of them); directories are replaced by the fasta files in them
+
+    A file given more than once is only returned once
+    '''
+    if isinstance(locs, str):
+        locs = [locs]
+    fastas = []
+    for loc in locs:
+        if os.path.isdir(loc):
+            fastas += sorted([os.path.join(loc, f) for f in os.listdir(loc) if f.endswith(FASTA_EXTENSIONS)])
+        else:
+            fastas.append(loc)
+
+    seen = set()
+    unique = []
+    for fasta in fastas:
+        if os.path.realpath(fasta) not in seen:
+            seen.add(os.path.realpath(fasta))
+            unique.append(fasta)
+    return unique
+
+def get_work_name(fasta):
+    '''
+    Return the name of the directory of a genome in a work_dir
+
+    Genomes with the same name in different places (or changed since) get different directories
+    '''
+    loc = os.path.realpath(fasta)
+    key = loc
+    if os.path.isfile(loc):
+        stat = os.stat(loc)
+        key = '{0}:{1}:{2}'.format(loc, stat.st_size, stat.st_mtime_ns)
+    return '{0}_{1}'.format(os.path.basename(fasta), hashlib.sha1(key.encode('utf-8')).hexdigest()[:12])
+
+def get_genome_names(fastas):
+    '''
+    Return the name to report every genome by: the file name, or the location if another genome has the same file name
+    '''
+    names = [os.path.basename(f) for f in fastas]
+    counts = collections.Counter(names)
+    return [n if counts[n] == 1 else os.path.abspath(f) for n, f in zip(names, fastas)]
+
+def split_threads(processes, genomes):
+    '''
+    Return the threads of each centrifuge run, and the number of genomes to call genes of at once
+    '''
+    processes = max(int(processes), 1)
+    if genomes <= 1:
+        # nothing to overlap with
+        return processes, 1
+    cent_threads = max(processes // 2, 1)
+    return cent_threads, max(processes - cent_threads, 1)
+
+def classify_fastas(fastas, **kwargs):
+    '''
+    Determine the taxonomy of every genome with prodigal and centrifuge
+
+    Yields (fasta, taxonomy, error) in the order of fastas; see from_tdb for the taxonomy
+    '''
+    cent_index = kwargs.get('cent_index')
+
+    def call_genes(fasta, scratch):
+        return run_prodigal(fasta, scratch)
+
+    def classify(fasta, scratch, genes, threads):
+        return run_centrifuge(genes, os.path.join(scratch, os.path.basename(fasta)), cent_index, threads=threads)
+
+    def summarize(fasta, scratch, classified):
+        hits, report = classified
+        return tRep.from_raw_centrifuge(hits, report, **kwargs)
+
+    return run_pipeline(fastas, call_genes, classify, summarize, processes=kwargs.get('processes', 6), \
+                        tmp_dir=kwargs.get('tmp_dir', None), work_dir=kwargs.get('work_dir', None))
+
+def run_fastas(fastas, **kwargs):
+    '''
+    Determine the taxonomy of every genome, printing each one as it's done
+
+    Returns a DataFrame of the genome, location, taxonomy and error of each; saved
+    to kwargs['out_table'] if there is one
+    '''
+    start = time.time()
+    results = []
+    for genome, (fasta, tax, error) in zip(get_genome_names(fastas), classify_fastas(fastas, **kwargs)):
+        if error is None:
+            print("{0}\t{1}".format(genome, tax))
+        else:
+            print("{0} failed: {1}".format(genome, error.strip().split('\n')[-1]))
+        results.append({'genome':genome, 'location':fasta, 'taxonomy':tax, 'error':error})
+    Rdb = pd.DataFrame(results, columns=['genome', 'location', 'taxonomy', 'error'])
+
+    if kwargs.get('out_table', None) is not None:
+        Rdb.to_csv(kwargs.get('out_table'), sep='\t', index=False)
+
+    failed = Rdb['error'].notna().sum()
+    seconds = time.time() - start
+    print("{0} genomes in {1:.1f} seconds ({2:.1f} per minute); {3} failed".format(len(Rdb), seconds, \
+        len(Rdb) / max(seconds, 1e-6) * 60, failed))
+    return Rdb
+
+def run_pipeline(items, call_genes, classify, summarize, processes=6, tmp_dir=None, work_dir=None, \
+                 work_name=get_work_name):
+    '''
+    Run the stages on every item, overlapping the gene calling of the next items with the rest
+
+    call_genes(item, scratch) runs in worker threads, using one thread of the budget each.
+    classify(item, scratch, genes, threads) runs in this thread with the threads it's given,
+    and summarize(item, scratch, classified) after, without any. scratch is a temporary
+    directory (in tmp_dir) that's removed once the item is summarized, or the directory
+    work_name(item) in work_dir (which is kept) if there is one
+
+    Yields (item, summary, error) in the order of items; error is the traceback if a stage failed
+    '''
+    items = list(items)
+    cent_threads, gene_workers = split_threads(processes, len(items))
+    if work_dir is not None:
+        os.makedirs(work_dir, exist_ok=True)
+    budget = ThreadBudget(max(int(processes), 1))
+
+    pending = collections.deque()
+    todo = iter(items)
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=gene_workers)
+    try:
+        while True:
+            # keep the gene callers busy, but only a few genomes ahead
+            while len(pending) < 2 * gene_workers:
+                item = next(todo, _END)
+                if item is _END:
+                    break
+                if work_dir is None:
+                    scratch = tempfile.TemporaryDirectory(prefix='tRep_', dir=tmp_dir)
+                else:
+                    scratch = WorkDirectory(os.path.join(work_dir, work_name(item)))
+                pending.append((item, scratch, pool.submit(_call_genes, budget, call_genes, item, scratch.name)))
+            if len(pending) == 0:
+                break
+
+            item, scratch, future = pending.popleft()
+            try:
+                genes = future.result()
+                with budget.use(cent_threads):
+                    classified = classify(item, scratch.name, genes, cent_threads)
+                summary, error = summarize(item, scratch.name, classified), None
+            except Exception:
+                summary, error = None, traceback.format_exc()
+            finally:
+                scratch.cleanup()
+            yield item, summary, error
+    finally:
+        # stopped early; don't leave anything behind
+        for item, scratch, future in pending:
+            future.cancel()
+        pool.shutdown(wait=True)
+        for item, scratch, future in pending:
+            scratch.cleanup()
+
+def _call_genes(budget, call_genes, item, scratch):
+    with budget.use(1):
+        return call_genes(item, scratch)
+
+class WorkDirectory():
+    '''
+    Stands in for a TemporaryDirectory, but is kept
+    '''
+    def __init__(self, name):
+        self.name = name
+        os.makedirs(name, exist_ok=True)
+
+    def cleanup(self):
+        pass
+
+class ThreadBudget():
+    '''
+    A number of threads that the stages take and give back, so that together they never use more
+    '''
+    def __init__(self, threads):
+        self.threads = threads
+        self.free = threads
+        self.peak = 0
+        self.condition = threading.Condition()
+
+    @contextlib.contextmanager
+    def use(self, threads):
+        threads = min(threads, self.threads)
+        with self.condition:
+            self.condition.wait_for(lambda: self.free >= threads)
+            self.free -= threads
+            self.peak = max(self.peak, self.threads - self.free)
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.free += threads
+                self.condition.notify_all()
+
+def run_prodigal(fasta, out_dir):
+    '''
+    Call the genes of a genome with prodigal; returns the location of their nucleotide sequences
+
+    Genes already called in out_dir are used instead of running prodigal again
+    '''
+    base = os.path.join(out_dir, os.path.basename(fasta))
+    fna, faa = base + '.fna', base + '.faa'
+    if os.path.exists(fna) and os.path.exists(faa):
+        print("Past prodigal run of {0} found- will not re-run".format(os.path.basename(fasta)))
+        return fna
+
+    # Written under temporary names, so a run that dies part way isn't reused
+    _run([_get_exe('prodigal'), '-i', fasta, '-d', fna + '.tmp', '-a', faa + '.tmp', '-m', '-p', 'single'], \
+         [fna, faa])
+    return fna
+
+def run_centrifuge(genes, out_base, cent_index, threads=1):
+    '''
+    Classify genes with centrifuge; returns the locations of the hits and report
+
+    Hits and a report already at out_base are used instead of running centrifuge again
+    '''
+    if cent_index is None:
+        print("Can't find centrifuge index- must provide for taxonomy")
+        raise Exception()
+    hits, report = out_base + '_hits.tsv', out_base + '_report.tsv'
+    if os.path.exists(hits) and os.path.exists(report):
+        print("Past centrifuge run of {0} found- will not re-run".format(os.path.basename(out_base)))
+        return hits, report
+
+    _run([_get_exe('centrifuge'), '-f', '-x', cent_index, genes, '-S', hits + '.tmp', '-p', str(threads), \
+          '--report-file', report + '.tmp'], [hits, report])
+    return hits, report
+
+def _get_exe(name):
+    loc = shutil.which(name)
+    if loc is None:
+        print("Can't find {0}- make sure it's in your system path".format(name))
+        raise Exception()
+    return loc
+
+def _run(cmd, outputs):
+    '''
+    Run a command that writes each of outputs to a .tmp file, and move them into place
+
+    Raises a subprocess.CalledProcessError (with the command's stdout and stderr) if it fails
+    '''
+    try:
+        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if result.returncode != 0:
+            print("{0} failed ({1}): {2}".format(os.path.basename(cmd[0]), result.returncode, \
+                result.stderr.decode('utf-8', 'replace').strip()[-500:]))
+            raise subprocess.CalledProcessError(result.returncode, cmd, output=result.stdout, stderr=result.stderr)
+        for loc in outputs:
+            os.replace(loc + '.tmp', loc)
+    finally:
+        for loc in outputs:
+            if os.path.exists(loc + '.tmp'):
+                os.remove(loc + '.tmp')
+    return result
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+
+'''
+Record the wall time, CPU time, peak memory and row count of every stage of a run
+
+Code marks its stages with
+
+    with tRep.profiling.stage('load_b6') as s:
+        Bdb = tRep.load_b6(b6_loc)
+        s['rows'] = len(Bdb)
+
+which does nothing unless a Profiler has been started. Stages can be nested;
+the peak memory of a stage includes that of the stages inside it. One stage can
+also be run under cProfile, and the results are saved as JSON so they can be
+collected from lots of runs
+
+Peak memory is the peak resident set size (VmHWM), which on Linux is reset at
+the start of every stage; elsewhere it's the peak of the whole process so far
+'''
+
+import os
+import sys
+import json
+import time
+import socket
+import resource
+import contextlib
+
+_profiler = None
+
+def start(cprofile_stage=None, cprofile_loc=None):
+    '''
+    Start recording stages (in this process)
+    '''
+    global _profiler
+    _profiler = Profiler(cprofile_stage=cprofile_stage, cprofile_loc=cprofile_loc)
+    return _profiler
+
+def stop():
+    '''
+    Stop recording stages and return the Profiler that recorded them
+    '''
+    global _profiler
+    profiler = _profiler
+    _profiler = None
+    return profiler
+
+@contextlib.contextmanager
+def stage(name):
+    '''
+    Record a stage of the active Profiler; yields a dictionary to put "rows" (or anything else) into
+    '''
+    if _profiler is None:
+        yield {}
+    else:
+        with _profiler.stage(name) as record:
+            yield record
+
+def get_rss():
+    '''
+    Return the current and peak resident set size of this process, in Mb
+    '''
+    status = _read_status()
+    if 'VmRSS' in status:
+        return status['VmRSS'] / 1024, status['VmHWM'] / 1024
+    # ru_maxrss is in kilobytes on Linux but bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak = peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+    return peak, peak
+
+def _read_status():
+    values = {}
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                key, value = line.split(':', 1)
+                if key in ['VmRSS', 'VmHWM']:
+                    values[key] = int(value.split()[0])
+    except (OSError, ValueError):
+        pass
+    return values
+
+def _reset_peak_rss():
+    # Writing 5 resets the peak resident set size of this process (Linux only)
+    try:
+        with open('/proc/self/clear_refs', 'w') as o:
+            o.write('5')
+    except OSError:
+        pass
+
+class Profiler():
+    '''
+    The stages recorded so far, and the stack of the ones running now
+    '''
+    def __init__(self, cprofile_stage=None, cprofile_loc=None):
+        self.stages = []
+        self.running = []
+        self.cprofile_stage = cprofile_stage
+        self.cprofile_loc = cprofile_loc
+        self.start = time.time()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        rss, peak = get_rss()
+        if len(self.running) > 0:
+            # The peak so far belongs to the stage this one is inside of
+            parent = self.running[-1]
+            parent['peak_rss_mb'] = max(parent['peak_rss_mb'], peak)
+        _reset_peak_rss()
+
+        record = {'stage':name, 'parent':self.running[-1]['stage'] if len(self.running) > 0 else None, \
+                  'depth':len(self.running), 'start_rss_mb':rss, 'peak_rss_mb':rss, 'rows':None}
+        # In the order they start, so stages come after the ones they're inside of
+        self.stages.append(record)
+        self.running.append(record)
+
+        profile = None
+        if name == self.cprofile_stage:
+            import cProfile
+            profile = cProfile.Profile()
+            profile.enable()
+
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield record
+        except BaseException as e:
+            record['error'] = '{0}: {1}'.format(type(e).__name__, e)
+            raise
+        finally:
+            record['wall_seconds'] = time.perf_counter() - wall
+            record['cpu_seconds'] = time.process_time() - cpu
+            if profile is not None:
+                profile.disable()
+                record['cprofile'] = self._save_cprofile(profile)
+
+            record['peak_rss_mb'] = max(record['peak_rss_mb'], get_rss()[1])
+            self.running.pop()
+            if len(self.running) > 0:
+                self.running[-1]['peak_rss_mb'] = max(self.running[-1]['peak_rss_mb'], record['peak_rss_mb'])
+
+    def _save_cprofile(self, profile, top=25):
+        '''
+        Save the cProfile stats (if there's somewhere to) and return the functions that took the most time
+        '''
+        import pstats
+        if self.cprofile_loc is not None:
+            profile.dump_stats(self.cprofile_loc)
+
+        stats = pstats.Stats(profile)
+        functions = []
+        for (filename, line, function), (cc, nc, tottime, cumtime, callers) in stats.stats.items():
+            functions.append({'function':'{0}:{1}({2})'.format(filename, line, function), \
+                              'calls':nc, 'tottime':tottime, 'cumtime':cumtime})
+        functions.sort(key=lambda f: f['cumtime'], reverse=True)
+        return {'loc':self.cprofile_loc, 'top':functions[:top]}
+
+    def report(self):
+        '''
+        Return everything recorded as a dictionary
+        '''
+        import tRep
+        return {'tRep_version':tRep.__version__, 'command':sys.argv, 'host':socket.gethostname(), \
+                'pid':os.getpid(), 'start':time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.start)), \
+                'peak_rss_mb':max([get_rss()[1]] + [r['peak_rss_mb'] for r in self.stages]), \
+                'stages':self.stages}
+
+    def save(self, loc):
+        with open(loc, 'w') as o:
+            json.dump(self.report(), o, indent=2)
+        return loc
+
+    def print_summary(self):
+        print("\n...::: stage profile :::...")
+        print("{0:<32}{1:>10}{2:>10}{3:>12}{4:>12}".format('stage', 'wall s', 'cpu s', 'peak Mb', 'rows'))
+        for record in self.stages:
+            indent = '  ' * record['depth']
+            print("{0:<32}{1:>10.2f}{2:>10.2f}{3:>12.1f}{4:>12}".format(indent + record['stage'], \
+                record['wall_seconds'], record['cpu_seconds'], record['peak_rss_mb'], \
+                record['rows'] if record['rows'] is not None else ''))
@@ -0,0 +1,403 @@
+#!/usr/bin/env python
+
+'''
+A resident tRep server, so that lots of runs of the scripts don't each pay for
+importing tRep, opening the NCBI taxonomy database and warming its caches
+
+    trep_server.py &
+    tax_collector.py -b sample.b6 -o sample      # runs in the server
+
+The server listens on a Unix domain socket (TREP_SERVER_SOCKET, or
+tRep_server_[uid].sock in the temporary directory) and keeps the lineage index,
+the taxonomy database connection and the connections to translation table
+indexes open between requests. tax_collector.py, make_Tdb.py,
+quickTaxonomy_centrifuge.py and functional_tax.py send their arguments to it when
+its socket is there, and run in their own process when it isn't (or it runs a
+different version of tRep). Runs that change the taxonomy database (--update),
+batches (--manifest) and --profile always run in their own process
+
+Each connection is one request, a line of JSON:
+
+    {"command": "tax_collector", "args": {...}, "version": "..."}
+
+answered with lines of JSON: {"output": text} for everything the command prints,
+and last {"done": true, "error": null or the traceback, "seconds": ...}. Commands
+run in a pool of worker threads, so requests can come in at the same time; the
+ones that don't fit in the pool wait. "ping", "stats" and "shutdown" are answered
+straight away
+
+Relative paths are made absolute by the client, but the server runs with its own
+environment (TREP_LINEAGE_CACHE and so on)
+'''
+
+import os
+import sys
+import json
+import time
+import socket
+import threading
+import traceback
+import socketserver
+import collections
+import concurrent.futures
+
+import numpy as np
+
+import tRep
+import tRep.controller
+import tRep.lineage
+import tRep.lineage_cache
+import tRep.taxdb
+import tRep.ttable
+
+# Worker threads to run requests with when no number is given
+DEFAULT_THREADS = 4
+
+# Requests of each command to work out the latency percentiles from
+RECENT_REQUESTS = 1000
+
+# Arguments of each command that are paths (made absolute before they're sent)
+PATH_ARGS = {'tax_collector':['b6_loc', 'out_loc', 'scaffold2bin', 'amino_acids'], \
+             'make_Tdb':['b6_loc', 'out_loc'], \
+             'quickTaxonomy_centrifuge':['cent_hit', 'cent_report', 'fasta', 'full_dump', 'cent_index', \
+                                         'out_table', 'tmp_dir', 'work_dir'], \
+             'functional_tax':['b6_loc', 'out_loc', 'database']}
+
+# Values of path arguments that aren't paths (left as they are)
+PATH_WORDS = {'scaffold2bin':['ALL']}
+
+# Runs with any of these arguments aren't sent to the server
+LOCAL_ARGS = ['update', 'manifest', 'profile']
+
+# What each thread is printing to (see ThreadOutput)
+_output = threading.local()
+
+def get_socket_loc():
+    '''
+    Return the location of the server's socket (None if the server is turned off)
+    '''
+    loc = os.environ.get('TREP_SERVER_SOCKET', None)
+    if loc is None:
+        import tempfile
+        return os.path.join(tempfile.gettempdir(), 'tRep_server_{0}.sock'.format(os.getuid()))
+    elif loc.lower() in ['off', 'none', '']:
+        return None
+    return loc
+
+def run_tax_collector(args):
+    tRep.controller.run_tax_collector(args)
+
+def run_make_Tdb(args):
+    tRep.controller.convert_b6_to_Tdb(args, save=True)
+
+def run_quick_taxonomy(args):
+    tRep.main(**args)
+
+def run_functional_tax(args):
+    tRep.controller.run_functional_tax(args)
+
+COMMANDS = {'tax_collector':run_tax_collector, 'make_Tdb':run_make_Tdb, \
+            'quickTaxonomy_centrifuge':run_quick_taxonomy, 'functional_tax':run_functional_tax}
+
+'''
+The client
+'''
+
+def forward(command, args, loc=None):
+    '''
+    Run a command in the server, printing what it prints
+
+    Returns False if there's no server to run it (so it should be run in this
+    process); exits with an error if it fails in the server
+    '''
+    if loc is None:
+        loc = get_socket_loc()
+    if (loc is None) or (not os.path.exists(loc)):
+        return False
+    if any(args.get(a, False) for a in LOCAL_ARGS):
+        return False
+
+    args = dict(args)
+    for a in PATH_ARGS.get(command, []):
+        if isinstance(args.get(a, None), list):
+            args[a] = [_abspath(a, f) for f in args[a]]
+        elif args.get(a, None) is not None:
+            args[a] = _abspath(a, args[a])
+
+    try:
+        messages = request(loc, {'command':command, 'args':args, 'version':tRep.__version__})
+        message = next(messages)
+    except (OSError, StopIteration):
+        # Nothing is listening (like a socket left by a server that died)
+        return False
+
+    for message in _chain(message, messages):
+        if 'output' in message:
+            sys.stdout.write(message['output'])
+            sys.stdout.flush()
+        elif 'rejected' in message:
+            print("Not using the tRep server at {0} ({1})".format(loc, message['rejected']))
+            return False
+        elif message.get('done', False):
+            if message.get('error', None) is not None:
+                sys.stderr.write(message['error'])
+                sys.exit(1)
+            return True
+
+    print("The tRep server at {0} stopped before {1} finished".format(loc, command))
+    sys.exit(1)
+
+def _abspath(arg, value):
+    if value in PATH_WORDS.get(arg, []):
+        return value
+    return os.path.abspath(value)
+
+def request(loc, message):
+    '''
+    Send a request to the server, and yield every message it answers with
+    '''
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(loc)
+        sock.sendall((json.dumps(message) + '\n').encode('utf-8'))
+        with sock.makefile('rb') as f:
+            for line in f:
+                yield json.loads(line)
+    finally:
+        sock.close()
+
+def call(command, loc=None):
+    '''
+    Send the server a command without arguments (ping, stats or shutdown) and return its answer (None if no server is running)
+    '''
+    if loc is None:
+        loc = get_socket_loc()
+    try:
+        for message in request(loc, {'command':command}):
+            if message.get('done', False):
+                return message
+    except (OSError, TypeError):
+        return None
+    return None
+
+def _chain(first, rest):
+    yield first
+    for message in rest:
+        yield message
+
+'''
+The server
+'''
+
+def serve(loc=None, threads=DEFAULT_THREADS, ttables=[]):
+    '''
+    Warm up and answer requests until the server is told to shut down
+    '''
+    if loc is None:
+        loc = get_socket_loc()
+    if loc is None:
+        print("The tRep server is turned off (TREP_SERVER_SOCKET={0})".format(os.environ.get('TREP_SERVER_SOCKET')))
+        raise Exception()
+    if os.path.exists(loc):
+        if call('ping', loc) is not None:
+            print("A tRep server is already running on {0}".format(loc))
+            raise Exception()
+        # Left behind by a server that died
+        os.remove(loc)
+
+    server = TaxonomyServer(loc, threads=threads)
+    server.warm_up(ttables)
+
+    stdout = sys.stdout
+    sys.stdout = ThreadOutput(stdout)
+    print("tRep server listening on {0} with {1} threads".format(loc, threads))
+    try:
+        server.serve_forever()
+    finally:
+        sys.stdout = stdout
+        server.server_close()
+        server.pool.shutdown(wait=True)
+        if os.path.exists(loc):
+            os.remove(loc)
+        print("tRep server stopped")
+
+class TaxonomyServer(socketserver.ThreadingUnixStreamServer):
+    '''
+    Reads requests in a thread each, and runs them in a pool of worker threads
+    '''
+    daemon_threads = True
+
+    def __init__(self, loc, threads=DEFAULT_THREADS):
+        self.loc = loc
+        self.threads = threads
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+        self.stats = LatencyStats()
+        self.started = time.time()
+        self.taxdb_lock = threading.Lock()
+        self.taxdb_fingerprint = None
+
+        # Only this user can talk to the server
+        umask = os.umask(0o177)
+        try:
+            socketserver.ThreadingUnixStreamServer.__init__(self, loc, RequestHandler)
+        finally:
+            os.umask(umask)
+
+    def warm_up(self, ttables=[]):
+        '''
+        Open the taxonomy database and build the lineage index; check the indexes of translation tables
+        '''
+        start = time.time()
+        loc = tRep.get_taxdb().loc
+        self.taxdb_fingerprint = tRep.lineage_cache.taxdb_fingerprint(loc)
+        tRep.get_lineage_index()
+        print("{0:.1f} seconds to load the taxonomy database".format(time.time() - start))
+
+        for tt_loc in ttables:
+            index_loc = tRep.ttable.get_index_loc(tt_loc)
+            if not tRep.ttable.index_is_current(tt_loc, index_loc):
+                print("{0} isn't indexed, so every run will read all of it (see functional_tax.py --build_index)"\
+                    .format(tt_loc))
+
+    def check_taxdb(self):
+        '''
+        Start over with the taxonomy database if it has changed (like after tax_collector.py --update)
+
+        The new connection and lineage index are built first and then swapped in; requests
+        that are already running keep the old ones, which are closed once nothing uses them
+        '''
+        with self.taxdb_lock:
+            old = tRep.get_taxdb()
+            fingerprint = tRep.lineage_cache.taxdb_fingerprint(old.loc)
+            if fingerprint == self.taxdb_fingerprint:
+                return
+            print("The taxonomy database has changed; reloading it")
+            start = time.time()
+            taxdb = tRep.taxdb.TaxDB(old.loc, scratch_dir=old.scratch_dir)
+            index = tRep.lineage.LineageIndex.from_taxdb(taxdb)
+            tRep.taxdb.replace(taxdb)
+            tRep.lineage_index = index
+            self.taxdb_fingerprint = fingerprint
+            print("{0:.1f} seconds to reload the taxonomy database".format(time.time() - start))
+
+    def run(self, command, args, wfile, queued):
+        '''
+        Run a command in a worker thread, sending what it prints to wfile
+        '''
+        start = time.perf_counter()
+        wait = start - queued
+        self.stats.start()
+        _output.wfile = wfile
+        error = None
+        try:
+            self.check_taxdb()
+            COMMANDS[command](args)
+        except (Exception, SystemExit):
+            error = traceback.format_exc()
+        finally:
+            _output.wfile = None
+        seconds = time.perf_counter() - start
+        self.stats.record(command, seconds, wait, error is not None)
+        return {'done':True, 'error':error, 'seconds':seconds, 'wait_seconds':wait}
+
+    def get_stats(self):
+        return {'version':tRep.__version__, 'pid':os.getpid(), 'socket':self.loc, 'threads':self.threads, \
+                'uptime_seconds':time.time() - self.started, 'active':self.stats.active, \
+                'commands':self.stats.report(), 'taxdb':tRep.taxdb.get_stats()}
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+            command = request['command']
+        except (ValueError, KeyError, TypeError):
+            _send(self.wfile, {'done':True, 'error':'Unable to read the request\n'})
+            return
+
+        if command == 'ping':
+            _send(self.wfile, {'done':True, 'version':tRep.__version__, 'pid':os.getpid()})
+        elif command == 'stats':
+            _send(self.wfile, {'done':True, 'stats':self.server.get_stats()})
+        elif command == 'shutdown':
+            _send(self.wfile, {'done':True})
+            # shutdown() waits for serve_forever(), so it can't be called from a request
+            threading.Thread(target=self.server.shutdown).start()
+        elif command not in COMMANDS:
+            _send(self.wfile, {'done':True, 'error':'Unknown command {0}\n'.format(command)})
+        elif request.get('version', None) != tRep.__version__:
+            _send(self.wfile, {'rejected':'it runs tRep {0}, not {1}'.format(tRep.__version__, \
+                request.get('version', None))})
+        else:
+            future = self.server.pool.submit(self.server.run, command, request.get('args', {}), \
+                self.wfile, time.perf_counter())
+            _send(self.wfile, future.result())
+
+def _send(wfile, message):
+    wfile.write((json.dumps(message) + '\n').encode('utf-8'))
+    wfile.flush()
+
+class ThreadOutput():
+    '''
+    Stands in for sys.stdout, sending what a request prints to its client
+
+    Everything printed outside of requests goes to stream
+    '''
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, text):
+        wfile = getattr(_output, 'wfile', None)
+        if wfile is None:
+            return self.stream.write(text)
+        if len(text) > 0:
+            _send(wfile, {'output':text})
+        return len(text)
+
+    def flush(self):
+        if getattr(_output, 'wfile', None) is None:
+            self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+class LatencyStats():
+    '''
+    How many requests of each command were run, how many failed and how long they took
+    '''
+    def __init__(self, recent=RECENT_REQUESTS):
+        self.lock = threading.Lock()
+        self.recent = recent
+        self.commands = {}
+        self.active = 0
+
+    def start(self):
+        with self.lock:
+            self.active += 1
+
+    def record(self, command, seconds, wait, failed):
+        with self.lock:
+            self.active -= 1
+            if command not in self.commands:
+                self.commands[command] = {'count':0, 'errors':0, 'total_seconds':0.0, 'max_seconds':0.0, \
+                    'wait_seconds':0.0, 'recent':collections.deque(maxlen=self.recent)}
+            c = self.commands[command]
+            c['count'] += 1
+            c['errors'] += int(failed)
+            c['total_seconds'] += seconds
+            c['max_seconds'] = max(c['max_seconds'], seconds)
+            c['wait_seconds'] += wait
+            c['recent'].append(seconds)
+
+    def report(self):
+        '''
+        Return the counters of every command, with the median and 95th percentile of its recent requests
+        '''
+        with self.lock:
+            report = {}
+            for command, c in self.commands.items():
+                recent = np.array(c['recent'])
+                report[command] = {'count':c['count'], 'errors':c['errors'], \
+                    'mean_seconds':c['total_seconds'] / c['count'], 'max_seconds':c['max_seconds'], \
+                    'p50_seconds':float(np.percentile(recent, 50)), 'p95_seconds':float(np.percentile(recent, 95)), \
+                    'mean_wait_seconds':c['wait_seconds'] / c['count']}
+            return report
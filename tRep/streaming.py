@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+
+'''
+Make the scaffold taxonomy table in one pass over a b6 file, without Tdb
+
+The scaffold table only needs to count the names at every rank of the genes of
+each scaffold. DIAMOND writes all hits of a query together and genes of the same
+scaffold are next to each other, so the b6 file is read in chunks (see
+tRep.iter_b6), and every scaffold that has ended is resolved and reduced to its
+row of the table straight away. Only the last scaffold of a chunk is held back,
+in case its genes carry on into the next chunk
+
+Memory is bounded by the chunk size (or the largest scaffold) and the rows of the
+finished table, rather than every hit of the sample. The table is the same as
+gen_taxonomy_table(Tdb, on='scaffold') of the Tdb that convert_b6_to_Tdb would make
+'''
+
+import collections
+
+import numpy as np
+import pandas as pd
+
+import tRep
+
+# Lines of the b6 file to parse at a time when no chunksize is given
+STREAM_CHUNKSIZE = 250000
+
+def stream_scaffold_taxonomy(b6_loc, tax_type='species', aa_loc=None, chunksize=None, minPerc=50):
+    '''
+    Return the scaffold taxonomy table of a b6 file, made a scaffold at a time
+
+    aa_loc = the prodigal genes the b6 file was made from; genes without hits count as "unk" at every rank
+    chunksize = lines of the b6 file to parse at a time
+
+    The number of genes counted is in Sdb.attrs['genes']
+    '''
+    import tRep.controller
+    type = tRep.type_b6(b6_loc)
+    if chunksize is None:
+        chunksize = STREAM_CHUNKSIZE
+
+    stream = ScaffoldStream(type, _genes_per_scaffold(aa_loc, type) if aa_loc is not None else {})
+    carry = None
+    for Bdb in tRep.iter_b6(b6_loc, tax_type=tax_type, chunksize=chunksize):
+        Bdb = tRep.controller.add_scaffolds(Bdb[~Bdb['taxID'].isna()], type)
+        if carry is not None:
+            Bdb = pd.concat([carry, Bdb])
+
+        # hold back the last scaffold; its genes may continue in the next chunk
+        scaffolds = Bdb['scaffold'].dropna()
+        if len(scaffolds) == 0:
+            # none of these hits can be put on a scaffold
+            carry = None
+            continue
+        tail = (Bdb['scaffold'] == scaffolds.iloc[-1]).to_numpy()
+        carry = Bdb[tail]
+        stream.add(Bdb[~tail])
+
+    if carry is not None:
+        stream.add(carry)
+    return stream.finish(minPerc)
+
+def _genes_per_scaffold(aa_loc, type):
+    '''
+    Count the genes of every scaffold of a prodigal .faa file
+
+    Returns a Counter of scaffold -> number of genes on it
+    '''
+    import tRep.controller
+    Adb = tRep.parse_prodigal_genes(aa_loc)
+    Adb = tRep.controller.add_scaffolds(pd.DataFrame({'querry':pd.unique(Adb['gene'])}), type)
+    return collections.Counter(Adb['scaffold'].dropna().tolist())
+
+class ScaffoldStream():
+    '''
+    The rows of the scaffold table made so far
+
+    type = the type of the b6 file
+    genes = scaffold -> number of genes on it (from the prodigal genes; can be empty)
+    '''
+    def __init__(self, type, genes):
+        self.type = type
+        self.genes = genes
+        self.levels = tRep.get_levels()
+        self.lineages = {}
+        self.finished = set()
+        self.tables = []
+        self.num_genes = 0
+
+    def add(self, Bdb):
+        '''
+        Add the rows of every scaffold of these hits; each scaffold has to be complete
+        '''
+        Bdb = Bdb[Bdb['scaffold'].notna()]
+        if len(Bdb) == 0:
+            return
+
+        scaffolds = pd.unique(Bdb['scaffold'])
+        again = self.finished.intersection(scaffolds)
+        if len(again) > 0:
+            print("The hits of scaffold {0} aren't next to each other in the b6 file; run without --streaming".format(\
+                sorted(again)[0]))
+            raise Exception()
+        self.finished.update(scaffolds)
+
+        # Genes without hits (from the prodigal genes) are "unk" at every rank
+        missing = {}
+        if len(self.genes) > 0:
+            hits = Bdb.groupby('scaffold', sort=False)['querry'].unique()
+            for scaffold, querries in hits.items():
+                genes = self.genes.get(scaffold, 0)
+                assert len(querries) <= genes
+                missing[scaffold] = genes - len(querries)
+
+        self._add_table(Bdb['scaffold'], Bdb['taxID'], missing)
+        self.num_genes += Bdb['querry'].nunique() + sum(missing.values())
+
+    def finish(self, minPerc=50):
+        '''
+        Add the scaffolds that only have genes without hits, and return the table
+        '''
+        missing = {scaffold:genes for scaffold, genes in self.genes.items() if scaffold not in self.finished}
+        if len(missing) > 0:
+            self._add_table(pd.Series([], dtype=object), pd.Series([], dtype=float), missing)
+            self.num_genes += sum(missing.values())
+
+        if len(self.tables) == 0:
+            Sdb = pd.DataFrame(columns=[c for l in self.levels for c in [l + '_winner', l + '_percent']] + \
+                                       ['scaffold', 'full_taxonomy', 'taxonomy'])
+        else:
+            # gen_taxonomy_table sorts the scaffolds
+            Sdb = pd.concat(self.tables).sort_values('scaffold', kind='stable').reset_index(drop=True)
+            Sdb['full_taxonomy'], Sdb['taxonomy'] = tRep.calculate_full_taxonomies(Sdb, minPerc)
+        Sdb.attrs['genes'] = self.num_genes
+        return Sdb
+
+    def _add_table(self, scaffolds, taxIDs, missing):
+        '''
+        Add the rows of these scaffolds from the taxID of every hit and the number of genes without hits
+        '''
+        # Tdb is merged on taxID, which sorts the hits by it; ties of
+        # gen_taxonomy_table go to the name that shows up first
+        order = np.argsort(taxIDs.to_numpy(dtype=float), kind='stable')
+        scaffolds = np.concatenate([scaffolds.to_numpy(dtype=object)[order], \
+                        np.repeat(np.array(list(missing.keys()), dtype=object), list(missing.values()))])
+        taxIDs = taxIDs.to_numpy(dtype=float)[order]
+        groups, things = pd.factorize(scaffolds, sort=True)
+
+        codes, uniques = pd.factorize(taxIDs)
+        self._resolve(uniques)
+        table = {}
+        for i, level in enumerate(self.levels):
+            names = np.array([self.lineages[t][i] for t in uniques], dtype=object)
+            values = np.concatenate([names[codes], np.full(len(scaffolds) - len(taxIDs), 'unk', dtype=object)])
+            table[level + '_winner'], table[level + '_percent'] = \
+                    tRep._group_winners(groups, len(things), pd.Series(values))
+        table['scaffold'] = things
+        self.tables.append(pd.DataFrame(table))
+
+    def _resolve(self, taxIDs):
+        '''
+        Look up the names at every rank of taxIDs that haven't been seen yet (NaN if there's no lineage)
+        '''
+        new = [t for t in taxIDs if t not in self.lineages]
+        for t, names in zip(new, tRep.get_engine().rank_names(new)):
+            self.lineages[t] = names if names is not None else [np.nan] * len(self.levels)
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+
+'''
+Save and load the tables tRep makes (Tdb and the gene / scaffold / genome taxonomy tables)
+
+Tables can be written as text (.tsv / .csv) or, if pyarrow is installed, as
+Parquet or Feather. The columnar formats are compressed, store the rank columns
+dictionary-encoded (each taxon name once, plus an integer per row), and are much
+faster to read back in than text
+'''
+
+import os
+
+import pandas as pd
+
+from tRep.lineage import LEVELS
+
+OUTPUT_FORMATS = ['tsv', 'parquet', 'feather']
+
+EXTENSIONS = {'tsv':'.tsv', 'csv':'.csv', 'parquet':'.parquet', 'feather':'.feather'}
+
+# zstd is supported by both Parquet and Feather (Arrow IPC)
+COMPRESSION = 'zstd'
+
+def output_loc(out_base, name, format):
+    '''
+    Return where a table with this name and format is saved, like [out_base]_[name].tsv
+    '''
+    return out_base + '_' + name + EXTENSIONS[format]
+
+def save_table(db, loc, format='tsv'):
+    '''
+    Save a table in one of OUTPUT_FORMATS (or csv)
+    '''
+    if format == 'tsv':
+        db.to_csv(loc, index=False, sep='\t')
+    elif format == 'csv':
+        db.to_csv(loc, index=False)
+    elif format in ['parquet', 'feather']:
+        _require_pyarrow(format)
+        db = dictionary_encode(db)
+        if format == 'parquet':
+            db.to_parquet(loc, index=False, compression=COMPRESSION)
+        else:
+            db.reset_index(drop=True).to_feather(loc, compression=COMPRESSION)
+    else:
+        raise ValueError("Unknown output format {0}; choose from {1}".format(\
+            format, ', '.join(OUTPUT_FORMATS + ['csv'])))
+    return loc
+
+def load_table(loc):
+    '''
+    Load a table saved by save_table; the format is figured out from the extension
+    '''
+    format = get_format(loc)
+    if format == 'tsv':
+        return pd.read_csv(loc, sep='\t')
+    elif format == 'csv':
+        return pd.read_csv(loc)
+    elif format == 'parquet':
+        _require_pyarrow(format)
+        return pd.read_parquet(loc)
+    elif format == 'feather':
+        _require_pyarrow(format)
+        return pd.read_feather(loc)
+
+def load_tdb(loc):
+    '''
+    Load a Tdb (from make_Tdb.py or a fullGeneTaxonomy table) in any format
+    '''
+    return load_table(loc)
+
+def get_format(loc):
+    '''
+    Figure out the format of a table from its extension (text that isn't .tsv is assumed to be csv)
+    '''
+    ext = os.path.splitext(loc[:-3] if loc.endswith('.gz') else loc)[1].lower()
+    for format in ['parquet', 'feather', 'tsv']:
+        if ext == EXTENSIONS[format]:
+            return format
+    if ext in ['.pq', '.parq']:
+        return 'parquet'
+    if ext in ['.arrow', '.ftr']:
+        return 'feather'
+    return 'csv'
+
+def dictionary_encode(db):
+    '''
+    Store the rank, winner, scaffold and bin columns as categoricals, which
+    pyarrow writes dictionary-encoded
+    '''
+    db = db.copy()
+    for col in db.columns:
+        if (col in LEVELS) or col.endswith('_winner') or (col in ['scaffold', 'bin', 'taxonomy']):
+            if not isinstance(db[col].dtype, pd.CategoricalDtype):
+                db[col] = db[col].astype('category')
+    return db
+
+def _require_pyarrow(format):
+    try:
+        import pyarrow
+    except ImportError:
+        raise ImportError("Writing or reading {0} files needs pyarrow; install it with "\
+            "\"pip install pyarrow\" or use the tsv format".format(format))
@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+
+'''
+Read-only access to ete3's NCBI taxonomy database (taxa.sqlite)
+
+ete3's NCBITaxa opens a new read-write connection every time one is made, and
+one "disk I/O error" from shared storage is enough to crash a run. Here every
+process keeps one connection per database, opened in read-only URI mode, and
+queries that fail with a transient error are retried with bounded exponential
+backoff. The database is still locked while it's read, since --update (or ete3's
+update_taxonomy_database) rewrites it in place.
+
+Set the environment variable TREP_TAXDB_SCRATCH to a local directory (like
+$TMPDIR on a cluster node) to copy the database there first and read the copy;
+jobs on the same node share it. Nothing writes to the copies, so they're opened
+immutable (SQLite skips locking entirely).
+
+Every process counts its connections, queries, retries and seconds spent
+waiting to retry in the dictionary "stats" (see get_stats())
+'''
+
+import os
+import time
+import random
+import shutil
+import sqlite3
+import pathlib
+
+import pandas as pd
+
+# Number of taxIDs looked up per query (SQLite allows 999 variables per statement)
+LOOKUP_BATCH = 900
+
+# Retries of a failed query, and the seconds waited before the first and any one retry
+MAX_RETRIES = 8
+BASE_DELAY = 0.05
+MAX_DELAY = 5.0
+
+# sqlite3.OperationalError messages worth retrying
+TRANSIENT_ERRORS = ['disk i/o error', 'database is locked', 'unable to open database file', \
+                    'database table is locked', 'busy']
+
+stats = {'connections':0, 'queries':0, 'retries':0, 'wait_seconds':0.0, 'scratch_copies':0}
+
+_pool = {}
+_pool_pid = None
+
+def read_only_uri(loc, immutable=False):
+    '''
+    Return the URI to open the SQLite database at loc read-only with (quoted, so any path works)
+
+    immutable = tell SQLite that nothing will change the file, so it skips locking
+    '''
+    uri = pathlib.Path(loc).resolve().as_uri() + '?mode=ro'
+    if immutable:
+        uri += '&immutable=1'
+    return uri
+
+def get_taxdb(loc):
+    '''
+    Return the TaxDB of this process for the database at loc, opening it the first time
+    '''
+    global _pool, _pool_pid
+    # A forked process needs its own connections
+    if _pool_pid != os.getpid():
+        _pool = {}
+        _pool_pid = os.getpid()
+
+    if loc not in _pool:
+        _pool[loc] = TaxDB(loc, scratch_dir=os.environ.get('TREP_TAXDB_SCRATCH', None))
+    return _pool[loc]
+
+def close():
+    '''
+    Close every connection of this process (for example, before the database is updated)
+    '''
+    global _pool
+    if _pool_pid == os.getpid():
+        for taxdb in _pool.values():
+            taxdb.close()
+    _pool = {}
+
+def replace(taxdb):
+    '''
+    Make taxdb the TaxDB of this process for its database
+
+    The old one isn't closed, so queries that are running on it can finish
+    '''
+    global _pool, _pool_pid
+    if _pool_pid != os.getpid():
+        _pool = {}
+        _pool_pid = os.getpid()
+    _pool = dict(_pool)
+    _pool[taxdb.loc] = taxdb
+
+def get_stats():
+    return dict(stats)
+
+def reset_stats():
+    for key in stats:
+        stats[key] = 0 if key != 'wait_seconds' else 0.0
+
+def stats_message(stats=stats):
+    return "{0} taxonomy database queries; {1} retried after errors, {2:.1f} seconds spent waiting to retry".format(\
+        stats['queries'], stats['retries'], stats['wait_seconds'])
+
+def is_transient(error):
+    message = str(error).lower()
+    return any(e in message for e in TRANSIENT_ERRORS)
+
+def retry(function, *args):
+    '''
+    Call function(*args), retrying with exponential backoff after transient SQLite or file system errors
+    '''
+    attempt = 0
+    while True:
+        try:
+            return function(*args)
+        except (sqlite3.OperationalError, OSError) as e:
+            if (attempt >= MAX_RETRIES) or \
+                    (isinstance(e, sqlite3.OperationalError) and not is_transient(e)):
+                raise
+            # Jittered, so that jobs which failed together don't all retry together
+            delay = min(BASE_DELAY * (2 ** attempt), MAX_DELAY) * random.uniform(0.5, 1.0)
+            stats['retries'] += 1
+            stats['wait_seconds'] += delay
+            time.sleep(delay)
+            attempt += 1
+
+def scratch_copy(loc, scratch_dir):
+    '''
+    Copy the database at loc into scratch_dir (unless an up-to-date copy is already
+    there) and return the location of the copy
+    '''
+    stat = os.stat(loc)
+    copy_loc = os.path.join(scratch_dir, 'tRep_taxa_{0}_{1}.sqlite'.format(stat.st_size, stat.st_mtime_ns))
+    if os.path.isfile(copy_loc) and (os.path.getsize(copy_loc) == stat.st_size):
+        return copy_loc
+
+    # Copied under a temporary name first so other jobs never see a partial copy
+    os.makedirs(scratch_dir, exist_ok=True)
+    tmp_loc = '{0}.{1}.tmp'.format(copy_loc, os.getpid())
+    try:
+        shutil.copyfile(loc, tmp_loc)
+        os.replace(tmp_loc, copy_loc)
+    finally:
+        if os.path.exists(tmp_loc):
+            os.remove(tmp_loc)
+    stats['scratch_copies'] += 1
+    return copy_loc
+
+class TaxDB():
+    '''
+    One read-only connection to a taxonomy database, reopened after errors
+
+    The queries give the same answers as ete3's NCBITaxa methods of the same purpose
+    '''
+    def __init__(self, loc, scratch_dir=None):
+        self.loc = loc
+        self.scratch_dir = scratch_dir
+        self.conn = None
+
+    def connect(self):
+        if self.conn is None:
+            uri = read_only_uri(self.loc)
+            if self.scratch_dir is not None:
+                uri = read_only_uri(retry(scratch_copy, self.loc, self.scratch_dir), immutable=True)
+            self.conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+            stats['connections'] += 1
+        return self.conn
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def query(self, sql, params=()):
+        '''
+        Return all rows of a query
+        '''
+        stats['queries'] += 1
+        return retry(self._query, sql, params)
+
+    def _query(self, sql, params):
+        try:
+            return self.connect().execute(sql, params).fetchall()
+        except sqlite3.OperationalError:
+            # Start over with a fresh connection
+            self.close()
+            raise
+
+    def read_table(self, sql):
+        '''
+        Return the result of a query as a DataFrame
+        '''
+        stats['queries'] += 1
+        return retry(self._read_table, sql)
+
+    def _read_table(self, sql):
+        try:
+            return pd.read_sql_query(sql, self.connect())
+        except sqlite3.OperationalError:
+            self.close()
+            raise
+
+    def lineage(self, taxid):
+        '''
+        Return the taxIDs of the lineage of taxid from the root down, like ete3's get_lineage
+
+        Merged (obsolete) taxIDs are translated; raises a ValueError if taxid can't be found
+        (or isn't a whole number)
+        '''
+        if not float(taxid).is_integer():
+            raise ValueError("%s taxid not found" % taxid)
+        taxid = int(float(taxid))
+        rows = self.query('SELECT track FROM species WHERE taxid = ?', (taxid,))
+        if len(rows) == 0:
+            merged = self.query('SELECT taxid_new FROM merged WHERE taxid_old = ?', (taxid,))
+            if len(merged) > 0:
+                rows = self.query('SELECT track FROM species WHERE taxid = ?', (merged[0][0],))
+            if len(rows) == 0:
+                raise ValueError("%s taxid not found" % taxid)
+        return [int(t) for t in reversed(rows[0][0].split(','))]
+
+    def names(self, taxids):
+        '''
+        Return a dictionary of taxID -> scientific name
+        '''
+        return dict(self._lookup('SELECT taxid, spname FROM species WHERE taxid IN ({0})', taxids))
+
+    def ranks(self, taxids):
+        '''
+        Return a dictionary of taxID -> rank
+        '''
+        return dict(self._lookup('SELECT taxid, rank FROM species WHERE taxid IN ({0})', taxids))
+
+    def _lookup(self, sql, taxids):
+        taxids = sorted(set(int(t) for t in taxids))
+        rows = []
+        for i in range(0, len(taxids), LOOKUP_BATCH):
+            batch = taxids[i:i + LOOKUP_BATCH]
+            rows += self.query(sql.format(','.join(['?'] * len(batch))), batch)
+        return rows
@@ -0,0 +1,362 @@
+#!/usr/bin/env python
+
+'''
+Look up functional annotations in a translation table (like uniref100.ttable.gz)
+
+A translation table is a gzipped, tab-separated file of ID -> annotation. Reading
+one means decompressing the whole thing, so build_index() can be run once to
+write an SQLite index next to it (<ttable>.idx); after that load_annotations()
+only has to look up the IDs it's asked about
+
+Without an index, a table compressed as BGZF (blocked gzip, like from bgzip or
+bin/bgzip_ttable.py) can be scanned by several processes at once, each taking
+its own range of blocks. A regular gzip file can only be read start to finish
+'''
+
+import os
+import gzip
+import zlib
+import struct
+import sqlite3
+import threading
+import multiprocessing
+
+import tRep.taxdb
+
+# Number of IDs looked up per query (SQLite allows 999 variables per statement)
+LOOKUP_BATCH = 900
+
+# Number of lines inserted per transaction while building the index
+INSERT_BATCH = 100000
+
+# Bytes of uncompressed data per BGZF block (the same as bgzip uses)
+BGZF_BLOCK_SIZE = 65280
+
+# Compressed bytes of a BGZF file handed to a worker at a time
+SCAN_CHUNK = 8 * 1024 * 1024
+
+# The empty block that marks the end of a BGZF file
+BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+# Open index connections of this thread (see _get_index_conn)
+_local = threading.local()
+
+def get_index_loc(tt_loc):
+    return tt_loc + '.idx'
+
+def load_annotations(tt_loc, hits, index_loc=None, processes=1):
+    '''
+    Return a dictionary of ID -> annotation for every ID in hits found in the translation table
+
+    Uses the index if there is an up-to-date one, and scans the whole table otherwise
+    (with multiple processes if the table is BGZF compressed)
+    '''
+    if index_loc is None:
+        index_loc = get_index_loc(tt_loc)
+
+    if index_is_current(tt_loc, index_loc):
+        return lookup_index(index_loc, hits)
+    elif (processes > 1) and is_bgzf(tt_loc):
+        return scan_bgzf(tt_loc, hits, processes)
+    else:
+        return scan_ttable(tt_loc, hits)
+
+def scan_ttable(tt_loc, hits):
+    '''
+    Decompress and read the whole translation table, keeping lines with IDs in hits
+    '''
+    r2t = dict()
+    assert type(hits) == type(set(hits))
+
+    with gzip.open(tt_loc, 'rt') as f:
+        for line in f:
+            if line.split('\t')[0] in hits:
+                linewords = line.strip().split('\t')
+                r2t[linewords[0]] = linewords[1]
+    return r2t
+
+def scan_bgzf(tt_loc, hits, processes):
+    '''
+    scan_ttable for a BGZF file, with the blocks split up between processes
+
+    Chunks of blocks don't start and end on line boundaries, so each worker hands
+    back the partial lines at the start and end of its chunk to be stitched
+    together here, in order
+    '''
+    assert type(hits) == type(set(hits))
+    chunks = split_bgzf(tt_loc, SCAN_CHUNK)
+
+    r2t = dict()
+    carry = b''
+    with _get_context().Pool(processes, initializer=_init_scan_worker, \
+                initargs=(tt_loc, hits)) as pool:
+        for head, matches, tail in pool.imap(_scan_chunk, chunks):
+            if tail is None:
+                # this chunk is all one piece of a line
+                carry += head
+                continue
+            _match_lines([(carry + head).decode('utf-8')], hits, r2t)
+            r2t.update(matches)
+            carry = tail
+    _match_lines([carry.decode('utf-8')], hits, r2t)
+
+    return r2t
+
+def _get_context():
+    '''
+    Forking from any thread but the main one (like a request of trep_server.py) copies
+    the locks other threads hold, and can deadlock; start fresh processes instead
+    '''
+    if threading.current_thread() is threading.main_thread():
+        return multiprocessing
+    return multiprocessing.get_context('spawn')
+
+_scan_worker = {}
+
+def _init_scan_worker(tt_loc, hits):
+    _scan_worker['tt_loc'] = tt_loc
+    _scan_worker['hits'] = hits
+
+def _scan_chunk(chunk):
+    '''
+    Decompress bytes [start, end) of the BGZF file and find the hits in it
+
+    Returns the bytes before the first newline, a dictionary of hits in the whole
+    lines, and the bytes after the last newline (None if there is no newline)
+    '''
+    start, end = chunk
+    with open(_scan_worker['tt_loc'], 'rb') as f:
+        f.seek(start)
+        data = _inflate_bgzf(f.read(end - start))
+
+    first = data.find(b'\n')
+    if first == -1:
+        return data, {}, None
+    last = data.rfind(b'\n')
+
+    r2t = dict()
+    _match_lines(data[first + 1:last].decode('utf-8').split('\n'), _scan_worker['hits'], r2t)
+    return data[:first], r2t, data[last + 1:]
+
+def _match_lines(lines, hits, r2t):
+    for line in lines:
+        if line.split('\t')[0] in hits:
+            linewords = line.strip().split('\t')
+            if len(linewords) > 1:
+                r2t[linewords[0]] = linewords[1]
+
+def is_bgzf(loc):
+    '''
+    Return True if the file starts with a BGZF block
+    '''
+    with open(loc, 'rb') as f:
+        return _read_bgzf_block_size(f) is not None
+
+def split_bgzf(loc, chunk_size):
+    '''
+    Return a list of (start, end) byte ranges of a BGZF file, each made of whole
+    blocks and about chunk_size long
+
+    Only the block headers are read, so this is quick even for huge files
+    '''
+    chunks = []
+    total = os.path.getsize(loc)
+    with open(loc, 'rb') as f:
+        start = 0
+        offset = 0
+        while offset < total:
+            f.seek(offset)
+            size = _read_bgzf_block_size(f)
+            if size is None:
+                raise ValueError('{0} is not BGZF compressed past byte {1}'.format(loc, offset))
+            offset += size
+            if offset - start >= chunk_size:
+                chunks.append((start, offset))
+                start = offset
+        if offset > start:
+            chunks.append((start, offset))
+    return chunks
+
+def _read_bgzf_block_size(f):
+    '''
+    Read the header of the gzip member at the current position of a file, and
+    return the size of the whole member (None if it's not a BGZF block)
+    '''
+    header = f.read(12)
+    if len(header) == 12:
+        header += f.read(struct.unpack('<H', header[10:12])[0])
+    return _bgzf_block_size(header)
+
+def _bgzf_block_size(header):
+    '''
+    Return the size of a whole BGZF block from the "BC" field of its header
+    (None if it has none)
+    '''
+    if (len(header) < 12) or (header[:4] != b'\x1f\x8b\x08\x04'):
+        return None
+    extra = header[12:12 + struct.unpack('<H', header[10:12])[0]]
+
+    i = 0
+    while i + 4 <= len(extra):
+        slen = struct.unpack('<H', extra[i + 2:i + 4])[0]
+        if (extra[i:i + 2] == b'BC') and (slen == 2):
+            return struct.unpack('<H', extra[i + 4:i + 6])[0] + 1
+        i += 4 + slen
+    return None
+
+def _inflate_bgzf(data):
+    '''
+    Decompress a run of whole BGZF blocks
+
+    gzip.decompress() works too, but copies the rest of the data after every
+    member, which is very slow for thousands of small ones
+    '''
+    view = memoryview(data)
+    parts = []
+    pos = 0
+    while pos < len(data):
+        xlen = struct.unpack('<H', view[pos + 10:pos + 12])[0]
+        size = _bgzf_block_size(bytes(view[pos:pos + 12 + xlen]))
+        parts.append(zlib.decompress(view[pos:pos + size], 31))
+        pos += size
+    return b''.join(parts)
+
+def write_bgzf(handle, out_loc, level=6):
+    '''
+    Write everything read from a binary file handle to out_loc as BGZF
+
+    Files written this way are still regular gzip files to everything else
+    '''
+    with open(out_loc, 'wb') as o:
+        while True:
+            data = handle.read(BGZF_BLOCK_SIZE)
+            if not data:
+                break
+            o.write(_bgzf_block(data, level))
+        o.write(BGZF_EOF)
+
+def _bgzf_block(data, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    compressed = compressor.compress(data) + compressor.flush()
+
+    header = b'\x1f\x8b\x08\x04' + b'\x00' * 4 + b'\x00\xff' \
+        + struct.pack('<H', 6) + b'BC' + struct.pack('<HH', 2, len(compressed) + 25)
+    footer = struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data))
+    return header + compressed + footer
+
+def iter_ttable(tt_loc):
+    '''
+    Yield (ID, annotation) for every line of the translation table
+    '''
+    with gzip.open(tt_loc, 'rt') as f:
+        for line in f:
+            linewords = line.strip().split('\t')
+            if len(linewords) < 2:
+                continue
+            yield linewords[0], linewords[1]
+
+def build_index(tt_loc, index_loc=None):
+    '''
+    Write an SQLite index of the translation table
+
+    The size and modification time of the table are stored with the index, so a
+    stale index (the table was replaced after indexing) is ignored rather than used
+    '''
+    if index_loc is None:
+        index_loc = get_index_loc(tt_loc)
+
+    # Write to a temporary file so a half-built index is never picked up
+    tmp_loc = index_loc + '.tmp'
+    if os.path.exists(tmp_loc):
+        os.remove(tmp_loc)
+
+    conn = sqlite3.connect(tmp_loc)
+    conn.execute('PRAGMA journal_mode = OFF')
+    conn.execute('PRAGMA synchronous = OFF')
+    conn.execute('CREATE TABLE ttable (ID TEXT, annotation TEXT)')
+    conn.execute('CREATE TABLE info (key TEXT PRIMARY KEY, value TEXT)')
+
+    count = 0
+    batch = []
+    for item in iter_ttable(tt_loc):
+        batch.append(item)
+        if len(batch) >= INSERT_BATCH:
+            conn.executemany('INSERT INTO ttable VALUES (?, ?)', batch)
+            conn.commit()
+            count += len(batch)
+            batch = []
+    conn.executemany('INSERT INTO ttable VALUES (?, ?)', batch)
+    count += len(batch)
+
+    # Indexing once at the end is much faster than keeping a sorted table while inserting
+    conn.execute('CREATE INDEX ttable_ID ON ttable (ID)')
+
+    size, mtime = _fingerprint(tt_loc)
+    conn.executemany('INSERT INTO info VALUES (?, ?)', \
+        [('size', str(size)), ('mtime', str(mtime)), ('lines', str(count))])
+    conn.commit()
+    conn.close()
+
+    os.replace(tmp_loc, index_loc)
+    return count
+
+def index_is_current(tt_loc, index_loc):
+    '''
+    Return True if there's an index of this version of the translation table
+    '''
+    if not os.path.isfile(index_loc):
+        return False
+
+    try:
+        conn = sqlite3.connect(tRep.taxdb.read_only_uri(index_loc), uri=True)
+        info = dict(conn.execute('SELECT key, value FROM info').fetchall())
+        conn.close()
+    except sqlite3.Error:
+        return False
+
+    size, mtime = _fingerprint(tt_loc)
+    return (info.get('size') == str(size)) and (info.get('mtime') == str(mtime))
+
+def lookup_index(index_loc, hits):
+    '''
+    Return a dictionary of ID -> annotation for every ID in hits found in the index
+    '''
+    r2t = dict()
+    hits = list(hits)
+
+    conn = _get_index_conn(index_loc)
+    for i in range(0, len(hits), LOOKUP_BATCH):
+        batch = hits[i:i + LOOKUP_BATCH]
+        # Ordered by rowid so that, as with a scan, the last line of a repeated ID wins
+        query = 'SELECT ID, annotation FROM ttable WHERE ID IN ({0}) ORDER BY rowid'\
+                    .format(','.join(['?'] * len(batch)))
+        for ID, annotation in conn.execute(query, batch):
+            r2t[ID] = annotation
+
+    return r2t
+
+def _get_index_conn(index_loc):
+    '''
+    Return a read-only connection to an index, kept open for later lookups (like those of trep_server.py)
+
+    Connections belong to one process and thread, and are reopened if the index is rebuilt
+    '''
+    conns = getattr(_local, 'conns', None)
+    if (conns is None) or (_local.pid != os.getpid()):
+        conns = _local.conns = {}
+        _local.pid = os.getpid()
+
+    fingerprint = _fingerprint(index_loc)
+    if index_loc in conns:
+        conn, known = conns[index_loc]
+        if known == fingerprint:
+            return conn
+        conn.close()
+
+    conn = sqlite3.connect(tRep.taxdb.read_only_uri(index_loc), uri=True)
+    conns[index_loc] = (conn, fingerprint)
+    return conn
+
+def _fingerprint(loc):
+    stat = os.stat(loc)
+    return stat.st_size, stat.st_mtime_ns
@@ -3,15 +3,31 @@
 Run test of tRep
 '''
 
+import io
 import os
 import glob
+import gzip
+import json
 import shutil
+import sqlite3
+import tempfile
+import time
+import threading
+import contextlib
 
 import pandas as pd
-from subprocess import call
+from subprocess import call, check_output, Popen
 
 import tRep
 import tRep.controller
+import tRep.engine
+import tRep.pipeline
+import tRep.lineage
+import tRep.server
+import tRep.streaming
+import tRep.taxdb
+import tRep.ttable
+import tRep.table_io
 
 def load_b6_loc():
     return os.path.join(str(os.getcwd()), \
@@ -52,6 +68,12 @@ def get_script_loc(script):
     elif script == 'functional_tax.py':
         return os.path.join(str(os.getcwd()), \
             'bin/functional_tax.py')
+    elif script == 'bgzip_ttable.py':
+        return os.path.join(str(os.getcwd()), \
+            'bin/bgzip_ttable.py')
+    elif script == 'trep_server.py':
+        return os.path.join(str(os.getcwd()), \
+            'bin/trep_server.py')
 
 class testUniProt():
     def setUp(self):
@@ -67,6 +89,21 @@ class testUniProt():
         self.main_test_2()
         self.main_test_3()
         self.main_test_4()
+        self.main_test_5()
+        self.main_test_6()
+        self.main_test_7()
+        self.main_test_8()
+        self.main_test_9()
+        self.main_test_10()
+        self.main_test_11()
+        self.main_test_12()
+        self.main_test_13()
+        self.main_test_14()
+        self.main_test_15()
+        self.main_test_16()
+        self.main_test_17()
+        self.main_test_18()
+        self.main_test_19()
         self.tearDown()
 
     def main_test_1(self):
@@ -147,6 +184,531 @@ class testUniProt():
 
             assert my_tax == gg_tax
 
+    def main_test_5(self):
+        '''
+        Make sure the lineage index gives the same answer as asking ete3 one taxID at a time
+        '''
+        Bdb = tRep.load_b6(load_testdir() + 'N4_005_008G1_Pseudomonas_aeruginosa_66_425.proteins.translated.diamondOut')
+        hits = list(Bdb['taxID'].unique()) + [0, 2.0, 9999999999.0]
+        tax = tRep.gen_levels_db(hits)
+
+        for i, row in tax.iterrows():
+            lin = tRep.ncbi.get_lineage(row['taxID'])
+            lin2name = tRep.ncbi.get_taxid_translator(lin)
+            rank2name = {v: k for k, v in tRep.ncbi.get_rank(lin).items()}
+            for level in tRep.get_levels():
+                if level in rank2name:
+                    assert row[level] == lin2name[rank2name[level]]
+                else:
+                    assert row[level] == 'unk'
+
+    def main_test_6(self):
+        '''
+        Test winners, ties and empty groups in gen_taxonomy_table
+        '''
+        Tdb = pd.DataFrame({'scaffold':['b', 'a', 'b', 'a', 'b', 'c', 'b']})
+        for level in tRep.get_levels():
+            Tdb[level] = ['x', 'y', 'y', 'x', 'x', None, None]
+        Tdb['species'] = ['unk', 'y', 'y', 'x', 'x', None, 'y']
+
+        Sdb = tRep.gen_taxonomy_table(Tdb, on='scaffold').set_index('scaffold')
+        assert Sdb.index.tolist() == ['a', 'b', 'c']
+
+        # a is a tie, which goes to whatever shows up first
+        assert Sdb.loc['a', 'genus_winner'] == 'y'
+        assert Sdb.loc['a', 'genus_percent'] == 50
+        assert Sdb.loc['b', 'genus_winner'] == 'x'
+        assert abs(Sdb.loc['b', 'genus_percent'] - (2/3 * 100)) < 1e-9
+        assert Sdb.loc['b', 'species_winner'] == 'y'
+        assert Sdb.loc['b', 'species_percent'] == 50
+
+        # c has no hits at all
+        assert Sdb.loc['c', 'genus_winner'] == 'unk'
+        assert Sdb.loc['c', 'genus_percent'] == 100
+        assert Sdb.loc['c', 'taxonomy'] == 'unk'
+
+        assert Sdb.loc['a', 'full_taxonomy'] == 'y|y|y|y|y|y|y'
+        assert Sdb.loc['b', 'full_taxonomy'] == 'x|x|x|x|x|x|y'
+        assert Sdb.loc['b', 'taxonomy'] == 'y'
+
+        # The same answer from the compact (categorical) Tdb
+        Cdb = tRep.compact_tdb(Tdb.copy())
+        assert Cdb['genus'].dtype == Cdb['species'].dtype
+        Sdb2 = tRep.gen_taxonomy_table(Cdb, on='scaffold').set_index('scaffold')
+        assert Sdb.astype(str).values.tolist() == Sdb2.astype(str).values.tolist()
+
+    def main_test_7(self):
+        '''
+        Make sure the column-wise b6 parsers agree with the line-by-line ones
+        '''
+        extras = pd.Series(['Protein X {ECO:0000313};  TaxID=286 species="Bacteria; Firmicutes;" source="C sp.;"',
+                            'no taxID here', 'a; TaxID=12x', 'a;TaxID=1_000', 'a; TaxID=', None])
+        db = tRep.parse_b6_column(extras)
+        for i, extra in enumerate(extras):
+            if pd.isna(extra):
+                continue
+            anno, taxID, taxString = tRep.parse_b6(extra)
+            assert db['annotation'][i] == anno
+            assert db['taxString'][i] == taxString
+            assert (db['taxID'][i] == taxID) or (pd.isna(db['taxID'][i]) and pd.isna(taxID))
+
+        targets = pd.Series(['A0A0F7QWA2_9CLOT_286_1239', 'UniRef100_X_12', 'bad_target'])
+        for tax_type in ['species', 'group']:
+            taxIDs = tRep.parse_diamond_column(targets, tax_type)
+            for i, target in enumerate(targets):
+                taxID = tRep.parse_diamond(target, tax_type)
+                assert (taxIDs[i] == taxID) or (pd.isna(taxIDs[i]) and pd.isna(taxID))
+
+    def main_test_8(self):
+        '''
+        Make sure lineages from the on-disk cache are the same as freshly resolved ones
+        '''
+        Bdb = tRep.load_b6(load_testdir() + 'N4_005_008G1_Pseudomonas_aeruginosa_66_425.proteins.translated.diamondOut')
+        hits = list(Bdb['taxID'].dropna().unique()) + [0, 9999999999.0]
+
+        cache_dir = tempfile.mkdtemp()
+        os.environ['TREP_LINEAGE_CACHE'] = os.path.join(cache_dir, 'cache.sqlite')
+        try:
+            tRep.lineage_cache._local.cache = None
+            tRep.get_engine().clear()
+            cold = tRep.gen_levels_db(hits)
+            cache = tRep.lineage_cache.get_cache(tRep.get_taxdb_loc())
+            assert len(cache) == len(hits) - 1
+            assert cache.hits == 0
+
+            # (the engine would otherwise remember them without asking the cache)
+            tRep.get_engine().clear()
+            warm = tRep.gen_levels_db(hits)
+            assert cache.hits == len(hits) - 1
+            assert cold.equals(warm)
+
+            assert tRep.lineage_from_taxId(hits[0]) == tRep.lineage_from_taxId(hits[0])
+
+            # Reading lineages used recently doesn't write; old ones get touched
+            changes = cache.conn.total_changes
+            cache.get([int(t) for t in hits[:5]])
+            assert cache.conn.total_changes == changes
+            cache.conn.execute('UPDATE lineages SET last_used = 0')
+            changes = cache.conn.total_changes
+            cache.get([int(t) for t in hits[:5]])
+            assert cache.conn.total_changes == changes + 5
+            assert cache.conn.execute('SELECT COUNT(*) FROM lineages WHERE last_used > 0').fetchone()[0] == 5
+
+            # A different version of the taxonomy empties the cache
+            cache = tRep.lineage_cache.LineageCache(cache.loc, 'new_fingerprint')
+            assert len(cache) == 0
+        finally:
+            del os.environ['TREP_LINEAGE_CACHE']
+            tRep.lineage_cache._local.cache = None
+            shutil.rmtree(cache_dir)
+
+    def main_test_9(self):
+        '''
+        Make sure repeated taxIDs count once per hit in gen_taxonomy_string and gen_full_tdb
+        '''
+        Bdb = tRep.load_b6(load_testdir() + 'N4_005_008G1_Pseudomonas_aeruginosa_66_425.proteins.translated.diamondOut')
+        hits = list(Bdb['taxID'].dropna().unique())
+        hits = [h for h, e in zip(hits, tRep.get_lineages(hits)) if e is not None][:20]
+        repeated = [h for h in hits for i in range(3)]
+
+        string, counts = tRep.gen_taxonomy_string(hits, testing=True)
+        repeated_string, repeated_counts = tRep.gen_taxonomy_string(repeated, testing=True)
+        assert string == repeated_string
+        for level in counts:
+            assert list(counts[level].keys()) == list(repeated_counts[level].keys())
+            for name, count in counts[level].items():
+                assert repeated_counts[level][name] == count * 3
+
+        assert tRep.gen_full_tdb(pd.DataFrame({'taxID':hits})).equals(
+            tRep.gen_full_tdb(pd.DataFrame({'taxID':repeated})))
+
+    def main_test_10(self):
+        '''
+        Test the read-only taxonomy database access (retries and scratch copies)
+        '''
+        taxid = 287
+        loc = tRep.get_taxdb().loc
+        assert tRep.get_taxdb().lineage(taxid) == tRep.ncbi.get_lineage(taxid)
+
+        # Transient errors are retried, with the retries counted
+        failures = [sqlite3.OperationalError('disk I/O error')] * 2
+        def flaky():
+            if len(failures) > 0:
+                raise failures.pop()
+            return 'done'
+        before = tRep.taxdb.get_stats()
+        assert tRep.taxdb.retry(flaky) == 'done'
+        assert tRep.taxdb.stats['retries'] - before['retries'] == 2
+        assert tRep.taxdb.stats['wait_seconds'] > before['wait_seconds']
+
+        # Other errors are not
+        def broken():
+            raise sqlite3.OperationalError('no such table: species')
+        try:
+            tRep.taxdb.retry(broken)
+            assert False
+        except sqlite3.OperationalError:
+            pass
+        assert tRep.taxdb.stats['retries'] - before['retries'] == 2
+
+        # Reading from a copy in a scratch directory
+        scratch_dir = tempfile.mkdtemp()
+        try:
+            taxdb = tRep.taxdb.TaxDB(loc, scratch_dir=scratch_dir)
+            assert taxdb.lineage(taxid) == tRep.ncbi.get_lineage(taxid)
+            assert len(glob.glob(os.path.join(scratch_dir, '*.sqlite'))) == 1
+            taxdb.close()
+
+            # A database that's rewritten in place (like by --update) is read as it is now
+            copy_loc = os.path.join(scratch_dir, 'taxa?#%20.sqlite')
+            shutil.copyfile(loc, copy_loc)
+            taxdb = tRep.taxdb.TaxDB(copy_loc)
+            assert taxdb.names([taxid]) == tRep.get_taxdb().names([taxid])
+            with sqlite3.connect(copy_loc) as conn:
+                conn.execute('UPDATE species SET spname = ? WHERE taxid = ?', ('renamed', taxid))
+            assert taxdb.names([taxid]) == {taxid:'renamed'}
+            taxdb.close()
+        finally:
+            shutil.rmtree(scratch_dir)
+
+    def main_test_11(self):
+        '''
+        Make sure a LineageIndex read straight from a taxdump is the same as one from ete3's database of it
+        '''
+        from ete3 import NCBITaxa
+        taxdump = os.path.join(str(os.getcwd()), 'benchmarks/data/taxdump.tar.gz')
+        index = tRep.lineage.LineageIndex.from_taxdump(taxdump)
+
+        db_dir = tempfile.mkdtemp()
+        try:
+            dbfile = os.path.join(db_dir, 'taxa.sqlite')
+            NCBITaxa(dbfile=dbfile, taxdump_file=taxdump)
+            ete3_index = tRep.lineage.LineageIndex.from_taxdb(tRep.taxdb.TaxDB(dbfile))
+
+            taxids = list(range(len(index.parent))) + [len(index.parent) + 10]
+            assert index.lineage_entries(taxids) == ete3_index.lineage_entries(taxids)
+            assert index.levels_table(taxids).equals(ete3_index.levels_table(taxids))
+        finally:
+            shutil.rmtree(db_dir)
+
+    def main_test_12(self):
+        '''
+        Make sure parse_prodigal_genes gets the same genes as Biopython, gzipped or not, in any size of block
+        '''
+        from Bio import SeqIO
+        aa_loc = load_testdir() + 'N4_005_008G1_Pseudomonas_aeruginosa_66_425.proteins.faa'
+        genes = [record.id for record in SeqIO.parse(aa_loc, 'fasta')]
+
+        Gdb = tRep.parse_prodigal_genes(aa_loc)
+        assert Gdb['gene'].tolist() == genes
+        assert Gdb['scaffold'].tolist() == ["_".join(g.split("_")[:-1]) for g in genes]
+
+        gz_dir = tempfile.mkdtemp()
+        block = tRep.FASTA_BLOCK
+        try:
+            gz_loc = os.path.join(gz_dir, 'genes.faa.gz')
+            with open(aa_loc, 'rb') as f, gzip.open(gz_loc, 'wb') as o:
+                shutil.copyfileobj(f, o)
+            assert tRep.parse_prodigal_genes(gz_loc).equals(Gdb)
+
+            tRep.FASTA_BLOCK = 7
+            assert tRep.get_fasta_ids(aa_loc) == genes
+            assert tRep.get_fasta_ids(gz_loc) == genes
+        finally:
+            tRep.FASTA_BLOCK = block
+            shutil.rmtree(gz_dir)
+
+    def main_test_13(self):
+        '''
+        Make sure add_scaffolds parses querries like extract_diamond_scaffold, and reports the ones it can't once
+        '''
+        querries = ['scaf_1_12|scaf_1|x', 'scaf 2_3', 'a_b|c_7', 'weird|name', 'weird|name', 'odd_x|y_z', 'scaf_1_13']
+        Tdb = pd.DataFrame({'querry':querries})
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            Tdb = tRep.controller.add_scaffolds(Tdb, 'diamond')
+        assert [s if isinstance(s, str) else None for s in Tdb['scaffold']] == \
+                [tRep.controller.extract_diamond_scaffold(q) for q in querries]
+        assert output.getvalue().count('I dont know how to parse') == 1
+        assert '2 genes' in output.getvalue()
+
+        # Scaffolds that are already there are kept
+        Tdb = pd.DataFrame({'querry':['a_1', 'b_2'], 'scaffold':['kept', None]})
+        assert tRep.controller.add_scaffolds(Tdb, 'b6+')['scaffold'].tolist() == ['kept', 'b']
+
+    def main_test_14(self):
+        '''
+        Make sure load_stb_table and add_bin_to_tdb give every scaffold the bin load_stb does
+        '''
+        stb_loc = load_testdir() + 'part02.stb.txt'
+        s2b = tRep.load_stb(stb_loc)
+        stb = tRep.load_stb_table(stb_loc)
+        assert dict(zip(stb['scaffold'], stb['bin'].astype(str))) == s2b
+        assert list(stb['bin'].cat.categories) == sorted(set(s2b.values()))
+
+        # Some scaffolds aren't in the stb, and some genes don't have a scaffold
+        scaffolds = list(s2b.keys())[:50] + ['not_in_the_stb', None]
+        Tdb = pd.DataFrame({'scaffold':scaffolds * 3})
+        expected = [s2b.get(s, 'unk') for s in Tdb['scaffold']]
+        for s in [stb_loc, s2b, stb]:
+            for db in [Tdb.copy(), Tdb.astype({'scaffold':'category'})]:
+                bins = tRep.add_bin_to_tdb(db, s)['bin']
+                assert isinstance(bins.dtype, pd.CategoricalDtype)
+                assert bins.astype(str).tolist() == expected
+
+        # Bins don't have to be strings
+        for s2b_numbers in [{s:i % 3 for i, s in enumerate(s2b)}, {s:(i % 3 if i % 2 else 'b') for i, s in enumerate(s2b)}]:
+            bins = tRep.add_bin_to_tdb(Tdb.copy(), s2b_numbers)['bin']
+            assert bins.tolist() == [s2b_numbers.get(s, 'unk') for s in Tdb['scaffold']]
+
+    def main_test_15(self):
+        '''
+        Make sure a TaxonomyEngine resolves each taxID once, and classifies like the module functions
+        '''
+        diamond_loc = load_testdir() + 'N4_005_008G1_Pseudomonas_aeruginosa_66_425.proteins.translated.diamondOut'
+        Bdb = tRep.load_b6(diamond_loc)
+        Bdb = Bdb[~Bdb['taxID'].isna()]
+        hits = list(Bdb['taxID'].unique()) + [0, 9999999999.0]
+
+        engine = tRep.engine.TaxonomyEngine()
+        levels = engine.levels_db(hits)
+        assert engine.stats['resolved'] == len(hits) - 1
+        assert engine.levels_db(hits).equals(levels)
+        assert engine.stats['resolved'] == len(hits) - 1
+        assert levels.equals(tRep.gen_levels_db(hits))
+        assert engine.lineage_string(hits[0]) == tRep.lineage_from_taxId(hits[0])
+        assert engine.taxonomy_string(Bdb['taxID']) == tRep.gen_taxonomy_string(Bdb['taxID'])
+
+        # An engine with its own lineage index gets the same lineages
+        indexed = tRep.engine.TaxonomyEngine(lineage_index=tRep.lineage.LineageIndex.from_taxdb(tRep.get_taxdb()))
+        assert indexed.lineages(hits) == engine.lineages(hits)
+
+        # Every Tdb of an engine is coded with one dictionary of names
+        Tdb = engine.classify_hits(Bdb.copy(), type='diamond')
+        Sdb = tRep.gen_taxonomy_table(tRep.controller.convert_b6_to_Tdb({'b6_loc':diamond_loc}), on='scaffold')
+        assert engine.classify_tdb(Tdb, on='scaffold').equals(Sdb)
+
+        half = engine.classify_hits(Bdb[:len(Bdb) // 2].copy(), type='diamond')
+        assert half['species'].dtype == Tdb['species'].dtype
+        both = pd.concat([half, Tdb])
+        assert isinstance(both['species'].dtype, pd.CategoricalDtype)
+
+        # The memo only keeps the most recently used lineages, and threads don't lose counts
+        small = tRep.engine.TaxonomyEngine(max_entries=3)
+        assert small.rank_names(hits) == engine.rank_names(hits)
+        assert len(small.entries) == 3
+        assert len(small.rank_memo) <= 3
+        assert small.stats['forgotten'] == len(hits) - 1 - 3
+        kept = list(small.entries.keys())
+        assert small.lineages(kept) == engine.lineages(kept)
+        assert small.stats['resolved'] == len(hits) - 1
+
+        threads = [threading.Thread(target=lambda: [small.lineages(hits[:5]) for i in range(20)]) for t in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert small.stats['lookups'] == len(hits) + 3 + 4 * 20 * 5
+        assert small.stats['memo_hits'] + small.stats['resolved'] == small.stats['lookups']
+
+    def main_test_16(self):
+        '''
+        Make sure the from_fasta pipeline keeps to its threads, calls genes while classifying, and cleans up
+        '''
+        tmp_dir = tempfile.mkdtemp()
+        log = []
+        used = {'now':0, 'most':0}
+        lock = threading.Lock()
+
+        def use(threads, event, item):
+            with lock:
+                used['now'] += threads
+                used['most'] = max(used['most'], used['now'])
+                log.append((event, item))
+
+        def call_genes(item, scratch):
+            use(1, 'genes', item)
+            time.sleep(0.05)
+            use(-1, 'called', item)
+            if item == 'bad':
+                raise ValueError('no genes')
+            open(os.path.join(scratch, 'genes.fna'), 'w').close()
+            return 'genes.fna'
+
+        def classify(item, scratch, genes, threads):
+            assert os.path.isfile(os.path.join(scratch, genes))
+            use(threads, 'classify', item)
+            time.sleep(0.2)
+            use(-threads, 'classified', item)
+            return threads
+
+        def summarize(item, scratch, threads):
+            return '{0}:{1}'.format(item, threads)
+
+        try:
+            items = ['a', 'bad', 'c', 'd', 'e']
+            results = list(tRep.pipeline.run_pipeline(items, call_genes, classify, summarize, processes=4, \
+                                                      tmp_dir=tmp_dir))
+            assert [r[0] for r in results] == items
+            assert [r[1] for r in results] == ['a:2', None, 'c:2', 'd:2', 'e:2']
+            assert 'no genes' in results[1][2]
+
+            assert used['most'] <= 4
+            assert log.index(('genes', 'c')) < log.index(('classified', 'a'))
+            assert os.listdir(tmp_dir) == []
+
+            # Stopping early leaves nothing behind either
+            for r in tRep.pipeline.run_pipeline(items, call_genes, classify, summarize, processes=1, tmp_dir=tmp_dir):
+                break
+            assert os.listdir(tmp_dir) == []
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def main_test_17(self):
+        '''
+        Make sure the streamed centrifuge parser matches parsing the whole file with dRep
+        '''
+        import numpy as np
+        import drep.d_bonus
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            hits_loc = os.path.join(tmp_dir, 'cent_hits.tsv')
+            report_loc = os.path.join(tmp_dir, 'cent_report.tsv')
+
+            taxids = [208224, 9000261, 1303, 9000198, 0]
+            pd.DataFrame({'name':['Species 208224', 'Species 9000261', 'Species 1303', 'Genus4', 'unclassified'],
+                          'taxID':taxids, 'taxRank':['species', 'species', 'species', 'genus', 'no rank'],
+                          'genomeSize':0, 'numReads':0, 'numUniqueReads':0, 'abundance':0.0}) \
+                          .to_csv(report_loc, sep='\t', index=False)
+
+            r = np.random.RandomState(7)
+            num = 500
+            score = r.randint(0, 1200, num)
+            pd.DataFrame({'readID':['scaff_{0}_{1}'.format(i // 20, i // 3) for i in range(num)],
+                          'seqID':'seq', 'taxID':r.choice(taxids, num, p=[0.4, 0.2, 0.1, 0.2, 0.1]),
+                          'score':score, '2ndBestScore':score - r.randint(0, 300, num),
+                          'hitLength':100, 'queryLength':150, 'numMatches':1}) \
+                          .to_csv(hits_loc, sep='\t', index=False)
+
+            Tdb = drep.d_bonus.parse_raw_centrifuge(hits_loc, report_loc)
+            Tdb = Tdb[(Tdb['score'] >= 300) & (Tdb['score'] - Tdb['2ndBestScore'] >= 50)]
+            for chunksize in [7, 1000000]:
+                # taxID counts
+                counts = tRep.count_centrifuge_taxids(hits_loc, min_score=300, min_diff=50, above=250, \
+                                                      chunksize=chunksize)
+                assert counts.to_dict() == Tdb['taxID'].value_counts().to_dict()
+                assert counts.index.tolist() == Tdb['taxID'].unique().tolist()
+
+                # every method
+                kwargs = {'min_score':'300', 'min_diff':'50', 'percent':'50', 'chunksize':chunksize}
+                tax = tRep.from_raw_centrifuge(hits_loc, report_loc, method='percent', **kwargs)
+                assert tax == tRep.gen_taxonomy_string(Tdb['taxID'].tolist(), minPerc=50)
+                assert tax == tRep.from_tdb(Tdb, method='percent', percent='50')
+
+                tax = tRep.from_raw_centrifuge(hits_loc, report_loc, method='max', **kwargs)
+                assert tax == tRep.from_tdb(Tdb, method='max')
+
+                dump_loc = os.path.join(tmp_dir, 'dump.csv')
+                tRep.from_raw_centrifuge(hits_loc, report_loc, full_dump=dump_loc, **kwargs)
+                assert pd.read_csv(dump_loc).equals(tRep.gen_full_tdb(Tdb))
+
+            # filter_hits keeps the same hits
+            Fdb = tRep.filter_hits(drep.d_bonus.parse_raw_centrifuge(hits_loc, report_loc), min_score=300, min_diff=50)
+            assert Fdb.index.tolist() == Tdb.index.tolist()
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def main_test_18(self):
+        '''
+        Make sure prodigal output in a work directory is reused, and failed runs raise CalledProcessError
+        '''
+        import subprocess
+
+        tmp_dir = tempfile.mkdtemp()
+        path = os.environ['PATH']
+        try:
+            bin_dir = os.path.join(tmp_dir, 'bin')
+            os.makedirs(bin_dir)
+            prodigal = os.path.join(bin_dir, 'prodigal')
+            with open(prodigal, 'w') as o:
+                o.write('#!/bin/bash\n'
+                        + 'while [ $# -gt 0 ]; do case $1 in -i) I=$2; shift;; -d) D=$2; shift;; -a) A=$2; shift;; '
+                        + 'esac; shift; done\n'
+                        + 'echo run >> {0}/runs\n'.format(tmp_dir)
+                        + 'if [ -n "$FAIL" ]; then echo partial > $D; echo broken >&2; exit 3; fi\n'
+                        + 'cat $I > $D; cp $D $A\n')
+            os.chmod(prodigal, 0o755)
+            os.environ['PATH'] = bin_dir + os.pathsep + path
+
+            work_dir = os.path.join(tmp_dir, 'work')
+            os.makedirs(work_dir)
+            for i in range(2):
+                fna = tRep.pipeline.run_prodigal('/genomes/g1.fna', work_dir)
+                assert fna == os.path.join(work_dir, 'g1.fna.fna')
+            with open(os.path.join(tmp_dir, 'runs')) as f:
+                assert len(f.readlines()) == 1
+
+            os.environ['FAIL'] = '1'
+            try:
+                tRep.pipeline.run_prodigal('/genomes/g2.fna', work_dir)
+                assert False
+            except subprocess.CalledProcessError as e:
+                assert e.returncode == 3
+                assert b'broken' in e.stderr
+            assert sorted(os.listdir(work_dir)) == ['g1.fna.faa', 'g1.fna.fna']
+            del os.environ['FAIL']
+
+            # Genomes with the same name in different directories don't share a work directory
+            fastas = []
+            for d in ['A', 'B']:
+                os.makedirs(os.path.join(tmp_dir, d))
+                fastas.append(os.path.join(tmp_dir, d, 'bin.1.fa'))
+                with open(fastas[-1], 'w') as o:
+                    o.write('>{0}\n'.format(d))
+            assert tRep.pipeline.get_genome_names(fastas) == [os.path.abspath(f) for f in fastas]
+            assert tRep.pipeline.get_fastas(fastas + fastas[:1]) == fastas
+
+            pipeline_dir = os.path.join(tmp_dir, 'pipeline')
+            for i in range(2):
+                results = tRep.pipeline.run_pipeline(fastas, lambda f, scratch: tRep.pipeline.run_prodigal(f, scratch), \
+                            lambda f, scratch, genes, threads: genes, lambda f, scratch, genes: open(genes).read(), \
+                            processes=2, work_dir=pipeline_dir)
+                assert [r[1] for r in results] == ['>A\n', '>B\n']
+            assert len(os.listdir(pipeline_dir)) == 2
+            with open(os.path.join(tmp_dir, 'runs')) as f:
+                assert len(f.readlines()) == 4
+        finally:
+            os.environ['PATH'] = path
+            os.environ.pop('FAIL', None)
+            shutil.rmtree(tmp_dir)
+
+    def main_test_19(self):
+        '''
+        Make sure taxIDs that aren't whole numbers aren't rounded to a real lineage
+        '''
+        hits = [287, 287.0, '287', 1239.5, '1239.7', 287.5]
+        levels = tRep.gen_levels_db(hits)
+        assert levels['taxID'].tolist() == [287, 287.0, '287']
+
+        assert tRep.get_lineage_index().translate([287, 287.5, 1239.5]).tolist() == [287, 0, 0]
+        assert tRep.engine.TaxonomyEngine().lineages([1239.5, '1239.7']) == [None, None]
+        for t in [1239.5, '1239.7']:
+            try:
+                tRep.get_taxdb().lineage(t)
+                assert False
+            except ValueError:
+                pass
+
+        # They count as hits without a lineage
+        tax, counts = tRep.gen_taxonomy_string([287, 287, 1239.5], testing=True)
+        assert counts['phylum'] == {1224:2}
+        try:
+            tRep.gen_full_tdb(pd.DataFrame({'taxID':[287, 1239.5]}))
+            assert False
+        except ValueError:
+            pass
+
 class testMakeTdb():
     def setUp(self):
         self.b6_loc = load_b6_loc()
@@ -222,6 +784,14 @@ class testFunctional_tax():
         self.test_1()
         self.tearDown()
 
+        self.setUp()
+        self.test_2()
+        self.tearDown()
+
+        self.setUp()
+        self.test_3()
+        self.tearDown()
+
     def test_1(self):
         out_base = os.path.join(self.test_dir, 'test_out_base')
         cmd = [self.script_loc, '-b', self.b6_loc, '-o', out_base, '-d', self.small_tans_table]
@@ -231,6 +801,67 @@ class testFunctional_tax():
         assert len(files) == 1, files
         print(files)
 
+    def test_2(self):
+        '''
+        Make sure looking up hits in an indexed translation table gives the same answer as a scan
+        '''
+        tt_loc = os.path.join(self.test_dir, 'ttable.gz')
+        shutil.copy(self.small_tans_table, tt_loc)
+
+        hits = set([ID for ID, annotation in tRep.ttable.iter_ttable(tt_loc)][::7] + ['not_there'])
+        r2t = tRep.ttable.load_annotations(tt_loc, hits)
+        assert len(r2t) == len(hits) - 1
+
+        assert not os.path.isfile(tRep.ttable.get_index_loc(tt_loc))
+        tRep.ttable.build_index(tt_loc)
+        assert tRep.ttable.index_is_current(tt_loc, tRep.ttable.get_index_loc(tt_loc))
+        assert tRep.ttable.load_annotations(tt_loc, hits) == r2t
+
+        # Locations with characters that mean something in a URI
+        odd_dir = os.path.join(self.test_dir, 'odd?dir#1%20')
+        os.makedirs(odd_dir)
+        odd_loc = os.path.join(odd_dir, 'ttable.gz')
+        shutil.copy(self.small_tans_table, odd_loc)
+        tRep.ttable.build_index(odd_loc)
+        assert tRep.ttable.index_is_current(odd_loc, tRep.ttable.get_index_loc(odd_loc))
+        assert tRep.ttable.lookup_index(tRep.ttable.get_index_loc(odd_loc), hits) == r2t
+
+        # Run the script with the index
+        out_base = os.path.join(self.test_dir, 'test_out_base')
+        cmd = [self.script_loc, '-b', self.diamond_loc, '-o', out_base, '-d', tt_loc, '--build_index']
+        call(cmd)
+        assert len(glob.glob(out_base + '*')) == 1
+
+    def test_3(self):
+        '''
+        Make sure a BGZF translation table scanned by several processes gives the same answer
+        '''
+        bgzf_loc = os.path.join(self.test_dir, 'ttable.bgzf.gz')
+        cmd = [get_script_loc('bgzip_ttable.py'), '-i', self.small_tans_table, '-o', bgzf_loc]
+        call(cmd)
+        assert tRep.ttable.is_bgzf(bgzf_loc)
+        assert not tRep.ttable.is_bgzf(self.small_tans_table)
+
+        hits = set([ID for ID, annotation in tRep.ttable.iter_ttable(self.small_tans_table)][::7])
+        r2t = tRep.ttable.load_annotations(self.small_tans_table, hits, processes=2)
+        assert len(r2t) == len(hits)
+
+        # Use tiny chunks so that lots of lines are split between them
+        chunk = tRep.ttable.SCAN_CHUNK
+        tRep.ttable.SCAN_CHUNK = 1
+        try:
+            assert tRep.ttable.load_annotations(bgzf_loc, hits, processes=2) == r2t
+        finally:
+            tRep.ttable.SCAN_CHUNK = chunk
+
+        # From a thread (like in trep_server.py), the workers are spawned rather than forked
+        found = []
+        thread = threading.Thread(target=lambda: found.append((tRep.ttable._get_context().get_start_method(), \
+                                  tRep.ttable.load_annotations(bgzf_loc, hits, processes=2))))
+        thread.start()
+        thread.join()
+        assert found == [('spawn', r2t)]
+
 class test_tax_collector():
     def setUp(self):
         self.b6_loc = load_b6_loc()
@@ -277,6 +908,38 @@ class test_tax_collector():
         self.main_test_6()
         self.tearDown()
 
+        self.setUp()
+        self.main_test_7()
+        self.tearDown()
+
+        self.setUp()
+        self.main_test_8()
+        self.tearDown()
+
+        self.setUp()
+        self.main_test_9()
+        self.tearDown()
+
+        self.setUp()
+        self.main_test_10()
+        self.tearDown()
+
+        self.setUp()
+        self.main_test_11()
+        self.tearDown()
+
+        self.setUp()
+        self.main_test_12()
+        self.tearDown()
+
+        self.setUp()
+        self.main_test_13()
+        self.tearDown()
+
+        self.setUp()
+        self.main_test_14()
+        self.tearDown()
+
         # THIS TAKES A WHILE AND REQUIRES SUPERVISION; NO NEED TO RUN NORMALLY
         # self.setUp()
         # self.update_test()
@@ -473,6 +1136,303 @@ class test_tax_collector():
                 assert len(db) == len(stb['bin'].unique()), [len(db), len(stb['bin'].unique())]
             assert os.path.getsize(f) > 0
 
+    def main_test_7(self):
+        '''
+        Make sure reading the b6 file in chunks gives the same answer
+        '''
+        out_base = os.path.join(self.test_dir, 'test_out_base')
+        cmd = [self.script_loc, '-b', self.diamond_loc, '-o', out_base, '-a', self.aa_loc, '-stb', 'ALL']
+        call(cmd)
+
+        out_base_c = os.path.join(self.test_dir, 'test_out_chunked')
+        cmd = [self.script_loc, '-b', self.diamond_loc, '-o', out_base_c, '-a', self.aa_loc, '-stb', 'ALL', '--max_memory', '0.01']
+        call(cmd)
+
+        for t in ['fullScaffoldTaxonomy', 'fullGenomeTaxonomy']:
+            db = pd.read_csv(out_base + '_{0}.tsv'.format(t), sep='\t')
+            dbC = pd.read_csv(out_base_c + '_{0}.tsv'.format(t), sep='\t')
+            assert db.equals(dbC), t
+
+        # Chunked loading in the API too
+        Bdb = tRep.load_b6(self.diamond_loc)
+        BdbC = tRep.load_b6(self.diamond_loc, chunksize=100)
+        assert Bdb.reset_index(drop=True).equals(BdbC.reset_index(drop=True))
+
+        # Duplicate querry / target pairs keep their best e-value
+        dup_loc = os.path.join(self.test_dir, 'duplicates.diamondOut')
+        with open(self.diamond_loc) as f:
+            lines = [next(f) for i in range(3)]
+        worse = lines[0].split('\t')
+        worse[10] = '1'
+        with open(dup_loc, 'w') as o:
+            o.write(''.join(['\t'.join(worse)] + lines))
+        for chunksize in [None, 2]:
+            Ddb = tRep.load_b6(dup_loc, chunksize=chunksize)
+            assert len(Ddb) == 3
+            assert not Ddb.duplicated(subset=['querry', 'target']).any()
+            assert Ddb['e-value'].tolist() == Bdb['e-value'].tolist()[:3]
+
+    def main_test_8(self):
+        '''
+        Make sure a batch run from a manifest gives the same answer as running each sample
+        '''
+        samples = [[self.diamond_loc, os.path.join(self.test_dir, 'single_1'), 'ALL', self.aa_loc],
+                   [self.diamond_loc, os.path.join(self.test_dir, 'single_2'), '', '']]
+        for b6, out, stb, aa in samples:
+            cmd = [self.script_loc, '-b', b6, '-o', out]
+            if stb != '':
+                cmd += ['-stb', stb, '-a', aa]
+            call(cmd)
+
+        manifest = os.path.join(self.test_dir, 'manifest.tsv')
+        with open(manifest, 'w') as o:
+            o.write('\t'.join(['b6_loc', 'out_loc', 'scaffold2bin', 'amino_acids']) + '\n')
+            for b6, out, stb, aa in samples:
+                o.write('\t'.join([b6, out.replace('single', 'batch'), stb, aa]) + '\n')
+        cmd = [self.script_loc, '--manifest', manifest, '-p', '2']
+        call(cmd)
+
+        single = sorted(glob.glob(os.path.join(self.test_dir, 'single_*')))
+        assert len(single) == 5, single
+        for f in single:
+            db = pd.read_csv(f, sep='\t')
+            dbB = pd.read_csv(f.replace('single', 'batch'), sep='\t')
+            if 'GeneTaxonomy' in f:
+                # Genes without hits are added in a random order
+                db = db.sort_values('querry').reset_index(drop=True)
+                dbB = dbB.sort_values('querry').reset_index(drop=True)
+            assert db.equals(dbB), f
+
+        # Arguments given on the command line apply to samples without them in the manifest
+        with open(manifest, 'w') as o:
+            o.write('\t'.join(['b6_loc', 'out_loc']) + '\n')
+            o.write('\t'.join([self.diamond_loc, os.path.join(self.test_dir, 'global_1')]) + '\n')
+        call([self.script_loc, '--manifest', manifest, '-stb', 'ALL'])
+        db = pd.read_csv(os.path.join(self.test_dir, 'single_1_fullGenomeTaxonomy.tsv'), sep='\t')
+        dbG = pd.read_csv(os.path.join(self.test_dir, 'global_1_fullGenomeTaxonomy.tsv'), sep='\t')
+        assert len(dbG) == 1
+        assert db.drop(columns=[c for c in db.columns if c.endswith('_percent')]).equals(\
+               dbG.drop(columns=[c for c in dbG.columns if c.endswith('_percent')]))
+
+    def main_test_9(self):
+        '''
+        Make sure the parquet and feather outputs hold the same tables as the tsv ones
+        '''
+        try:
+            import pyarrow
+        except ImportError:
+            print("pyarrow isn't installed; skipping the parquet / feather test")
+            return
+
+        out_base = os.path.join(self.test_dir, 'test_out_base')
+        cmd = [self.script_loc, '-b', self.diamond_loc, '-o', out_base, '-stb', 'ALL']
+        call(cmd)
+
+        for format in ['parquet', 'feather']:
+            cmd = [self.script_loc, '-b', self.diamond_loc, '-o', out_base, '-stb', 'ALL', '--output_format', format]
+            call(cmd)
+
+            for t in ['fullGeneTaxonomy', 'fullScaffoldTaxonomy', 'fullGenomeTaxonomy']:
+                db = pd.read_csv(out_base + '_{0}.tsv'.format(t), sep='\t')
+                dbF = tRep.table_io.load_table(out_base + '_{0}.{1}'.format(t, format))
+                assert isinstance(dbF['species' if t == 'fullGeneTaxonomy' else 'species_winner'].dtype, \
+                    pd.CategoricalDtype)
+                pd.testing.assert_frame_equal(db, dbF, check_dtype=False, check_categorical=False)
+
+            # Make the scaffold table straight from the saved Tdb
+            sdb = tRep.gen_taxonomy_table(out_base + '_fullGeneTaxonomy.' + format, on='scaffold')
+            db = pd.read_csv(out_base + '_fullScaffoldTaxonomy.tsv', sep='\t')
+            pd.testing.assert_frame_equal(db, sdb, check_dtype=False, check_categorical=False)
+
+    def main_test_10(self):
+        '''
+        Make sure --profile records every stage that ran
+        '''
+        out_base = os.path.join(self.test_dir, 'test_out_base')
+        cmd = [self.script_loc, '-b', self.diamond_loc, '-o', out_base, '-stb', 'ALL', '-a', self.aa_loc, \
+               '--profile', '--profile_stage', 'load_b6']
+        call(cmd)
+
+        with open(out_base + '_profile.json') as f:
+            profile = json.load(f)
+        stages = {s['stage']:s for s in profile['stages']}
+        assert set(stages.keys()) == set(tRep.controller.PROFILE_STAGES)
+        for s in stages.values():
+            assert s['wall_seconds'] >= 0
+            assert s['cpu_seconds'] >= 0
+            assert s['peak_rss_mb'] > 0
+        assert stages['load_b6']['parent'] == 'convert_b6_to_Tdb'
+        assert stages['load_b6']['rows'] == tRep.load_b6(self.diamond_loc, tax_type='group')['taxID'].notna().sum()
+        assert stages['genome_taxonomy']['rows'] == 1
+        assert len(stages['load_b6']['cprofile']['top']) > 0
+        assert os.path.getsize(out_base + '_profile_load_b6.prof') > 0
+
+        # The tables are the same as without --profile
+        db = pd.read_csv(out_base + '_fullScaffoldTaxonomy.tsv', sep='\t')
+        call([self.script_loc, '-b', self.diamond_loc, '-o', out_base, '-stb', 'ALL', '-a', self.aa_loc])
+        assert db.equals(pd.read_csv(out_base + '_fullScaffoldTaxonomy.tsv', sep='\t'))
+
+    def main_test_11(self):
+        '''
+        Make sure --checkpoints only remakes the tables whose inputs changed
+        '''
+        out_base = os.path.join(self.test_dir, 'test_out_base')
+        cmd = [self.script_loc, '-b', self.diamond_loc, '-o', out_base, '-stb', 'ALL', '-a', self.aa_loc, \
+               '--checkpoints']
+        call(cmd)
+        tables = {t:out_base + '_{0}.tsv'.format(t) for t in \
+                  ['fullGeneTaxonomy', 'fullScaffoldTaxonomy', 'fullGenomeTaxonomy']}
+        dbs = {t:pd.read_csv(loc, sep='\t') for t, loc in tables.items()}
+        times = {t:os.path.getmtime(loc) for t, loc in tables.items()}
+        assert os.path.isfile(os.path.join(out_base + '_checkpoints', 'Tdb.pkl'))
+
+        # Nothing changed, so nothing is rewritten
+        output = check_output(cmd).decode()
+        assert 'Reusing the Tdb checkpoint' in output, output
+        for t, loc in tables.items():
+            assert os.path.getmtime(loc) == times[t], t
+
+        # A new .stb only remakes the genome table
+        stb = os.path.join(self.test_dir, 'test.stb')
+        scaffolds = dbs['fullScaffoldTaxonomy']['scaffold'].tolist()
+        with open(stb, 'w') as o:
+            for i, scaffold in enumerate(scaffolds):
+                o.write('{0}\tbin_{1}\n'.format(scaffold, i % 2))
+        cmd[cmd.index('ALL')] = stb
+        call(cmd)
+        for t in ['fullGeneTaxonomy', 'fullScaffoldTaxonomy']:
+            assert os.path.getmtime(tables[t]) == times[t], t
+        assert len(pd.read_csv(tables['fullGenomeTaxonomy'], sep='\t')) == 2
+
+        # And is the same as a run without checkpoints
+        gdb = pd.read_csv(tables['fullGenomeTaxonomy'], sep='\t')
+        shutil.rmtree(out_base + '_checkpoints')
+        call([self.script_loc, '-b', self.diamond_loc, '-o', out_base, '-stb', stb, '-a', self.aa_loc])
+        assert gdb.equals(pd.read_csv(tables['fullGenomeTaxonomy'], sep='\t'))
+        for t in ['fullGeneTaxonomy', 'fullScaffoldTaxonomy']:
+            db = pd.read_csv(tables[t], sep='\t')
+            if t == 'fullGeneTaxonomy':
+                # Genes without hits are added in a random order
+                db = db.sort_values('querry').reset_index(drop=True)
+                dbs[t] = dbs[t].sort_values('querry').reset_index(drop=True)
+            assert db.equals(dbs[t]), t
+
+    def main_test_12(self):
+        '''
+        Make sure --streaming makes the same scaffold table, even a few lines at a time
+        '''
+        out_base = os.path.join(self.test_dir, 'test_out_base')
+        call([self.script_loc, '-b', self.diamond_loc, '-o', out_base, '-a', self.aa_loc])
+        db = pd.read_csv(out_base + '_fullScaffoldTaxonomy.tsv', sep='\t')
+        os.remove(out_base + '_fullScaffoldTaxonomy.tsv')
+
+        stream_base = os.path.join(self.test_dir, 'test_stream_base')
+        call([self.script_loc, '-b', self.diamond_loc, '-o', stream_base, '-a', self.aa_loc, '--streaming'])
+        assert db.equals(pd.read_csv(stream_base + '_fullScaffoldTaxonomy.tsv', sep='\t'))
+        assert not os.path.isfile(stream_base + '_fullGeneTaxonomy.tsv')
+
+        sdb = tRep.streaming.stream_scaffold_taxonomy(self.diamond_loc, tax_type='group', aa_loc=self.aa_loc, \
+                                                      chunksize=7)
+        pd.testing.assert_frame_equal(db, sdb, check_dtype=False)
+
+        # Only the number of genes of each scaffold is kept
+        genes = tRep.streaming._genes_per_scaffold(self.aa_loc, 'diamond')
+        assert sum(genes.values()) == len(tRep.parse_prodigal_genes(self.aa_loc))
+        assert all(isinstance(n, int) for n in genes.values())
+
+        # Scaffolds whose hits aren't next to each other can't be streamed
+        shuffled = os.path.join(self.test_dir, 'shuffled.diamondOut')
+        with open(self.diamond_loc) as f:
+            lines = f.readlines()
+        with open(shuffled, 'w') as o:
+            o.writelines(lines[len(lines) // 2:] + lines[:len(lines) // 2])
+        failed = False
+        try:
+            tRep.streaming.stream_scaffold_taxonomy(shuffled, chunksize=100)
+        except Exception:
+            failed = True
+        assert failed
+
+    def main_test_13(self):
+        '''
+        Make sure runs sent to trep_server.py make the same tables as runs in their own process
+        '''
+        out_base = os.path.join(self.test_dir, 'test_out_base')
+        env = dict(os.environ, TREP_SERVER_SOCKET='off')
+        call([self.script_loc, '-b', self.diamond_loc, '-o', out_base], env=env)
+
+        socket_loc = os.path.join(self.test_dir, 'tRep.sock')
+        env = dict(os.environ, TREP_SERVER_SOCKET=socket_loc)
+        server = Popen([get_script_loc('trep_server.py'), '-t', '2'], env=env)
+        try:
+            for i in range(100):
+                if tRep.server.call('ping', socket_loc) is not None:
+                    break
+                time.sleep(0.1)
+
+            # Two at a time, with relative paths
+            server_base = 'test_server_base'
+            clients = [Popen([self.script_loc, '-b', self.diamond_loc, '-o', server_base + str(i)], \
+                        env=env, cwd=self.test_dir) for i in range(2)]
+            assert [c.wait() for c in clients] == [0, 0]
+            for i in range(2):
+                for table in ['_fullGeneTaxonomy.tsv', '_fullScaffoldTaxonomy.tsv']:
+                    db = pd.read_csv(out_base + table, sep='\t')
+                    sdb = pd.read_csv(os.path.join(self.test_dir, server_base + str(i)) + table, sep='\t')
+                    assert db.equals(sdb)
+
+            # Errors come back to the client
+            assert call([self.script_loc, '-b', os.path.join(self.test_dir, 'missing.b6'), '-o', out_base], \
+                        env=env) != 0
+
+            stats = tRep.server.call('stats', socket_loc)['stats']['commands']['tax_collector']
+            assert stats['count'] == 3
+            assert stats['errors'] == 1
+            assert 0 < stats['p50_seconds'] <= stats['max_seconds']
+
+            # "-stb ALL" isn't a path
+            call([self.script_loc, '-b', self.diamond_loc, '-o', out_base + '_all', '-stb', 'ALL'], \
+                 env=dict(os.environ, TREP_SERVER_SOCKET='off'))
+            assert call([self.script_loc, '-b', self.diamond_loc, '-o', server_base + '_all', '-stb', 'ALL'], \
+                        env=env, cwd=self.test_dir) == 0
+            db = pd.read_csv(out_base + '_all_fullGenomeTaxonomy.tsv', sep='\t')
+            sdb = pd.read_csv(os.path.join(self.test_dir, server_base + '_all_fullGenomeTaxonomy.tsv'), sep='\t')
+            assert db.equals(sdb)
+        finally:
+            tRep.server.call('shutdown', socket_loc)
+            server.wait()
+        assert not os.path.exists(socket_loc)
+
+        # With the server gone, runs go back to running in their own process
+        call([self.script_loc, '-b', self.diamond_loc, '-o', out_base + '_alone'], env=env)
+        assert os.path.isfile(out_base + '_alone_fullGeneTaxonomy.tsv')
+
+    def main_test_14(self):
+        '''
+        Make sure the server swaps in a new taxonomy database without closing the one running requests use
+        '''
+        server = tRep.server.TaxonomyServer(os.path.join(self.test_dir, 'tRep.sock'))
+        try:
+            server.warm_up()
+            old_taxdb, old_index = tRep.get_taxdb(), tRep.get_lineage_index()
+            conn = old_taxdb.connect()
+
+            # Nothing changed
+            server.check_taxdb()
+            assert tRep.get_taxdb() is old_taxdb
+
+            # Changed, like after --update
+            server.taxdb_fingerprint = None
+            server.check_taxdb()
+            assert tRep.get_taxdb() is not old_taxdb
+            assert tRep.get_lineage_index() is not old_index
+            assert old_taxdb.conn is conn
+            assert conn.execute('SELECT count(*) FROM species').fetchone()[0] > 0
+            assert tRep.get_taxdb().names([2]) == old_taxdb.names([2])
+        finally:
+            server.server_close()
+            server.pool.shutdown(wait=True)
+
     def update_test(self):
         '''
         Make sure tax collector actually updates